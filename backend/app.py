@@ -1,32 +1,79 @@
 import os
 from flask import Flask, render_template, session, redirect, url_for
-from flask_session import Session # Import Flask-Session
+from werkzeug.middleware.proxy_fix import ProxyFix
 from backend.config import Config # Import your Config class
+from backend.models import init_db_pool
+from backend.sessions import init_session, init_session_gc
+from backend.reports import init_report_cache, init_report_prerenderer
+from backend.qr_images import init_qr_cache
+from backend.passwords import init_password_hasher
+from backend.ratelimit import init_login_limiter
+from backend.doctors import init_doctor_directory
+from backend.roster import init_doctor_roster
+from backend import migrations
+from backend.cli import register_commands
 
 # Import Blueprints
 from backend.routes.auth import auth_bp
-from backend.routes.patient import patient_bp, parse_disease_history # Import parse_disease_history
+from backend.routes.patient import patient_bp
 from backend.routes.doctor import doctor_bp
 from backend.routes.appointment import appointment_bp
 from backend.routes.qr_code import qr_bp
+from backend.routes.admin import admin_bp
 
-def create_app():
+def create_app(config_overrides=None):
     app = Flask(__name__,
                 template_folder='templates', # Specify templates folder relative to backend/
                 static_folder='static')      # Specify static folder relative to backend/
     app.config.from_object(Config)
+    if config_overrides:
+        app.config.update(config_overrides)
 
-    # Initialize Flask-Session
-    Session(app)
+    # Client address and scheme from trusted proxies' X-Forwarded-* headers (used by the login limiter)
+    if app.config['TRUSTED_PROXY_COUNT'] > 0:
+        proxies = app.config['TRUSTED_PROXY_COUNT']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+
+    # Initialize server-side sessions (Flask-Session, or our PostgreSQL store; see SESSION_TYPE)
+    init_session(app)
+
+    # Create the shared PostgreSQL connection pool (connections are returned on request teardown)
+    init_db_pool(app)
+
+    # Cache for rendered emergency report PDFs, and the background pool that keeps it warm
+    init_report_cache(app)
+    init_report_prerenderer(app)
+
+    # In-process LRU cache for generated QR code images
+    init_qr_cache(app)
+
+    # Process pool for password hashing, so logins don't tie up request threads
+    init_password_hasher(app)
+
+    # Failed-login throttling, checked before any database or hashing work
+    init_login_limiter(app)
+
+    # In-memory doctor roster for appointment booking
+    init_doctor_directory(app)
+
+    # Per-doctor cache of the dashboard's patient roster (count and first page)
+    init_doctor_roster(app)
+
+    # Schema migrations: apply at startup if configured, and warn about missing hot-path indexes
+    register_commands(app)
+    if app.config['AUTO_MIGRATE']:
+        with app.app_context():
+            migrations.upgrade()
+    if app.config['CHECK_INDEXES_ON_STARTUP']:
+        migrations.warn_missing_indexes(app)
 
     # Ensure the session file directory exists
-    if not os.path.exists(app.config['SESSION_FILE_DIR']):
+    if app.config['SESSION_TYPE'] == 'filesystem' and not os.path.exists(app.config['SESSION_FILE_DIR']):
         os.makedirs(app.config['SESSION_FILE_DIR'])
         print(f"Created session directory: {app.config['SESSION_FILE_DIR']}") # For debugging
 
-    # Make parse_disease_history available as a global function in Jinja2 templates
-    app.jinja_env.globals['parse_disease_history'] = parse_disease_history
-
+    # Sweep expired sessions outside of requests (see SESSION_GC_INTERVAL)
+    init_session_gc(app)
 
     # Register Blueprints
     app.register_blueprint(auth_bp)
@@ -34,6 +81,7 @@ def create_app():
     app.register_blueprint(doctor_bp)
     app.register_blueprint(appointment_bp)
     app.register_blueprint(qr_bp)
+    app.register_blueprint(admin_bp)
 
     # Main application routes
     @app.route('/')
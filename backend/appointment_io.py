@@ -0,0 +1,273 @@
+import csv
+import io
+import json
+from collections import namedtuple
+import psycopg2
+import psycopg2.errors
+
+# --- Bulk Appointment Import / Export ---
+# Clinics moving over from another system hand us their calendars as CSV or NDJSON (one
+# JSON object per line). Files are streamed into a temporary staging table with COPY, never
+# held in memory or inserted row by row. Every row is then checked with a few set-based
+# statements (joins against patients and doctors, overlap checks against the calendar and
+# the rest of the file), and only if all rows pass are they merged into appointments with a
+# single INSERT ... SELECT, in the same transaction. A file with any bad row changes nothing.
+#
+# Exports run COPY (SELECT ...) TO STDOUT, so PostgreSQL formats the rows and we only pass
+# bytes along. The CSV export can be imported again (the extra columns are ignored).
+# Imports from `flask appointments import` reach the running app's doctor roster cache when
+# its entries expire (DOCTOR_ROSTER_CACHE_TTL).
+
+IMPORT_COLUMNS = ('patient_uid', 'doctor_id', 'appointment_date', 'duration_minutes', 'reason', 'status')
+# Columns of the export that carry no appointment data of their own
+IGNORED_COLUMNS = ('id', 'patient_name')
+REQUIRED_COLUMNS = ('patient_uid', 'doctor_id', 'appointment_date')
+FORMATS = ('csv', 'ndjson')
+APPOINTMENT_STATUSES = ('scheduled', 'completed', 'cancelled')
+
+# rows: rows in the file; imported: rows merged (0 when rejected);
+# errors: [(row number, problem)] for the first few rejected rows; error_count: all rejected rows
+ImportResult = namedtuple('ImportResult', ['rows', 'imported', 'errors', 'error_count'])
+
+class ImportRejected(Exception):
+    """Raised when a file can't be read at all (bad header, malformed CSV/JSON); nothing is imported."""
+
+# Every column is text so that a bad value becomes a validation error, not a COPY failure.
+# doctor, starts_at and minutes hold the parsed values.
+STAGING_TABLE_SQL = """
+    CREATE TEMP TABLE appointment_import (
+        row_number SERIAL,
+        id TEXT, patient_uid TEXT, patient_name TEXT, doctor_id TEXT, appointment_date TEXT,
+        duration_minutes TEXT, reason TEXT, status TEXT,
+        doctor INTEGER, starts_at TIMESTAMP, minutes INTEGER, problem TEXT
+    ) ON COMMIT DROP
+"""
+
+PARSE_SQL = """
+    UPDATE appointment_import SET
+        patient_uid = NULLIF(trim(patient_uid), ''),
+        doctor = try_cast_integer(doctor_id),
+        starts_at = try_cast_timestamp(appointment_date),
+        minutes = CASE WHEN NULLIF(trim(duration_minutes), '') IS NULL THEN %(default_minutes)s
+                       ELSE try_cast_integer(duration_minutes) END,
+        status = COALESCE(NULLIF(lower(trim(status)), ''), 'scheduled')
+"""
+
+VALIDATE_SQL = """
+    UPDATE appointment_import s SET problem = v.problem
+    FROM (
+        SELECT s.row_number, CASE
+            WHEN s.patient_uid IS NULL THEN 'patient_uid is missing'
+            WHEN p.uid IS NULL THEN 'unknown patient_uid ' || s.patient_uid
+            WHEN s.doctor IS NULL THEN 'doctor_id is missing or not a number'
+            WHEN u.id IS NULL THEN 'doctor_id ' || s.doctor || ' is not a doctor'
+            WHEN s.starts_at IS NULL THEN 'appointment_date is missing or not a date and time'
+            WHEN s.minutes IS NULL OR s.minutes NOT BETWEEN 5 AND 480 THEN 'duration_minutes must be 5 to 480'
+            WHEN s.status <> ALL(%(statuses)s) THEN 'unknown status ' || s.status
+        END AS problem
+        FROM appointment_import s
+        LEFT JOIN patients p ON p.uid = s.patient_uid
+        LEFT JOIN users u ON u.id = s.doctor AND u.role = 'doctor'
+    ) v
+    WHERE v.row_number = s.row_number AND v.problem IS NOT NULL
+"""
+
+# Same rule as the appointments_no_overlap constraint (migration 0013)
+CALENDAR_OVERLAP_SQL = """
+    UPDATE appointment_import s SET problem = 'overlaps scheduled appointment ' || (
+        SELECT min(a.id) FROM appointments a
+        WHERE a.doctor_id = s.doctor AND a.status = 'scheduled' AND NOT a.double_booked
+          AND tsrange(a.appointment_date, a.appointment_date + make_interval(mins => a.duration_minutes))
+              && tsrange(s.starts_at, s.starts_at + make_interval(mins => s.minutes))
+    )
+    WHERE s.problem IS NULL AND s.status = 'scheduled' AND EXISTS (
+        SELECT 1 FROM appointments a
+        WHERE a.doctor_id = s.doctor AND a.status = 'scheduled' AND NOT a.double_booked
+          AND tsrange(a.appointment_date, a.appointment_date + make_interval(mins => a.duration_minutes))
+              && tsrange(s.starts_at, s.starts_at + make_interval(mins => s.minutes))
+    )
+"""
+
+# A row overlaps another one in the file if it starts before the latest end among the
+# doctor's rows that start earlier: one sort per doctor instead of comparing every pair
+FILE_OVERLAP_SQL = """
+    UPDATE appointment_import s SET problem = 'overlaps another appointment in the file'
+    FROM (
+        SELECT row_number, starts_at,
+               max(starts_at + make_interval(mins => minutes)) OVER (
+                   PARTITION BY doctor ORDER BY starts_at, row_number
+                   ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+               ) AS previous_end
+        FROM appointment_import
+        WHERE problem IS NULL AND status = 'scheduled'
+    ) w
+    WHERE w.row_number = s.row_number AND w.previous_end > w.starts_at
+"""
+
+MERGE_SQL = """
+    INSERT INTO appointments (patient_uid, doctor_id, appointment_date, duration_minutes, reason, status)
+    SELECT patient_uid, doctor, starts_at, minutes, NULLIF(reason, ''), status
+    FROM appointment_import
+    ORDER BY row_number
+"""
+
+def format_for_filename(filename, default='csv'):
+    """'ndjson' for .ndjson/.jsonl files, 'csv' for .csv, else `default`."""
+    name = (filename or '').lower()
+    if name.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    if name.endswith('.csv'):
+        return 'csv'
+    return default
+
+def _csv_columns(header):
+    """Maps a CSV header to staging table columns (export-only columns included). Raises ImportRejected."""
+    columns = [name.strip().lower() for name in header]
+    unknown = [name for name in columns if name not in IMPORT_COLUMNS + IGNORED_COLUMNS]
+    if unknown:
+        raise ImportRejected(f"Unknown column(s): {', '.join(unknown)}. Expected: {', '.join(IMPORT_COLUMNS)}.")
+    missing = [name for name in REQUIRED_COLUMNS if name not in columns]
+    if missing:
+        raise ImportRejected(f"Missing column(s): {', '.join(missing)}.")
+    if len(set(columns)) != len(columns):
+        raise ImportRejected("Duplicate column names in the header.")
+    return columns
+
+class _NDJSONAsCSV:
+    """File-like object that reads NDJSON from a text stream and hands COPY the same rows as CSV."""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.line_number = 0
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator='\n')
+
+    def _row(self, line):
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            raise ImportRejected(f"Line {self.line_number}: invalid JSON ({e}).")
+        if not isinstance(item, dict):
+            raise ImportRejected(f"Line {self.line_number}: expected a JSON object.")
+        unknown = [key for key in item if key not in IMPORT_COLUMNS + IGNORED_COLUMNS]
+        if unknown:
+            raise ImportRejected(f"Line {self.line_number}: unknown field(s) {', '.join(unknown)}.")
+        # Missing fields and nulls become empty (NULL) CSV fields
+        return ['' if item.get(name) is None else str(item[name]) for name in IMPORT_COLUMNS]
+
+    def read(self, size=8192):
+        while self.buffer.tell() < size:
+            line = self.lines.readline()
+            if not line:
+                break
+            self.line_number += 1
+            if line.strip():
+                self.writer.writerow(self._row(line))
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+class _CopySource:
+    """
+    What COPY FROM STDIN reads. psycopg2 reports an exception raised in read() as a generic
+    QueryCanceled, so the reason is kept here and re-raised once the COPY has failed.
+    """
+
+    def __init__(self, read):
+        self._read = read
+        self.error = None
+
+    def read(self, size=8192):
+        try:
+            return self._read(size)
+        except UnicodeDecodeError:
+            self.error = ImportRejected("The file is not UTF-8 text.")
+            raise
+        except ImportRejected as e:
+            self.error = e
+            raise
+
+def _copy_into_staging(cur, stream, fmt):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'ndjson':
+        columns, source = IMPORT_COLUMNS, _CopySource(_NDJSONAsCSV(text).read)
+    else:
+        try:
+            header = next(csv.reader([text.readline()]), None)
+        except UnicodeDecodeError:
+            raise ImportRejected("The file is not UTF-8 text.")
+        if not header:
+            raise ImportRejected("The file is empty.")
+        columns, source = _csv_columns(header), _CopySource(text.read)
+    try:
+        cur.copy_expert(f"COPY appointment_import ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", source)
+    except psycopg2.Error as e:
+        if source.error is not None:
+            raise source.error
+        if isinstance(e, psycopg2.DataError):
+            raise ImportRejected(f"Malformed file: {e.pgerror or e}".strip())
+        raise
+
+def import_appointments(cur, stream, fmt='csv', default_minutes=30, max_errors=100):
+    """
+    Imports appointments from a binary `stream` of CSV (with a header row) or NDJSON and
+    returns an ImportResult. All rows are merged, or none if any row is invalid. Must be
+    called inside transaction(); raises ImportRejected for unreadable files and if another
+    booking took one of the slots while the import ran (the transaction is then rolled back).
+    """
+    if fmt not in FORMATS:
+        raise ImportRejected(f"Unknown format {fmt!r}; expected one of {', '.join(FORMATS)}.")
+    cur.execute(STAGING_TABLE_SQL)
+    _copy_into_staging(cur, stream, fmt)
+    cur.execute("ANALYZE appointment_import") # Temp tables have no statistics until analyzed
+
+    cur.execute(PARSE_SQL, {'default_minutes': default_minutes})
+    rows = cur.rowcount
+    cur.execute(VALIDATE_SQL, {'statuses': list(APPOINTMENT_STATUSES)})
+    cur.execute(CALENDAR_OVERLAP_SQL)
+    cur.execute(FILE_OVERLAP_SQL)
+
+    cur.execute("SELECT count(*) FROM appointment_import WHERE problem IS NOT NULL")
+    error_count = cur.fetchone()[0]
+    if error_count:
+        cur.execute(
+            "SELECT row_number, problem FROM appointment_import WHERE problem IS NOT NULL ORDER BY row_number LIMIT %s",
+            (max_errors,)
+        )
+        return ImportResult(rows, 0, cur.fetchall(), error_count)
+
+    try:
+        cur.execute(MERGE_SQL)
+    except psycopg2.errors.ExclusionViolation:
+        raise ImportRejected("Another booking took one of the imported slots during the import. Nothing was imported; please try again.")
+    return ImportResult(rows, cur.rowcount, [], 0)
+
+EXPORT_SQL = """
+    SELECT a.id, a.patient_uid, p.name AS patient_name, a.doctor_id, a.appointment_date,
+           a.duration_minutes, a.reason, a.status
+    FROM appointments a
+    JOIN patients p ON p.uid = a.patient_uid
+    WHERE a.doctor_id = %(doctor_id)s
+      AND (%(first_day)s::date IS NULL OR a.appointment_date >= %(first_day)s::date)
+      AND (%(last_day)s::date IS NULL OR a.appointment_date < %(last_day)s::date + 1)
+    ORDER BY a.appointment_date, a.id
+"""
+
+def export_appointments(cur, out, doctor_id, first_day=None, last_day=None, fmt='csv'):
+    """
+    Writes the doctor's appointments (optionally only first_day to last_day, inclusive) to the
+    file-like `out` as CSV with a header row or as NDJSON, straight from COPY ... TO STDOUT.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt!r}")
+    query = cur.mogrify(EXPORT_SQL, {'doctor_id': doctor_id, 'first_day': first_day, 'last_day': last_day}).decode()
+    if fmt == 'ndjson':
+        # row_to_json never produces raw newlines, and with control characters as quote and
+        # delimiter CSV mode never quotes its output, so each line is exactly one JSON object
+        cur.copy_expert(
+            f"COPY (SELECT row_to_json(e) FROM ({query}) e) TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')",
+            out
+        )
+    else:
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", out)
@@ -0,0 +1,183 @@
+import random
+import statistics
+import time
+from datetime import date, datetime, timedelta
+from backend.models import get_cursor, search_patients
+from backend.scheduling import SlotUnavailable, book_appointment, fetch_availability, next_free_slots, working_hours
+
+# Benchmarks against a synthetic data set, run with `flask bench ...` (see backend/cli.py).
+# The data goes into a temporary table that shadows the real one for the benchmark's own
+# transaction only (pg_temp comes first on the search_path), so the code under test runs
+# unmodified and nothing is written to the real tables. Everything is rolled back at the end.
+
+FIRST_NAMES = [
+    'James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+    'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen',
+    'Aarav', 'Priya', 'Wei', 'Mei', 'Mohammed', 'Fatima', 'Carlos', 'Sofia', 'Kwame', 'Amara',
+]
+LAST_NAMES = [
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+    'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin',
+    'Sharma', 'Patel', 'Chen', 'Wang', 'Khan', 'Okafor', 'Mensah', 'Silva', 'Nakamura', 'Kowalski',
+]
+
+def _seed_patients(cur, rows):
+    # LIKE still resolves to the real table here, so the copy gets the same columns and indexes
+    cur.execute("CREATE TEMP TABLE patients (LIKE patients INCLUDING ALL) ON COMMIT DROP")
+    cur.execute(
+        """INSERT INTO patients (uid, user_id, name, date_of_birth, gender, contact_info)
+           SELECT 'bench-' || i, i,
+                  (%(first)s::text[])[1 + (random() * (cardinality(%(first)s::text[]) - 1))::int] || ' ' ||
+                  (%(last)s::text[])[1 + (random() * (cardinality(%(last)s::text[]) - 1))::int],
+                  DATE '1930-01-01' + (random() * 30000)::int,
+                  CASE WHEN i %% 2 = 0 THEN 'Female' ELSE 'Male' END,
+                  '+1 (' || lpad((200 + i %% 800)::text, 3, '0') || ') ' || lpad((random() * 9999999)::int::text, 7, '0')
+           FROM generate_series(1, %(rows)s) AS i""",
+        {'first': FIRST_NAMES, 'last': LAST_NAMES, 'rows': rows}
+    )
+    cur.execute("ANALYZE patients") # Temporary tables are never analyzed automatically
+
+def _sample_queries(cur, count):
+    """Realistic typeahead input: name prefixes, phone fragments and exact dates of birth."""
+    cur.execute("SELECT name, contact_info, date_of_birth FROM patients ORDER BY random() LIMIT %s", (count,))
+    queries = []
+    for name, contact_info, date_of_birth in cur.fetchall():
+        kind = random.choice(('name', 'name', 'phone', 'dob'))
+        if kind == 'name':
+            word = random.choice(name.split()[:2])
+            queries.append(word[:random.randint(3, len(word))])
+        elif kind == 'phone':
+            digits = ''.join(ch for ch in contact_info if ch.isdigit())
+            start = random.randint(0, len(digits) - 4)
+            queries.append(digits[start:start + random.randint(4, 7)])
+        else:
+            queries.append(date_of_birth.isoformat())
+    return queries
+
+def _latency_summary(timings):
+    timings = sorted(timings)
+    return {
+        'queries': len(timings),
+        'p50_ms': round(statistics.median(timings), 2),
+        'p95_ms': round(timings[max(0, int(len(timings) * 0.95) - 1)], 2),
+        'max_ms': round(timings[-1], 2),
+    }
+
+def benchmark_patient_search(rows=1000000, queries=200, limit=10, log=print):
+    """
+    Times search_patients() over `rows` synthetic patients and returns the latency
+    percentiles in milliseconds. Runs inside an application context.
+    """
+    cur = get_cursor()
+    try:
+        started = time.perf_counter()
+        _seed_patients(cur, rows)
+        log(f'Seeded {rows} patients in {time.perf_counter() - started:.1f}s.')
+
+        samples = _sample_queries(cur, queries)
+        for query in samples[:10]: # Warm up caches
+            search_patients(cur, query, limit)
+        timings = []
+        for query in samples:
+            started = time.perf_counter()
+            search_patients(cur, query, limit)
+            timings.append((time.perf_counter() - started) * 1000)
+    finally:
+        cur.connection.rollback() # Drops the temporary table
+
+    result = _latency_summary(timings)
+    log(f"search_patients over {rows} rows: p50 {result['p50_ms']} ms, "
+        f"p95 {result['p95_ms']} ms, max {result['max_ms']} ms ({result['queries']} queries)")
+    return result
+
+def _seed_appointments(cur, doctors, per_doctor, hours, occupancy):
+    """Fills `occupancy` of each doctor's slots, from today on, until each has about `per_doctor` appointments."""
+    cur.execute("CREATE TEMP TABLE appointments (LIKE appointments INCLUDING ALL) ON COMMIT DROP")
+    # Own id sequence, so the real one isn't advanced (the sequence goes with the rollback)
+    cur.execute("CREATE TEMP SEQUENCE bench_appointment_ids")
+    cur.execute("ALTER TABLE appointments ALTER COLUMN id SET DEFAULT nextval('bench_appointment_ids')")
+    # Availability bitmaps (migration 0014): the synthetic doctors keep the default hours
+    cur.execute("CREATE TEMP TABLE doctor_working_hours (LIKE doctor_working_hours INCLUDING ALL) ON COMMIT DROP")
+    cur.execute("CREATE TEMP TABLE doctor_busy_slots (LIKE doctor_busy_slots INCLUDING ALL) ON COMMIT DROP")
+    per_day = _appointments_per_day(hours)
+    cur.execute(
+        """INSERT INTO appointments (patient_uid, doctor_id, appointment_date, duration_minutes, reason, status)
+           SELECT 'bench-patient', d.id,
+                  CURRENT_DATE + s.i / %(slots_per_day)s + %(day_start)s::time
+                      + (s.i %% %(slots_per_day)s) * make_interval(mins => %(slot)s),
+                  %(slot)s, 'Benchmark', 'scheduled'
+           FROM generate_series(1, %(doctors)s) AS d(id)
+           CROSS JOIN generate_series(0, ceil(%(per_doctor)s / %(occupancy)s)::int - 1) AS s(i)
+           WHERE random() < %(occupancy)s""",
+        {'doctors': doctors, 'per_doctor': per_doctor, 'occupancy': occupancy, 'slots_per_day': per_day,
+         'day_start': hours.day_start, 'slot': hours.slot_minutes}
+    )
+    cur.execute("SELECT rebuild_doctor_busy_slots(CURRENT_DATE)")
+    # Bookings made by the benchmark update the bitmaps like real ones
+    cur.execute(
+        """CREATE TRIGGER appointments_maintain_busy_slots
+           AFTER INSERT OR DELETE OR UPDATE OF status, appointment_date, duration_minutes, doctor_id
+           ON appointments FOR EACH ROW EXECUTE FUNCTION maintain_doctor_busy_slots()"""
+    )
+    cur.execute("ANALYZE appointments")
+    cur.execute("ANALYZE doctor_busy_slots")
+    return int(per_doctor / occupancy / per_day) + 1 # Days covered
+
+def _appointments_per_day(hours):
+    return ((hours.day_end.hour * 60 + hours.day_end.minute) -
+            (hours.day_start.hour * 60 + hours.day_start.minute)) // hours.slot_minutes
+
+def benchmark_scheduling(doctors=5, per_doctor=10000, queries=200, occupancy=0.8, log=print):
+    """
+    Times next_free_slots(), a month of fetch_availability() for every doctor, and
+    book_appointment() against doctors with `per_doctor` appointments each (`occupancy` of their slots taken) and returns the latency
+    percentiles in milliseconds. Runs inside an application context.
+    """
+    hours = working_hours()
+    cur = get_cursor()
+    try:
+        started = time.perf_counter()
+        days = _seed_appointments(cur, doctors, per_doctor, hours, occupancy)
+        log(f'Seeded about {doctors * per_doctor} appointments over {days} days in {time.perf_counter() - started:.1f}s.')
+
+        per_day = _appointments_per_day(hours)
+        def random_slot():
+            day = date.today() + timedelta(days=random.randrange(days))
+            offset = timedelta(minutes=random.randrange(per_day) * hours.slot_minutes)
+            return datetime.combine(day, hours.day_start) + offset
+
+        free_timings = []
+        for _ in range(queries):
+            doctor_id, after = random.randint(1, doctors), random_slot()
+            started = time.perf_counter()
+            next_free_slots(cur, doctor_id, after=after, count=5, hours=hours, search_days=days + 7)
+            free_timings.append((time.perf_counter() - started) * 1000)
+
+        month_timings = []
+        for _ in range(queries):
+            first_day = date.today() + timedelta(days=random.randrange(days))
+            started = time.perf_counter()
+            fetch_availability(cur, range(1, doctors + 1), first_day, first_day + timedelta(days=30), hours)
+            month_timings.append((time.perf_counter() - started) * 1000)
+
+        book_timings = []
+        conflicts = 0
+        for _ in range(queries):
+            doctor_id, start = random.randint(1, doctors), random_slot()
+            started = time.perf_counter()
+            try:
+                book_appointment(cur, 'bench-patient', doctor_id, start, 'Benchmark', hours.slot_minutes)
+            except SlotUnavailable:
+                conflicts += 1
+            book_timings.append((time.perf_counter() - started) * 1000)
+    finally:
+        cur.connection.rollback() # Drops the temporary tables and sequence
+
+    result = {'next_free_slots': _latency_summary(free_timings), 'month_availability': _latency_summary(month_timings),
+              'book_appointment': _latency_summary(book_timings), 'conflicts': conflicts}
+    for name in ('next_free_slots', 'month_availability', 'book_appointment'):
+        timing = result[name]
+        log(f"{name} with {per_doctor} appointments per doctor: p50 {timing['p50_ms']} ms, "
+            f"p95 {timing['p95_ms']} ms, max {timing['max_ms']} ms ({timing['queries']} calls)")
+    log(f'{conflicts} of {queries} bookings were rejected as double-bookings.')
+    return result
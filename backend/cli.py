@@ -0,0 +1,135 @@
+import time
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from backend import migrations
+from backend.appointment_io import FORMATS, ImportRejected, import_appointments, export_appointments, format_for_filename
+from backend.benchmarks import benchmark_patient_search, benchmark_scheduling
+from backend.models import transaction, backfill_structured_records
+
+# Flask CLI commands, registered on the app in create_app().
+# Run them with e.g. `flask --app backend.app db upgrade`.
+
+db_cli = AppGroup('db', help='Database schema commands.')
+
+@db_cli.command('upgrade')
+def db_upgrade():
+    """Applies all pending schema migrations."""
+    applied = migrations.upgrade(log=click.echo)
+    if not applied:
+        click.echo('Database schema is up to date.')
+
+@db_cli.command('status')
+def db_status():
+    """Lists pending migrations and missing indexes."""
+    pending = migrations.pending_migrations()
+    if pending:
+        for migration in pending:
+            click.echo(f'Pending: {migration.version:04d}_{migration.name}')
+    else:
+        click.echo('No pending migrations.')
+
+    for table, columns in migrations.missing_indexes():
+        click.echo(f"Missing index: {table}({', '.join(columns)})")
+
+@db_cli.command('backfill-records')
+@click.option('--batch-size', type=int, default=1000, show_default=True, help='Records converted per transaction.')
+@click.option('--pause', type=float, default=0.1, show_default=True,
+              help='Seconds to sleep between batches, to leave room for application traffic.')
+def db_backfill_records(batch_size, pause):
+    """Fills the structured medical record columns (migration 0010) for older records."""
+    total = 0
+    while True:
+        # One short transaction per batch, so row locks are held only briefly
+        with transaction() as cur:
+            converted = backfill_structured_records(cur, batch_size)
+        if not converted:
+            break
+        total += converted
+        click.echo(f'Converted {total} records...')
+        time.sleep(pause)
+    click.echo(f'Backfill complete: {total} records converted.')
+
+sessions_cli = AppGroup('sessions', help='Session store commands.')
+
+@sessions_cli.command('gc')
+@click.option('--time-budget', type=float, default=None,
+              help='Stop after this many seconds (default: sweep everything). The next run resumes.')
+def sessions_gc(time_budget):
+    """Deletes expired sessions and reports the space reclaimed."""
+    collector = current_app.extensions.get('session_gc')
+    if collector is None:
+        click.echo(f"Nothing to sweep for SESSION_TYPE={current_app.config['SESSION_TYPE']!r}.")
+        return
+    result = collector.sweep(time_budget=time_budget or 0)
+    click.echo(f'Scanned {result.scanned} sessions, removed {result.removed} expired '
+               f'({result.bytes_reclaimed} bytes reclaimed).')
+    if not result.complete:
+        click.echo('Time budget exhausted; run again to continue.')
+
+bench_cli = AppGroup('bench', help='Performance benchmarks on synthetic data (nothing is written to real tables).')
+
+@bench_cli.command('patient-search')
+@click.option('--rows', type=int, default=1000000, show_default=True, help='Synthetic patients to search.')
+@click.option('--queries', type=int, default=200, show_default=True, help='Number of timed searches.')
+@click.option('--limit', type=int, default=10, show_default=True, help='Results per search.')
+def bench_patient_search(rows, queries, limit):
+    """Times the doctor patient search (name / phone / date of birth)."""
+    benchmark_patient_search(rows=rows, queries=queries, limit=limit, log=click.echo)
+
+@bench_cli.command('scheduling')
+@click.option('--doctors', type=int, default=5, show_default=True, help='Synthetic doctors.')
+@click.option('--per-doctor', type=int, default=10000, show_default=True, help='Appointments per doctor.')
+@click.option('--queries', type=int, default=200, show_default=True, help='Timed calls of each kind.')
+@click.option('--occupancy', type=float, default=0.8, show_default=True, help='Share of slots already booked.')
+def bench_scheduling(doctors, per_doctor, queries, occupancy):
+    """Times free-slot lookups and conflict-checked bookings."""
+    benchmark_scheduling(doctors=doctors, per_doctor=per_doctor, queries=queries, occupancy=occupancy, log=click.echo)
+
+appointments_cli = AppGroup('appointments', help='Bulk appointment import and export.')
+
+@appointments_cli.command('import')
+@click.argument('file', type=click.File('rb'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None,
+              help='File format (default: from the file extension, else csv).')
+def appointments_import(file, fmt):
+    """Imports appointments from a CSV or NDJSON FILE ('-' for stdin); all rows or none."""
+    fmt = fmt or format_for_filename(file.name)
+    try:
+        with transaction() as cur:
+            result = import_appointments(
+                cur, file, fmt,
+                default_minutes=current_app.config['APPOINTMENT_SLOT_MINUTES'],
+                max_errors=current_app.config['APPOINTMENT_IMPORT_MAX_ERRORS']
+            )
+    except ImportRejected as e:
+        raise click.ClickException(str(e))
+    if result.error_count:
+        for row_number, problem in result.errors:
+            click.echo(f'Row {row_number}: {problem}', err=True)
+        if result.error_count > len(result.errors):
+            click.echo(f'... and {result.error_count - len(result.errors)} more.', err=True)
+        raise click.ClickException(f'{result.error_count} of {result.rows} rows rejected; nothing was imported.')
+    click.echo(f'Imported {result.imported} appointments.')
+
+@appointments_cli.command('export')
+@click.option('--doctor-id', type=int, required=True, help="The doctor's user id.")
+@click.option('--from', 'first_day', type=click.DateTime(['%Y-%m-%d']), default=None, help='First day (YYYY-MM-DD).')
+@click.option('--to', 'last_day', type=click.DateTime(['%Y-%m-%d']), default=None, help='Last day, inclusive (YYYY-MM-DD).')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.File('w'), default='-', help='Output file (default: stdout).')
+def appointments_export(doctor_id, first_day, last_day, fmt, output):
+    """Writes a doctor's appointments as CSV or NDJSON."""
+    with transaction() as cur:
+        export_appointments(
+            cur, output, doctor_id,
+            first_day=first_day.date() if first_day else None,
+            last_day=last_day.date() if last_day else None,
+            fmt=fmt
+        )
+
+def register_commands(app):
+    app.cli.add_command(db_cli)
+    app.cli.add_command(sessions_cli)
+    app.cli.add_command(bench_cli)
+    app.cli.add_command(appointments_cli)
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import namedtuple
+from flask import current_app
+from backend.models import transaction, on_commit
+
+# --- Doctor Directory ---
+# Patients pick a doctor from the full roster every time they book an appointment, but the
+# roster only changes when a doctor registers. It is loaded once and kept in memory for
+# DOCTOR_DIRECTORY_TTL seconds; registering a doctor clears it on this node straight away
+# (other nodes pick the new doctor up when their copy expires).
+
+Doctor = namedtuple('Doctor', ['id', 'username', 'name', 'specialization'])
+
+DOCTOR_DIRECTORY_SQL = """
+    SELECT u.id, u.username, d.name, d.specialization
+    FROM users u
+    LEFT JOIN doctors d ON d.user_id = u.id
+    WHERE u.role = 'doctor'
+    ORDER BY COALESCE(d.name, u.username), u.id
+"""
+
+DOCTOR_LOOKUP_SQL = """
+    SELECT u.id, u.username, d.name, d.specialization
+    FROM users u
+    LEFT JOIN doctors d ON d.user_id = u.id
+    WHERE u.role = 'doctor' AND u.id = %s
+"""
+
+class DoctorDirectory:
+    """In-memory copy of the doctor roster, reloaded when older than `ttl` seconds or invalidated."""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._doctors = None
+        self._loaded_at = 0.0
+        self._generation = 0 # Bumped by invalidate(), so a load that started before it isn't kept
+        self.loads = 0
+        self.lookups = 0 # Single-doctor queries for ids missing from the cached roster
+
+    def _load(self):
+        with transaction() as cur:
+            cur.execute(DOCTOR_DIRECTORY_SQL)
+            return [Doctor(*row) for row in cur.fetchall()]
+
+    def all(self):
+        """Returns every doctor, ordered by name. May query the database (raises psycopg2.Error)."""
+        with self._lock:
+            if self._doctors is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._doctors
+            generation = self._generation
+        # Load outside the lock: concurrent misses may both query, but never wait on each other's I/O
+        doctors = self._load()
+        with self._lock:
+            self.loads += 1
+            if generation == self._generation:
+                self._doctors = doctors
+                self._loaded_at = time.monotonic()
+        return doctors
+
+    def get(self, doctor_id):
+        """
+        Returns the Doctor with this user id, or None. An id missing from the cached roster is
+        looked up on its own, in case the doctor registered on another node since it was cached;
+        only if that finds a doctor is the roster dropped, so bogus ids never force a reload.
+        """
+        if doctor_id is None:
+            return None
+        for doctor in self.all():
+            if doctor.id == doctor_id:
+                return doctor
+        with self._lock:
+            self.lookups += 1
+        with transaction() as cur:
+            cur.execute(DOCTOR_LOOKUP_SQL, (doctor_id,))
+            row = cur.fetchone()
+        if row is None:
+            return None
+        self.invalidate()
+        return Doctor(*row)
+
+    def by_specialization(self, specialization=None):
+        """Doctors with the given specialization (case-insensitive); all of them if None/empty."""
+        doctors = self.all()
+        if not specialization:
+            return doctors
+        wanted = specialization.strip().lower()
+        return [doctor for doctor in doctors if (doctor.specialization or '').strip().lower() == wanted]
+
+    def specializations(self):
+        """Distinct specializations (compared case-insensitively), for the booking filter."""
+        seen = {}
+        for doctor in self.all():
+            label = (doctor.specialization or '').strip()
+            if label:
+                seen.setdefault(label.lower(), label)
+        return sorted(seen.values(), key=str.lower)
+
+    def metrics(self):
+        with self._lock:
+            cached = self._doctors is not None
+            return {
+                'doctors': len(self._doctors) if cached else None,
+                'age_seconds': round(time.monotonic() - self._loaded_at, 1) if cached else None,
+                'loads': self.loads,
+                'lookups': self.lookups,
+                'ttl': self.ttl,
+            }
+
+    def invalidate(self):
+        with self._lock:
+            self._doctors = None
+            self._generation += 1
+
+def init_doctor_directory(app):
+    directory = DoctorDirectory(ttl=app.config['DOCTOR_DIRECTORY_TTL'])
+    app.extensions['doctor_directory'] = directory
+    return directory
+
+def get_doctor_directory():
+    return current_app.extensions['doctor_directory']
+
+def invalidate_doctor_directory():
+    """Drops the cached roster once the current transaction commits (e.g. after registering a doctor)."""
+    directory = get_doctor_directory()
+    on_commit(directory.invalidate)
@@ -0,0 +1,49 @@
+-- Baseline schema for the Virtual Health Record app.
+-- Uses IF NOT EXISTS so databases that were created by hand before migrations
+-- existed are adopted as-is.
+
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    username VARCHAR(255) NOT NULL UNIQUE,
+    password TEXT NOT NULL,
+    role VARCHAR(20) NOT NULL CHECK (role IN ('patient', 'doctor'))
+);
+
+CREATE TABLE IF NOT EXISTS patients (
+    uid VARCHAR(255) PRIMARY KEY,
+    user_id INTEGER NOT NULL UNIQUE REFERENCES users (id) ON DELETE CASCADE,
+    name VARCHAR(255) NOT NULL,
+    date_of_birth DATE,
+    gender VARCHAR(20),
+    contact_info TEXT,
+    emergency_contact_name VARCHAR(255),
+    emergency_contact_relationship VARCHAR(100),
+    emergency_contact_phone VARCHAR(50)
+);
+
+CREATE TABLE IF NOT EXISTS doctors (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL UNIQUE REFERENCES users (id) ON DELETE CASCADE,
+    name VARCHAR(255) NOT NULL,
+    specialization VARCHAR(255),
+    license_number VARCHAR(100) NOT NULL UNIQUE,
+    contact_info TEXT
+);
+
+CREATE TABLE IF NOT EXISTS medical_records (
+    id SERIAL PRIMARY KEY,
+    patient_uid VARCHAR(255) NOT NULL REFERENCES patients (uid) ON DELETE CASCADE,
+    doctor_id INTEGER NOT NULL REFERENCES users (id),
+    record_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    disease_history TEXT,
+    prescriptions TEXT
+);
+
+CREATE TABLE IF NOT EXISTS appointments (
+    id SERIAL PRIMARY KEY,
+    patient_uid VARCHAR(255) NOT NULL REFERENCES patients (uid) ON DELETE CASCADE,
+    doctor_id INTEGER NOT NULL REFERENCES users (id),
+    appointment_date TIMESTAMP NOT NULL,
+    reason TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'scheduled'
+);
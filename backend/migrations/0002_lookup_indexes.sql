@@ -0,0 +1,27 @@
+-- Indexes for the columns the views filter and sort on.
+
+-- Single-row lookups. Fresh databases already have these through the UNIQUE
+-- constraints in 0001 (same default names); hand-made databases may not.
+CREATE UNIQUE INDEX IF NOT EXISTS users_username_key ON users (username);
+CREATE UNIQUE INDEX IF NOT EXISTS patients_user_id_key ON patients (user_id);
+CREATE UNIQUE INDEX IF NOT EXISTS doctors_license_number_key ON doctors (license_number);
+
+-- A patient's history, newest first (dashboards, search, PDF report).
+CREATE INDEX IF NOT EXISTS idx_medical_records_patient_date
+    ON medical_records (patient_uid, record_date DESC);
+
+-- A patient's appointments, newest first.
+CREATE INDEX IF NOT EXISTS idx_appointments_patient_date
+    ON appointments (patient_uid, appointment_date DESC);
+
+-- The patient's next scheduled appointment (status = 'scheduled' ORDER BY appointment_date LIMIT 1).
+CREATE INDEX IF NOT EXISTS idx_appointments_patient_status_date
+    ON appointments (patient_uid, status, appointment_date);
+
+-- A doctor's appointments on manage_appointments, newest first.
+CREATE INDEX IF NOT EXISTS idx_appointments_doctor_date
+    ON appointments (doctor_id, appointment_date DESC);
+
+-- The doctor picker (WHERE role = 'doctor' ORDER BY username).
+CREATE INDEX IF NOT EXISTS idx_users_role_username
+    ON users (role, username);
@@ -0,0 +1,15 @@
+-- History lists page with keyset cursors on (date, id). Extend the per-patient and
+-- per-doctor indexes with id so every page is a single index range scan, and drop the
+-- 0002 indexes they supersede (same leading columns).
+
+CREATE INDEX IF NOT EXISTS idx_medical_records_patient_date_id
+    ON medical_records (patient_uid, record_date DESC, id DESC);
+DROP INDEX IF EXISTS idx_medical_records_patient_date;
+
+CREATE INDEX IF NOT EXISTS idx_appointments_patient_date_id
+    ON appointments (patient_uid, appointment_date DESC, id DESC);
+DROP INDEX IF EXISTS idx_appointments_patient_date;
+
+CREATE INDEX IF NOT EXISTS idx_appointments_doctor_date_id
+    ON appointments (doctor_id, appointment_date DESC, id DESC);
+DROP INDEX IF EXISTS idx_appointments_doctor_date;
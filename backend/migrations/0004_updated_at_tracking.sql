@@ -0,0 +1,27 @@
+-- Track when patient data last changed, so cached emergency reports can be keyed on a
+-- data version (backend/reports.py). New rows get the default; updates go through the trigger.
+
+ALTER TABLE patients ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE medical_records ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE appointments ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+-- clock_timestamp() rather than CURRENT_TIMESTAMP: the latter is the transaction start
+-- time, which can be older than a version another request has already seen.
+CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at = clock_timestamp();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS patients_set_updated_at ON patients;
+CREATE TRIGGER patients_set_updated_at BEFORE UPDATE ON patients
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+DROP TRIGGER IF EXISTS medical_records_set_updated_at ON medical_records;
+CREATE TRIGGER medical_records_set_updated_at BEFORE UPDATE ON medical_records
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+
+DROP TRIGGER IF EXISTS appointments_set_updated_at ON appointments;
+CREATE TRIGGER appointments_set_updated_at BEFORE UPDATE ON appointments
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
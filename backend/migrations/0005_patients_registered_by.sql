@@ -0,0 +1,18 @@
+-- Remember which doctor registered a patient, so doctors can batch-print QR cards for
+-- "all patients registered by me".
+
+ALTER TABLE patients ADD COLUMN IF NOT EXISTS registered_by INTEGER REFERENCES users (id) ON DELETE SET NULL;
+
+-- Best-effort backfill: doctor-registered patients use their UID as username, and the
+-- registering doctor always adds the first consultation record.
+UPDATE patients p
+SET registered_by = (
+    SELECT mr.doctor_id FROM medical_records mr
+    WHERE mr.patient_uid = p.uid
+    ORDER BY mr.record_date, mr.id
+    LIMIT 1
+)
+FROM users u
+WHERE u.id = p.user_id AND u.username = p.uid AND p.registered_by IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_patients_registered_by_name ON patients (registered_by, name);
@@ -0,0 +1,11 @@
+-- Server-side session store for SESSION_TYPE = 'postgres' (backend/sessions.py).
+-- data is the Flask-Session msgpack payload; the expiry index serves both lookups of
+-- live sessions and the batched deletion of expired ones.
+
+CREATE TABLE IF NOT EXISTS sessions (
+    id VARCHAR(255) PRIMARY KEY,
+    data BYTEA NOT NULL,
+    expiry TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_sessions_expiry ON sessions (expiry);
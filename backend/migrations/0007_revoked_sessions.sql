@@ -0,0 +1,9 @@
+-- Logged-out cookie sessions (SESSION_TYPE = 'cookie'). Privileged views reject a cookie
+-- whose session_id is listed here; rows are dropped once the cookie would have expired.
+
+CREATE TABLE IF NOT EXISTS revoked_sessions (
+    session_id VARCHAR(64) PRIMARY KEY,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_revoked_sessions_expires_at ON revoked_sessions (expires_at);
@@ -0,0 +1,12 @@
+-- Failed login counters for LOGIN_RATE_LIMIT_STORE = 'postgres' (backend/ratelimit.py), so
+-- every app node sees the same counts. One row per key ('user:<name>' or 'ip:<address>')
+-- and fixed window; the limiter only ever reads the current and the previous window.
+
+CREATE TABLE IF NOT EXISTS login_failures (
+    key VARCHAR(255) NOT NULL,
+    window_index BIGINT NOT NULL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (key, window_index)
+);
+
+CREATE INDEX IF NOT EXISTS idx_login_failures_window ON login_failures (window_index);
@@ -0,0 +1,11 @@
+-- Trigram indexes for the doctor's patient search (search_patients() in backend/models.py).
+-- GiST rather than GIN because GiST can return the nearest matches in distance order
+-- (ORDER BY ... <<-> ... LIMIT n) without ranking every match first.
+-- Phone numbers are searched on their digits only, so '555 12' finds '(555) 123-4567'.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_patients_name_trgm ON patients USING gist (name gist_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_patients_contact_digits_trgm
+    ON patients USING gist ((regexp_replace(contact_info, '[^0-9]', '', 'g')) gist_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_patients_date_of_birth ON patients (date_of_birth, name);
@@ -0,0 +1,17 @@
+-- Structured medical record fields, replacing the string-packed disease_history
+-- ("Symptoms & Diagnosis: ...\n--- Allergies: ...") that every read used to split apart.
+--   symptoms_diagnosis / allergies: the text as the doctor entered it, for display
+--   allergy_list / medication_list: one entry per allergy / prescription line
+--   diagnoses: condition labels found in the symptoms (see CONDITION_KEYWORDS)
+-- Existing rows are converted by `flask db backfill-records`, in small batches while the
+-- app is running; until then they are read through the legacy parser. disease_history is
+-- still written for now so older app versions keep working during the rollout.
+
+ALTER TABLE medical_records ADD COLUMN IF NOT EXISTS symptoms_diagnosis TEXT;
+ALTER TABLE medical_records ADD COLUMN IF NOT EXISTS allergies TEXT;
+ALTER TABLE medical_records ADD COLUMN IF NOT EXISTS allergy_list TEXT[];
+ALTER TABLE medical_records ADD COLUMN IF NOT EXISTS medication_list TEXT[];
+ALTER TABLE medical_records ADD COLUMN IF NOT EXISTS diagnoses TEXT[];
+
+-- Finds the rows still to convert; empties out as the backfill progresses
+CREATE INDEX IF NOT EXISTS idx_medical_records_unstructured ON medical_records (id) WHERE symptoms_diagnosis IS NULL;
@@ -0,0 +1,70 @@
+-- Per-patient clinical summary (medications, allergies, conditions) for the dashboards, so
+-- they read one row instead of aggregating the patient's whole history on every view.
+-- Kept up to date by a trigger: every medical record written with structured fields
+-- (migration 0010) merges them in, including rows converted later by the backfill.
+-- Entries are only ever added; records are not edited or deleted by the app.
+
+CREATE TABLE IF NOT EXISTS patient_summary (
+    patient_uid VARCHAR(255) PRIMARY KEY REFERENCES patients (uid) ON DELETE CASCADE,
+    medications TEXT[] NOT NULL DEFAULT '{}',
+    allergies TEXT[] NOT NULL DEFAULT '{}',
+    conditions TEXT[] NOT NULL DEFAULT '{}',
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Union of two arrays, de-duplicated and sorted
+CREATE OR REPLACE FUNCTION text_array_union(a TEXT[], b TEXT[]) RETURNS TEXT[] AS $$
+    SELECT COALESCE(array_agg(DISTINCT item ORDER BY item), '{}')
+    FROM unnest(COALESCE(a, '{}') || COALESCE(b, '{}')) AS item
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION merge_patient_summary() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO patient_summary (patient_uid, medications, allergies, conditions)
+    VALUES (NEW.patient_uid,
+            text_array_union(NEW.medication_list, NULL),
+            text_array_union(NEW.allergy_list, NULL),
+            text_array_union(NEW.diagnoses, NULL))
+    ON CONFLICT (patient_uid) DO UPDATE SET
+        medications = text_array_union(patient_summary.medications, EXCLUDED.medications),
+        allergies = text_array_union(patient_summary.allergies, EXCLUDED.allergies),
+        conditions = text_array_union(patient_summary.conditions, EXCLUDED.conditions),
+        updated_at = clock_timestamp();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Rows written by a release older than 0010 have no structured fields yet; they are
+-- merged when the backfill fills them in (the UPDATE OF case).
+DROP TRIGGER IF EXISTS medical_records_merge_summary ON medical_records;
+CREATE TRIGGER medical_records_merge_summary
+    AFTER INSERT OR UPDATE OF allergy_list, medication_list, diagnoses ON medical_records
+    FOR EACH ROW WHEN (NEW.symptoms_diagnosis IS NOT NULL)
+    EXECUTE FUNCTION merge_patient_summary();
+
+-- Existing history, including rows the backfill hasn't converted yet (parsed as in
+-- backend/models.py split_disease_history(); condition keywords as of this migration).
+INSERT INTO patient_summary (patient_uid, medications, allergies, conditions)
+SELECT p.uid,
+       (SELECT COALESCE(array_agg(DISTINCT m.item ORDER BY m.item), '{}')
+          FROM medical_records mr
+          CROSS JOIN LATERAL unnest(COALESCE(mr.medication_list, ARRAY(
+              SELECT btrim(line, E' \t\r') FROM regexp_split_to_table(mr.prescriptions, E'\n') AS line
+               WHERE btrim(line, E' \t\r') <> ''))) AS m(item)
+         WHERE mr.patient_uid = p.uid),
+       (SELECT COALESCE(array_agg(DISTINCT x.item ORDER BY x.item), '{}')
+          FROM medical_records mr
+          CROSS JOIN LATERAL btrim(split_part(mr.disease_history, E'\n--- Allergies:', 2)) AS h(allergies)
+          CROSS JOIN LATERAL unnest(COALESCE(mr.allergy_list, ARRAY(
+              SELECT btrim(item) FROM regexp_split_to_table(h.allergies, ',') AS item
+               WHERE h.allergies <> '' AND lower(h.allergies) <> 'none' AND btrim(item) <> ''))) AS x(item)
+         WHERE mr.patient_uid = p.uid),
+       (SELECT COALESCE(array_agg(DISTINCT c.label ORDER BY c.label), '{}')
+          FROM medical_records mr
+          CROSS JOIN LATERAL unnest(COALESCE(mr.diagnoses, ARRAY(
+              SELECT k.label FROM (VALUES ('diabetes', 'Diabetes'), ('hypertension', 'Hypertension')) AS k(keyword, label)
+               WHERE position(k.keyword IN lower(split_part(mr.disease_history, E'\n--- Allergies:', 1))) > 0))) AS c(label)
+         WHERE mr.patient_uid = p.uid)
+FROM patients p
+WHERE EXISTS (SELECT 1 FROM medical_records mr WHERE mr.patient_uid = p.uid)
+ON CONFLICT (patient_uid) DO NOTHING;
@@ -0,0 +1,8 @@
+-- The doctor dashboard's patient roster: every patient a doctor has written a record for
+-- or has an appointment with (backend/roster.py). Both lookups become index-only scans.
+
+CREATE INDEX IF NOT EXISTS idx_medical_records_doctor_patient
+    ON medical_records (doctor_id, patient_uid);
+
+CREATE INDEX IF NOT EXISTS idx_appointments_doctor_patient
+    ON appointments (doctor_id, patient_uid);
@@ -0,0 +1,42 @@
+-- A doctor can't have two scheduled appointments at overlapping times. Each appointment
+-- covers [appointment_date, appointment_date + duration_minutes), and an exclusion
+-- constraint (GiST on doctor_id and that range) rejects overlapping bookings in the
+-- database, whichever app node or client writes them. Cancelled and completed
+-- appointments free their slot.
+
+CREATE EXTENSION IF NOT EXISTS btree_gist; -- GiST operator class for "doctor_id WITH ="
+
+ALTER TABLE appointments ADD COLUMN IF NOT EXISTS duration_minutes INTEGER NOT NULL DEFAULT 30;
+-- Set below on existing bookings that already overlap an earlier one; the constraint skips them
+ALTER TABLE appointments ADD COLUMN IF NOT EXISTS double_booked BOOLEAN NOT NULL DEFAULT false;
+
+DO $$
+BEGIN
+    -- The upper bound lets availability queries look back a fixed window (backend/scheduling.py)
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'appointments_duration_check') THEN
+        ALTER TABLE appointments ADD CONSTRAINT appointments_duration_check
+            CHECK (duration_minutes BETWEEN 5 AND 480);
+    END IF;
+END;
+$$;
+
+UPDATE appointments b
+SET double_booked = true
+WHERE b.status = 'scheduled'
+  AND EXISTS (
+      SELECT 1 FROM appointments a
+      WHERE a.doctor_id = b.doctor_id AND a.status = 'scheduled' AND a.id < b.id
+        AND a.appointment_date < b.appointment_date + make_interval(mins => b.duration_minutes)
+        AND a.appointment_date + make_interval(mins => a.duration_minutes) > b.appointment_date
+  );
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'appointments_no_overlap') THEN
+        ALTER TABLE appointments ADD CONSTRAINT appointments_no_overlap EXCLUDE USING gist (
+            doctor_id WITH =,
+            tsrange(appointment_date, appointment_date + make_interval(mins => duration_minutes)) WITH &&
+        ) WHERE (status = 'scheduled' AND NOT double_booked);
+    END IF;
+END;
+$$;
@@ -0,0 +1,113 @@
+-- Doctor availability as bitmaps, so a month calendar for any number of doctors is one
+-- query over one row per doctor and day (backend/scheduling.py).
+-- A day is 96 slots of 15 minutes; bit i (leftmost is 0) covers minutes [15*i, 15*i + 15).
+--   doctor_working_hours: each doctor's hours per ISO weekday (1 = Monday). Doctors without
+--     any rows work APPOINTMENT_DAY_START-APPOINTMENT_DAY_END every day; weekdays missing for a
+--     doctor who has rows are days off.
+--   doctor_busy_slots: slots covered by the doctor's scheduled appointments, one row per day
+--     that has any. A trigger on appointments keeps it current: a new booking ORs its slots
+--     in, and a cancellation (or any other change) recomputes the affected days.
+
+-- Bitmap with slots [first_slot, last_slot) set
+CREATE OR REPLACE FUNCTION slot_mask(first_slot INTEGER, last_slot INTEGER) RETURNS BIT(96) AS $$
+    SELECT CASE
+        WHEN LEAST(last_slot, 96) <= GREATEST(first_slot, 0) THEN B'0'::BIT(96)
+        ELSE (repeat('1', LEAST(last_slot, 96) - GREATEST(first_slot, 0)) ||
+              repeat('0', 96 - LEAST(last_slot, 96) + GREATEST(first_slot, 0)))::BIT(96) >> GREATEST(first_slot, 0)
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Whole slots inside working hours
+CREATE OR REPLACE FUNCTION working_slot_mask(start_time TIME, end_time TIME) RETURNS BIT(96) AS $$
+    SELECT slot_mask(ceil(extract(epoch FROM start_time) / 900)::int, floor(extract(epoch FROM end_time) / 900)::int)
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Slots of `day` touched by an appointment
+CREATE OR REPLACE FUNCTION appointment_slot_mask(start_at TIMESTAMP, duration_minutes INTEGER, day DATE) RETURNS BIT(96) AS $$
+    SELECT slot_mask(floor(extract(epoch FROM start_at - day) / 900)::int,
+                     ceil(extract(epoch FROM start_at + make_interval(mins => duration_minutes) - day) / 900)::int)
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Days an appointment touches (one, unless it runs past midnight)
+CREATE OR REPLACE FUNCTION appointment_days(start_at TIMESTAMP, duration_minutes INTEGER) RETURNS SETOF DATE AS $$
+    SELECT generate_series(start_at::date,
+                           (start_at + make_interval(mins => duration_minutes) - interval '1 microsecond')::date,
+                           interval '1 day')::date
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE TABLE IF NOT EXISTS doctor_working_hours (
+    doctor_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    isodow SMALLINT NOT NULL CHECK (isodow BETWEEN 1 AND 7),
+    start_time TIME NOT NULL,
+    end_time TIME NOT NULL CHECK (end_time > start_time),
+    slots BIT(96) GENERATED ALWAYS AS (working_slot_mask(start_time, end_time)) STORED,
+    PRIMARY KEY (doctor_id, isodow)
+);
+
+CREATE TABLE IF NOT EXISTS doctor_busy_slots (
+    doctor_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    busy BIT(96) NOT NULL,
+    PRIMARY KEY (doctor_id, day)
+);
+
+-- Recomputes one doctor's day from the appointments table
+CREATE OR REPLACE FUNCTION refresh_doctor_busy_day(p_doctor_id INTEGER, p_day DATE) RETURNS void AS $$
+DECLARE
+    busy_mask BIT(96);
+BEGIN
+    SELECT bit_or(appointment_slot_mask(a.appointment_date, a.duration_minutes, p_day)) INTO busy_mask
+    FROM appointments a
+    WHERE a.doctor_id = p_doctor_id AND a.status = 'scheduled'
+      AND a.appointment_date < p_day + 1
+      AND a.appointment_date > p_day - interval '480 minutes'; -- appointments_duration_check
+    IF busy_mask IS NULL OR busy_mask = B'0'::BIT(96) THEN
+        DELETE FROM doctor_busy_slots WHERE doctor_id = p_doctor_id AND day = p_day;
+    ELSE
+        INSERT INTO doctor_busy_slots (doctor_id, day, busy) VALUES (p_doctor_id, p_day, busy_mask)
+        ON CONFLICT (doctor_id, day) DO UPDATE SET busy = EXCLUDED.busy;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION maintain_doctor_busy_slots() RETURNS trigger AS $$
+DECLARE
+    d DATE;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        -- Other appointments may share these slots (double bookings from before 0013), so
+        -- clearing this one's bits isn't enough: recompute the days it used to cover
+        FOR d IN SELECT appointment_days(OLD.appointment_date, OLD.duration_minutes) LOOP
+            PERFORM refresh_doctor_busy_day(OLD.doctor_id, d);
+        END LOOP;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'scheduled' THEN
+        FOR d IN SELECT appointment_days(NEW.appointment_date, NEW.duration_minutes) LOOP
+            INSERT INTO doctor_busy_slots (doctor_id, day, busy)
+            VALUES (NEW.doctor_id, d, appointment_slot_mask(NEW.appointment_date, NEW.duration_minutes, d))
+            ON CONFLICT (doctor_id, day) DO UPDATE SET busy = doctor_busy_slots.busy | EXCLUDED.busy;
+        END LOOP;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS appointments_maintain_busy_slots ON appointments;
+CREATE TRIGGER appointments_maintain_busy_slots
+    AFTER INSERT OR DELETE OR UPDATE OF status, appointment_date, duration_minutes, doctor_id ON appointments
+    FOR EACH ROW EXECUTE FUNCTION maintain_doctor_busy_slots();
+
+-- Rebuilds every doctor's busy bitmaps from `from_day` on (also used by `flask bench scheduling`)
+CREATE OR REPLACE FUNCTION rebuild_doctor_busy_slots(from_day DATE) RETURNS void AS $$
+    DELETE FROM doctor_busy_slots WHERE day >= from_day;
+    INSERT INTO doctor_busy_slots (doctor_id, day, busy)
+    SELECT a.doctor_id, d.day, bit_or(appointment_slot_mask(a.appointment_date, a.duration_minutes, d.day))
+    FROM appointments a
+    CROSS JOIN LATERAL appointment_days(a.appointment_date, a.duration_minutes) AS d(day)
+    WHERE a.status = 'scheduled' AND d.day >= from_day
+      AND a.appointment_date > from_day - interval '480 minutes'
+    GROUP BY a.doctor_id, d.day;
+$$ LANGUAGE sql;
+
+-- Past days are never offered for booking; the trigger covers them from here on anyway
+SELECT rebuild_doctor_busy_slots(CURRENT_DATE - 1);
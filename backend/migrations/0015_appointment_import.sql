@@ -0,0 +1,19 @@
+-- Lenient casts for bulk appointment imports (backend/appointment_io.py). Imported files are
+-- COPYed into a staging table as text and validated in a few set-based statements; a value
+-- that doesn't parse must mark its row as rejected instead of aborting the whole statement.
+
+CREATE OR REPLACE FUNCTION try_cast_integer(value TEXT) RETURNS INTEGER AS $$
+BEGIN
+    RETURN trim(value)::INTEGER;
+EXCEPTION WHEN invalid_text_representation OR numeric_value_out_of_range THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION try_cast_timestamp(value TEXT) RETURNS TIMESTAMP AS $$
+BEGIN
+    RETURN trim(value)::TIMESTAMP;
+EXCEPTION WHEN invalid_datetime_format OR datetime_field_overflow OR invalid_parameter_value THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql STABLE; -- Parsing depends on DateStyle
@@ -0,0 +1,51 @@
+-- Serialize changes to one doctor's busy bitmap for a day (migration 0014). A cancellation
+-- recomputes the day from the appointments it can see, and would overwrite the bits a
+-- concurrent, not yet committed booking had just ORed in. Both paths now take a transaction-
+-- level advisory lock on (doctor, day) first, so the recompute waits for the booking to
+-- commit and then sees it (each statement takes a new snapshot under READ COMMITTED).
+
+CREATE OR REPLACE FUNCTION lock_doctor_busy_day(p_doctor_id INTEGER, p_day DATE) RETURNS void AS $$
+    SELECT pg_advisory_xact_lock(p_doctor_id, p_day - DATE '2000-01-01')
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION refresh_doctor_busy_day(p_doctor_id INTEGER, p_day DATE) RETURNS void AS $$
+DECLARE
+    busy_mask BIT(96);
+BEGIN
+    PERFORM lock_doctor_busy_day(p_doctor_id, p_day);
+    SELECT bit_or(appointment_slot_mask(a.appointment_date, a.duration_minutes, p_day)) INTO busy_mask
+    FROM appointments a
+    WHERE a.doctor_id = p_doctor_id AND a.status = 'scheduled'
+      AND a.appointment_date < p_day + 1
+      AND a.appointment_date > p_day - interval '480 minutes'; -- appointments_duration_check
+    IF busy_mask IS NULL OR busy_mask = B'0'::BIT(96) THEN
+        DELETE FROM doctor_busy_slots WHERE doctor_id = p_doctor_id AND day = p_day;
+    ELSE
+        INSERT INTO doctor_busy_slots (doctor_id, day, busy) VALUES (p_doctor_id, p_day, busy_mask)
+        ON CONFLICT (doctor_id, day) DO UPDATE SET busy = EXCLUDED.busy;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION maintain_doctor_busy_slots() RETURNS trigger AS $$
+DECLARE
+    d DATE;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        -- Other appointments may share these slots (double bookings from before 0013), so
+        -- clearing this one's bits isn't enough: recompute the days it used to cover
+        FOR d IN SELECT appointment_days(OLD.appointment_date, OLD.duration_minutes) LOOP
+            PERFORM refresh_doctor_busy_day(OLD.doctor_id, d);
+        END LOOP;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'scheduled' THEN
+        FOR d IN SELECT appointment_days(NEW.appointment_date, NEW.duration_minutes) LOOP
+            PERFORM lock_doctor_busy_day(NEW.doctor_id, d);
+            INSERT INTO doctor_busy_slots (doctor_id, day, busy)
+            VALUES (NEW.doctor_id, d, appointment_slot_mask(NEW.appointment_date, NEW.duration_minutes, d))
+            ON CONFLICT (doctor_id, day) DO UPDATE SET busy = doctor_busy_slots.busy | EXCLUDED.busy;
+        END LOOP;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
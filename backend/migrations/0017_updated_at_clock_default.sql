@@ -0,0 +1,7 @@
+-- New rows take updated_at from clock_timestamp() too, like updates (migration 0004).
+-- CURRENT_TIMESTAMP is the transaction start time, so a row inserted late in a long
+-- transaction could carry an older version than rows committed before it.
+
+ALTER TABLE patients ALTER COLUMN updated_at SET DEFAULT clock_timestamp();
+ALTER TABLE medical_records ALTER COLUMN updated_at SET DEFAULT clock_timestamp();
+ALTER TABLE appointments ALTER COLUMN updated_at SET DEFAULT clock_timestamp();
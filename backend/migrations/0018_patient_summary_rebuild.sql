@@ -0,0 +1,43 @@
+-- Rebuild patient_summary (migration 0011). Its initial populate parsed rows the backfill
+-- hadn't converted yet with btrim() on spaces only, while backend/models.py strips all
+-- whitespace, so items from textarea input kept a leading "\r\n". Once the backfill filled
+-- in the Python values the trigger merged them as new entries, and entries are never
+-- removed, leaving both spellings in the summary. Each summary is now recomputed from the
+-- patient's records: structured fields where present, otherwise the legacy text parsed the
+-- way split_disease_history() and structure_medical_record() do.
+
+-- No record is written while the summaries are recomputed, so none of the trigger's merges
+-- can be overwritten
+LOCK TABLE medical_records IN SHARE MODE;
+
+INSERT INTO patient_summary (patient_uid, medications, allergies, conditions)
+SELECT p.uid,
+       (SELECT COALESCE(array_agg(DISTINCT m.item ORDER BY m.item), '{}')
+          FROM medical_records mr
+          CROSS JOIN LATERAL unnest(COALESCE(mr.medication_list, ARRAY(
+              SELECT btrim(line, E' \t\n\r\v\f') FROM regexp_split_to_table(mr.prescriptions, E'\n') AS line
+               WHERE btrim(line, E' \t\n\r\v\f') <> ''))) AS m(item)
+         WHERE mr.patient_uid = p.uid),
+       (SELECT COALESCE(array_agg(DISTINCT x.item ORDER BY x.item), '{}')
+          FROM medical_records mr
+          -- Everything after the first separator, as str.split(sep, 1)
+          CROSS JOIN LATERAL btrim(CASE WHEN position(E'\n--- Allergies:' IN mr.disease_history) > 0
+                                        THEN substr(mr.disease_history, position(E'\n--- Allergies:' IN mr.disease_history) + 15)
+                                        ELSE '' END, E' \t\n\r\v\f') AS h(allergies)
+          CROSS JOIN LATERAL unnest(COALESCE(mr.allergy_list, ARRAY(
+              SELECT btrim(item, E' \t\n\r\v\f') FROM regexp_split_to_table(h.allergies, ',') AS item
+               WHERE h.allergies <> '' AND lower(h.allergies) <> 'none' AND btrim(item, E' \t\n\r\v\f') <> ''))) AS x(item)
+         WHERE mr.patient_uid = p.uid),
+       (SELECT COALESCE(array_agg(DISTINCT c.label ORDER BY c.label), '{}')
+          FROM medical_records mr
+          CROSS JOIN LATERAL unnest(COALESCE(mr.diagnoses, ARRAY(
+              SELECT k.label FROM (VALUES ('diabetes', 'Diabetes'), ('hypertension', 'Hypertension')) AS k(keyword, label)
+               WHERE position(k.keyword IN lower(split_part(mr.disease_history, E'\n--- Allergies:', 1))) > 0))) AS c(label)
+         WHERE mr.patient_uid = p.uid)
+FROM patients p
+WHERE EXISTS (SELECT 1 FROM medical_records mr WHERE mr.patient_uid = p.uid)
+ON CONFLICT (patient_uid) DO UPDATE SET
+    medications = EXCLUDED.medications,
+    allergies = EXCLUDED.allergies,
+    conditions = EXCLUDED.conditions,
+    updated_at = clock_timestamp();
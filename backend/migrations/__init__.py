@@ -0,0 +1,135 @@
+import os
+import re
+from collections import namedtuple
+import psycopg2
+from backend.models import transaction
+
+# Versioned schema migrations.
+# Each migration is a NNNN_description.sql file in this directory. Files are applied
+# in version order, each in its own transaction, and recorded in schema_migrations.
+# Never edit a migration that has been released; add a new one instead.
+
+MIGRATIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+MIGRATION_FILE_RE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+
+# Arbitrary constant used with pg_advisory_lock so that app instances starting at the
+# same time don't try to apply the same migration concurrently.
+MIGRATION_LOCK_ID = 7314201
+
+Migration = namedtuple('Migration', ['version', 'name', 'path'])
+
+# (table, leading columns) pairs the views' queries rely on. Any index whose columns
+# start with these satisfies the check, whatever it is called.
+EXPECTED_INDEXES = [
+    ('users', ('username',)),
+    ('patients', ('uid',)),
+    ('patients', ('user_id',)),
+    ('patients', ('registered_by',)),
+    ('patients', ('date_of_birth',)),
+    ('doctors', ('license_number',)),
+    ('medical_records', ('patient_uid', 'record_date')),
+    ('medical_records', ('doctor_id', 'patient_uid')),
+    ('appointments', ('patient_uid', 'appointment_date')),
+    ('appointments', ('patient_uid', 'status', 'appointment_date')),
+    ('appointments', ('doctor_id', 'appointment_date')),
+    ('appointments', ('doctor_id', 'patient_uid')),
+]
+
+def load_migrations():
+    """Returns all migrations shipped with the app, ordered by version."""
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE_RE.match(filename)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    migrations.sort()
+    versions = [m.version for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError("Two migrations share the same version number.")
+    return migrations
+
+def _ensure_migrations_table(cur):
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS schema_migrations (
+               version INTEGER PRIMARY KEY,
+               name VARCHAR(255) NOT NULL,
+               applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+           )"""
+    )
+
+def applied_versions(cur):
+    _ensure_migrations_table(cur)
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+def pending_migrations():
+    """Returns the migrations that have not been applied to the database yet."""
+    with transaction() as cur:
+        applied = applied_versions(cur)
+    return [m for m in load_migrations() if m.version not in applied]
+
+def upgrade(log=print):
+    """
+    Applies every pending migration, each in its own transaction.
+    Must be called inside an app context. Returns the list of applied migrations.
+    """
+    applied_now = []
+    with transaction() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+    try:
+        # Re-read under the lock: another instance may have just finished upgrading.
+        for migration in pending_migrations():
+            with open(migration.path) as f:
+                sql = f.read()
+            with transaction() as cur:
+                cur.execute(sql)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (migration.version, migration.name)
+                )
+            log(f"Applied migration {migration.version:04d}_{migration.name}")
+            applied_now.append(migration)
+    finally:
+        with transaction() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    return applied_now
+
+def missing_indexes():
+    """Returns the (table, columns) entries of EXPECTED_INDEXES that no index in the database covers."""
+    tables = sorted({table for table, _ in EXPECTED_INDEXES})
+    with transaction() as cur:
+        cur.execute(
+            """SELECT t.relname, array_agg(a.attname::text ORDER BY k.ord)
+               FROM pg_index i
+               JOIN pg_class t ON t.oid = i.indrelid
+               JOIN pg_namespace n ON n.oid = t.relnamespace
+               CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+               JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+               WHERE n.nspname = current_schema() AND t.relname = ANY(%s)
+               GROUP BY i.indexrelid, t.relname""",
+            (tables,)
+        )
+        existing = cur.fetchall()
+
+    missing = []
+    for table, columns in EXPECTED_INDEXES:
+        covered = any(
+            index_table == table and tuple(index_columns[:len(columns)]) == columns
+            for index_table, index_columns in existing
+        )
+        if not covered:
+            missing.append((table, columns))
+    return missing
+
+def warn_missing_indexes(app):
+    """Logs a warning for every expected index that is missing. Never raises on database errors."""
+    try:
+        with app.app_context():
+            missing = missing_indexes()
+    except psycopg2.Error as e:
+        app.logger.warning(f"Could not check database indexes: {e}")
+        return
+    for table, columns in missing:
+        app.logger.warning(
+            f"Missing index on {table}({', '.join(columns)}); run 'flask db upgrade' to create it."
+        )
@@ -1,26 +1,571 @@
+import base64
+import binascii
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime
 import psycopg2
-from flask import current_app
+import psycopg2.extras
+from psycopg2.extensions import STATUS_READY
+from psycopg2.pool import PoolError
+from flask import current_app, g
 from werkzeug.security import generate_password_hash, check_password_hash
 
-# --- Database Connection ---
+# --- Database Connection Pool ---
+class ConnectionPool:
+    """
+    Thread-safe pool of PostgreSQL connections shared by all requests of one app.
+
+    Connections are health-checked on checkout once they have been idle for
+    longer than `health_check_interval`, and closed instead of reused once they
+    have been idle for longer than `idle_timeout` (while keeping `minconn` warm).
+    """
+
+    def __init__(self, dsn, minconn=1, maxconn=10, idle_timeout=300,
+                 health_check_interval=30, checkout_timeout=5):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: need 0 <= minconn <= maxconn and maxconn >= 1")
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+
+        self._lock = threading.Condition()
+        self._idle = deque() # (connection, returned_at) pairs, most recently returned last
+        self._open = 0 # Connections currently owned by the pool (idle + checked out)
+        self._pid = os.getpid()
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn)
+
+    def _discard(self, conn):
+        """Closes a connection the pool no longer wants. Caller must hold the lock."""
+        self._open -= 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _reset_after_fork(self):
+        """Forget connections inherited from a parent process (e.g. gunicorn --preload)."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle.clear()
+            self._open = 0
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def fill(self):
+        """Opens connections until `minconn` are available. Connection errors are left to the caller."""
+        with self._lock:
+            self._reset_after_fork()
+            while self._open < self.minconn:
+                self._idle.append((self._connect(), time.monotonic()))
+                self._open += 1
+
+    def getconn(self):
+        """Checks out a healthy connection, waiting up to `checkout_timeout` seconds if the pool is exhausted."""
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            conn = None
+            with self._lock:
+                self._reset_after_fork()
+                while True:
+                    if self._idle:
+                        conn, returned_at = self._idle.pop()
+                        break
+                    if self._open < self.maxconn:
+                        self._open += 1 # Reserve the slot before connecting outside the lock
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolError("Connection pool exhausted")
+                    self._lock.wait(remaining)
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except psycopg2.Error:
+                    with self._lock:
+                        self._open -= 1
+                        self._lock.notify()
+                    raise
+
+            # Network round trips (health checks) happen outside the lock.
+            idle_for = time.monotonic() - returned_at
+            expired = idle_for > self.idle_timeout and self._open > self.minconn
+            if conn.closed or expired or (idle_for > self.health_check_interval and not self._is_healthy(conn)):
+                with self._lock:
+                    self._discard(conn)
+                    self._lock.notify()
+                continue
+            return conn
+
+    def putconn(self, conn):
+        """Returns a connection to the pool, rolling back any transaction left open."""
+        if self._pid != os.getpid():
+            return # Connection belongs to a parent process; never touch it here
+        if not conn.closed and conn.status != STATUS_READY:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+        with self._lock:
+            if conn.closed:
+                self._open -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    def closeall(self):
+        with self._lock:
+            while self._idle:
+                self._discard(self._idle.pop()[0])
+
+
+def init_db_pool(app):
+    """Creates the app-wide connection pool and returns connections to it at the end of each request."""
+    db_pool = ConnectionPool(
+        app.config['DATABASE_URL'],
+        minconn=app.config['DB_POOL_MIN_SIZE'],
+        maxconn=app.config['DB_POOL_MAX_SIZE'],
+        idle_timeout=app.config['DB_POOL_IDLE_TIMEOUT'],
+        health_check_interval=app.config['DB_POOL_HEALTH_CHECK_INTERVAL'],
+        checkout_timeout=app.config['DB_POOL_CHECKOUT_TIMEOUT'],
+    )
+    try:
+        db_pool.fill()
+    except psycopg2.Error as e:
+        # The pool opens connections on demand, so a database that is down at startup is not fatal.
+        print(f"Could not pre-fill database connection pool: {e}")
+    app.extensions['db_pool'] = db_pool
+    app.teardown_appcontext(release_db_connection)
+    return db_pool
+
 def get_db_connection():
-    """Establishes a connection to the PostgreSQL database."""
+    """
+    Returns the pooled PostgreSQL connection for the current request.
+    The first call checks a connection out of the pool; later calls in the same
+    request reuse it. It is returned to the pool automatically on teardown.
+    """
+    if 'db_conn' not in g:
+        try:
+            g.db_conn = current_app.extensions['db_pool'].getconn()
+        except psycopg2.Error as e:
+            print(f"Database connection error: {e}")
+            # In a real application, you'd want more robust error handling
+            # and logging.
+            return None
+    return g.db_conn
+
+def release_db_connection(exc=None):
+    """
+    Ends the request's unit of work: commits if the request finished cleanly,
+    rolls back otherwise, and returns the connection to the pool.
+    """
+    cur = g.pop('db_cursor', None)
+    conn = g.pop('db_conn', None)
+    if conn is None:
+        return
     try:
-        # Use current_app.config to get the DATABASE_URL
-        conn = psycopg2.connect(current_app.config['DATABASE_URL'])
-        return conn
+        if cur is not None:
+            cur.close()
+        if not conn.closed:
+            if exc is None:
+                conn.commit()
+                _run_on_commit()
+            else:
+                conn.rollback()
     except psycopg2.Error as e:
-        print(f"Database connection error: {e}")
-        # In a real application, you'd want more robust error handling
-        # and logging.
+        print(f"Error finishing request transaction: {e}")
+    finally:
+        g.pop('db_on_commit', None)
+        current_app.extensions['db_pool'].putconn(conn)
+
+# --- Request-scoped Unit of Work ---
+def get_cursor():
+    """
+    Returns the cursor shared by every query in the current request.
+    The connection is checked out lazily on first use; raises psycopg2.OperationalError
+    if no connection is available so callers can handle it like any other database error.
+    """
+    cur = g.get('db_cursor')
+    if cur is None or cur.closed:
+        conn = get_db_connection()
+        if conn is None:
+            raise psycopg2.OperationalError('Database connection error. Please try again later.')
+        cur = g.db_cursor = conn.cursor()
+    return cur
+
+@contextmanager
+def transaction():
+    """
+    Runs a block inside the request's transaction and yields the shared cursor.
+    Commits when the block exits normally and rolls back if it raises, so views
+    don't need their own connect/cursor/commit/rollback/close boilerplate.
+    """
+    cur = get_cursor()
+    try:
+        yield cur
+    except Exception:
+        g.pop('db_on_commit', None)
+        if not cur.connection.closed:
+            cur.connection.rollback()
+        raise
+    else:
+        cur.connection.commit()
+        _run_on_commit()
+
+def on_commit(callback):
+    """
+    Registers `callback` to run right after the current transaction commits.
+    Callbacks are dropped if it rolls back, so side effects (e.g. background jobs)
+    never act on data that was not saved.
+    """
+    g.setdefault('db_on_commit', []).append(callback)
+
+def _run_on_commit():
+    for callback in g.pop('db_on_commit', []):
+        try:
+            callback()
+        except Exception as e:
+            # The data is already committed; a failing side effect must not turn the request into an error.
+            print(f"Error in on_commit callback: {e}")
+
+# --- Patient Record Bundle ---
+# Rows keep the column order the templates index by (record[0], apt[3], ...)
+MedicalRecord = namedtuple('MedicalRecord', [
+    'record_date', 'symptoms_diagnosis', 'prescriptions', 'doctor_username', 'id',
+    'allergies', 'allergy_list', 'medication_list', 'diagnoses' # Structured fields, see migration 0010
+])
+Appointment = namedtuple('Appointment', ['appointment_date', 'reason', 'status', 'doctor_username', 'doctor_id', 'id'])
+PatientBundle = namedtuple('PatientBundle', [
+    'patient', 'medical_records', 'appointments', 'upcoming_appointment',
+    'summary' # Medications/allergies/conditions across the whole history, when requested
+])
+
+# Keyword -> label pairs used to flag pre-existing conditions in "Symptoms & Diagnosis" text.
+CONDITION_KEYWORDS = [('diabetes', 'Diabetes'), ('hypertension', 'Hypertension')]
+
+# Columns read for a MedicalRecord. disease_history comes last and is only used for rows the
+# backfill (backfill_structured_records) hasn't reached yet, see _record_from_row().
+MEDICAL_RECORD_COLUMNS = """mr.record_date, mr.symptoms_diagnosis, mr.prescriptions, u.username AS doctor_username, mr.id,
+                          mr.allergies, mr.allergy_list, mr.medication_list, mr.diagnoses, mr.disease_history"""
+
+PATIENT_BUNDLE_SQL = """
+    SELECT p.uid, p.name, p.date_of_birth, p.gender, p.contact_info,
+           p.emergency_contact_name, p.emergency_contact_relationship, p.emergency_contact_phone,
+           (SELECT json_build_array(a.appointment_date, a.reason, a.status, u.username, u.id, a.id)
+              FROM appointments a
+              JOIN users u ON a.doctor_id = u.id
+             WHERE a.patient_uid = p.uid AND a.status = 'scheduled'
+             ORDER BY a.appointment_date ASC LIMIT 1) AS upcoming_appointment
+"""
+
+# The patient's whole history, newest first; left out when only the dashboard cards are needed
+PATIENT_HISTORY_SQL = """
+           , (SELECT COALESCE(json_agg(json_build_array(r.record_date, r.symptoms_diagnosis, r.prescriptions, r.doctor_username, r.id,
+                                                        r.allergies, r.allergy_list, r.medication_list, r.diagnoses, r.disease_history)
+                                       ORDER BY r.record_date DESC, r.id DESC), '[]'::json)
+                FROM (SELECT {MEDICAL_RECORD_COLUMNS}
+                        FROM medical_records mr
+                        JOIN users u ON mr.doctor_id = u.id
+                       WHERE mr.patient_uid = p.uid) r) AS medical_records
+           , (SELECT COALESCE(json_agg(json_build_array(a.appointment_date, a.reason, a.status, u.username, u.id, a.id)
+                                       ORDER BY a.appointment_date DESC, a.id DESC), '[]'::json)
+                FROM appointments a
+                JOIN users u ON a.doctor_id = u.id
+               WHERE a.patient_uid = p.uid) AS appointments
+""".replace('{MEDICAL_RECORD_COLUMNS}', MEDICAL_RECORD_COLUMNS)
+
+# Dashboard cards summarise the whole history. They read the patient_summary row that a
+# trigger maintains as records are written (migration 0011), not the records themselves.
+CLINICAL_SUMMARY_SQL = """
+           , (SELECT json_build_array(s.medications, s.allergies, s.conditions)
+                FROM patient_summary s WHERE s.patient_uid = p.uid) AS summary
+"""
+
+# --- Structured Medical Records ---
+# Symptoms and allergies used to be packed into disease_history as
+# "Symptoms & Diagnosis: ...\n--- Allergies: ...". Migration 0010 adds a column for each part
+# plus the allergies, medications and diagnoses as arrays, filled in when a record is written
+# (structure_medical_record) and for older rows by `flask db backfill-records`.
+# disease_history is still written so that nodes running the previous release can read new rows.
+
+def split_disease_history(history_text):
+    """Splits a legacy disease_history string into (symptoms_diagnosis, allergies)."""
+    symptoms_diagnosis = ""
+    allergies = ""
+    if history_text:
+        parts = history_text.split('\n--- Allergies:', 1) # Split only on the first occurrence
+        symptoms_diagnosis = parts[0].replace("Symptoms & Diagnosis: ", "").strip()
+        if len(parts) > 1:
+            allergies = parts[1].strip()
+    return symptoms_diagnosis, allergies
+
+def structure_medical_record(symptoms_diagnosis, allergies, prescriptions):
+    """Returns the (allergy_list, medication_list, diagnoses) arrays stored alongside a record."""
+    allergies = (allergies or '').strip()
+    allergy_list = []
+    if allergies.lower() != 'none':
+        allergy_list = [item.strip() for item in allergies.split(',') if item.strip()]
+    medication_list = [line.strip() for line in (prescriptions or '').split('\n') if line.strip()]
+    symptoms = (symptoms_diagnosis or '').lower()
+    diagnoses = [label for keyword, label in CONDITION_KEYWORDS if keyword in symptoms]
+    return allergy_list, medication_list, diagnoses
+
+def _record_from_row(row):
+    """Builds a MedicalRecord from MEDICAL_RECORD_COLUMNS, parsing disease_history only if not yet backfilled."""
+    record = MedicalRecord(*row[:-1])
+    if record.symptoms_diagnosis is None:
+        symptoms_diagnosis, allergies = split_disease_history(row[-1])
+        allergy_list, medication_list, diagnoses = structure_medical_record(
+            symptoms_diagnosis, allergies, record.prescriptions)
+        record = record._replace(symptoms_diagnosis=symptoms_diagnosis, allergies=allergies,
+                                 allergy_list=allergy_list, medication_list=medication_list,
+                                 diagnoses=diagnoses)
+    return record
+
+def backfill_structured_records(cur, batch_size=1000):
+    """
+    Fills the structured columns of up to `batch_size` records written before migration 0010.
+    Returns the number of records updated; 0 means nothing is left to convert. Rows locked by
+    another transaction are skipped, so it can run while the application is serving traffic.
+    """
+    cur.execute(
+        """SELECT id, disease_history, prescriptions FROM medical_records
+           WHERE symptoms_diagnosis IS NULL
+           ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED""",
+        (batch_size,)
+    )
+    values = []
+    for record_id, disease_history, prescriptions in cur.fetchall():
+        symptoms_diagnosis, allergies = split_disease_history(disease_history)
+        values.append((record_id, symptoms_diagnosis, allergies)
+                      + structure_medical_record(symptoms_diagnosis, allergies, prescriptions))
+    if values:
+        psycopg2.extras.execute_values(
+            cur,
+            """UPDATE medical_records mr
+               SET symptoms_diagnosis = v.symptoms_diagnosis, allergies = v.allergies,
+                   allergy_list = v.allergy_list, medication_list = v.medication_list, diagnoses = v.diagnoses
+               FROM (VALUES %s) AS v(id, symptoms_diagnosis, allergies, allergy_list, medication_list, diagnoses)
+               WHERE mr.id = v.id""",
+            values,
+            template="(%s, %s, %s, %s::text[], %s::text[], %s::text[])"
+        )
+    return len(values)
+
+def _parse_json_timestamp(value):
+    """json_build_array() renders timestamps as ISO-8601 strings; turn them back into datetimes."""
+    return datetime.fromisoformat(value) if value else None
+
+def _appointment_from_json(item):
+    return Appointment(_parse_json_timestamp(item[0]), *item[1:])
+
+def encode_page_cursor(sort_value, row_id):
+    """Builds an opaque keyset cursor pointing just after the row (sort_value, row_id)."""
+    raw = f"{sort_value.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_page_cursor(token):
+    """Returns the (datetime, id) pair encoded by encode_page_cursor(). Raises ValueError if malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        sort_value, row_id = raw.split('|')
+        return datetime.fromisoformat(sort_value), int(row_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Malformed page cursor") from e
+
+def history_page_size():
+    return current_app.config['HISTORY_PAGE_SIZE']
+
+def _patient_from_row(row):
+    return {
+        'uid': row[0],
+        'name': row[1],
+        'date_of_birth': row[2],
+        'gender': row[3],
+        'contact_info': row[4],
+        'emergency_contact_name': row[5],
+        'emergency_contact_relationship': row[6],
+        'emergency_contact_phone': row[7]
+    }
+
+def fetch_patient(cur, patient_uid):
+    """Returns a patient's details (without history) as a dict, or None."""
+    cur.execute(
+        """SELECT uid, name, date_of_birth, gender, contact_info,
+                  emergency_contact_name, emergency_contact_relationship, emergency_contact_phone
+           FROM patients WHERE uid = %s""",
+        (patient_uid,)
+    )
+    row = cur.fetchone()
+    return _patient_from_row(row) if row else None
+
+def _summary_from_json(value):
+    medications, allergies, conditions = value or ([], [], []) # No row until the first record
+    return {'medications': medications, 'allergies': allergies, 'conditions': conditions}
+
+def fetch_patient_overview(cur, patient_uid):
+    """Returns (patient details dict, clinical summary) in one query, without history; None if no patient matches."""
+    cur.execute(
+        """SELECT p.uid, p.name, p.date_of_birth, p.gender, p.contact_info,
+                  p.emergency_contact_name, p.emergency_contact_relationship, p.emergency_contact_phone"""
+        + CLINICAL_SUMMARY_SQL + " FROM patients p WHERE p.uid = %s",
+        (patient_uid,)
+    )
+    row = cur.fetchone()
+    return (_patient_from_row(row), _summary_from_json(row[8])) if row else None
+
+def fetch_patient_bundle(cur, patient_uid=None, user_id=None, with_history=True, with_summary=False):
+    """
+    Fetches a patient's details, medical records, appointments and next scheduled
+    appointment in a single round trip. Look the patient up by `patient_uid` or by
+    the owning `user_id`. With with_history=False the records and appointments are
+    not queried and come back as empty lists.
+    Returns a PatientBundle, or None if no patient matches.
+    """
+    sql = PATIENT_BUNDLE_SQL
+    if with_history:
+        sql += PATIENT_HISTORY_SQL
+    if with_summary:
+        sql += CLINICAL_SUMMARY_SQL
+    sql += " FROM patients p"
+
+    if patient_uid is not None:
+        cur.execute(sql + " WHERE p.uid = %s", (patient_uid,))
+    elif user_id is not None:
+        cur.execute(sql + " WHERE p.user_id = %s", (user_id,))
+    else:
+        raise ValueError("fetch_patient_bundle() needs a patient_uid or a user_id")
+
+    row = cur.fetchone()
+    if row is None:
         return None
 
+    patient = _patient_from_row(row)
+    upcoming_appointment = _appointment_from_json(row[8]) if row[8] else None
+    extra = row[9:] # Optional columns, in the order they were added to the query
+    medical_records, appointments, summary = [], [], None
+    if with_history:
+        medical_records = [_record_from_row([_parse_json_timestamp(item[0])] + item[1:]) for item in extra[0]]
+        appointments = [_appointment_from_json(item) for item in extra[1]]
+        extra = extra[2:]
+    if with_summary:
+        summary = _summary_from_json(extra[0])
+    return PatientBundle(patient, medical_records, appointments, upcoming_appointment, summary)
+
+# --- Streaming History ---
+# For exports of very long histories: rows come from a server-side (named) cursor in
+# batches of `fetch_size`, so only one batch is held in memory at a time. The cursor
+# lives in the current transaction; consume the generator inside transaction().
+
+def _stream_rows(cur, name, sql, params, make_row, fetch_size):
+    with cur.connection.cursor(name=name) as named_cur:
+        named_cur.itersize = fetch_size
+        named_cur.execute(sql, params)
+        for row in named_cur:
+            yield make_row(row)
+
+def iter_medical_records(cur, patient_uid, limit=None, fetch_size=500):
+    """Yields up to `limit` of a patient's MedicalRecords, newest first, without loading them all."""
+    sql = f"""SELECT {MEDICAL_RECORD_COLUMNS}
+             FROM medical_records mr
+             JOIN users u ON mr.doctor_id = u.id
+             WHERE mr.patient_uid = %s
+             ORDER BY mr.record_date DESC, mr.id DESC LIMIT %s"""
+    return _stream_rows(cur, 'stream_medical_records', sql, (patient_uid, limit), _record_from_row, fetch_size)
+
+def iter_appointments(cur, patient_uid, limit=None, fetch_size=500):
+    """Yields up to `limit` of a patient's Appointments, newest first, without loading them all."""
+    sql = """SELECT a.appointment_date, a.reason, a.status, u.username AS doctor_username, u.id AS doctor_id, a.id
+             FROM appointments a
+             JOIN users u ON a.doctor_id = u.id
+             WHERE a.patient_uid = %s
+             ORDER BY a.appointment_date DESC, a.id DESC LIMIT %s"""
+    return _stream_rows(cur, 'stream_appointments', sql, (patient_uid, limit), lambda row: Appointment(*row), fetch_size)
+
+# --- Patient Search ---
+# Doctors look patients up by part of a name, part of a phone number, or a date of birth.
+# Name and phone searches use the trigram GiST indexes from migration 0009, which return
+# the closest matches first, so a LIMIT stops the scan early even on very large tables.
+
+PatientMatch = namedtuple('PatientMatch', ['uid', 'name', 'date_of_birth', 'contact_info'])
+
+PATIENT_SEARCH_MIN_NAME_LENGTH = 2
+PATIENT_SEARCH_MIN_DIGITS = 3 # Trigrams need at least three characters to narrow anything down
+DATE_OF_BIRTH_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d.%m.%Y')
+
+# Must match the expression indexed by idx_patients_contact_digits_trgm
+CONTACT_DIGITS_SQL = "regexp_replace(contact_info, '[^0-9]', '', 'g')"
+
+def _parse_date_of_birth(query):
+    for fmt in DATE_OF_BIRTH_FORMATS:
+        try:
+            return datetime.strptime(query, fmt).date()
+        except ValueError:
+            pass
+    return None
+
+def search_patients(cur, query, limit=10):
+    """
+    Returns up to `limit` PatientMatches for a search box query, best matches first: a date
+    matches date_of_birth exactly, a mostly-numeric query matches phone digits anywhere in
+    contact_info, and anything else is matched against names (word prefix/typo tolerant).
+    A patient whose UID is exactly the query always comes first.
+    """
+    query = ' '.join(query.split())
+    date_of_birth = _parse_date_of_birth(query)
+    digits = ''.join(ch for ch in query if ch.isdigit())
+    select = "SELECT uid, name, date_of_birth, contact_info FROM patients"
+
+    cur.execute(select + " WHERE uid = %s", (query,))
+    exact = [PatientMatch(*row) for row in cur.fetchall()]
+
+    if date_of_birth is not None:
+        cur.execute(select + " WHERE date_of_birth = %s ORDER BY name, uid LIMIT %s", (date_of_birth, limit))
+    elif digits and not query.strip('+-() .0123456789'):
+        if len(digits) < PATIENT_SEARCH_MIN_DIGITS:
+            return exact
+        cur.execute(
+            select + f""" WHERE {CONTACT_DIGITS_SQL} LIKE %(pattern)s
+                          ORDER BY {CONTACT_DIGITS_SQL} <-> %(digits)s, name LIMIT %(limit)s""",
+            {'pattern': f'%{digits}%', 'digits': digits, 'limit': limit}
+        )
+    else:
+        if len(query) < PATIENT_SEARCH_MIN_NAME_LENGTH:
+            return exact
+        # <% : some word of name is similar to the query; <<-> : the matching distance
+        cur.execute(
+            select + """ WHERE %(query)s <%% name
+                         ORDER BY %(query)s <<-> name, name LIMIT %(limit)s""",
+            {'query': query, 'limit': limit}
+        )
+    matches = [PatientMatch(*row) for row in cur.fetchall()]
+    return (exact + [match for match in matches if not exact or match.uid != exact[0].uid])[:limit]
+
 # --- Password Hashing Utilities ---
+# These hash on the calling thread; request handlers use backend.passwords, which runs
+# the same hashing in a bounded process pool.
 def hash_password(password):
     """
-    Hashes a password using Werkzeug's secure hashing.
+    Hashes a password using Werkzeug's secure hashing, with the configured PASSWORD_HASH_METHOD.
     """
-    return generate_password_hash(password)
+    return generate_password_hash(password, current_app.config['PASSWORD_HASH_METHOD'])
 
 def check_password(hashed_password, password):
     """
@@ -0,0 +1,167 @@
+import csv
+import io
+import uuid
+from collections import Counter, namedtuple
+from datetime import date
+import psycopg2.errors
+import psycopg2.extras
+from backend.models import transaction
+from backend.passwords import get_password_hasher
+
+# --- Bulk Patient Onboarding ---
+# Registering patients one at a time takes three page loads each, plus a password hash on
+# the request thread. Clinics that move over with a list of patients upload it as a CSV
+# instead. The file is checked as a whole, with one query each for UIDs and usernames that
+# are already taken. Then every placeholder password is hashed in the password pool, and
+# the users and patients rows are written with two multi-row INSERTs. A file with any bad
+# row registers nobody, and the doctor gets the list of rows to fix.
+#
+# As with single registrations, the patient's username is their UID, and the password is
+# a random one that is never shown to anybody.
+
+PATIENT_COLUMNS = (
+    'uid', 'name', 'date_of_birth', 'gender', 'contact_info',
+    'emergency_contact_name', 'emergency_contact_relationship', 'emergency_contact_phone'
+)
+REQUIRED_COLUMNS = ('uid', 'name', 'date_of_birth', 'gender', 'contact_info') # As in doctor_new_patient_form.html
+GENDERS = ('Male', 'Female', 'Other')
+MAX_LENGTHS = { # Column sizes in the patients table
+    'uid': 255, 'name': 255, 'gender': 20, 'emergency_contact_name': 255,
+    'emergency_contact_relationship': 100, 'emergency_contact_phone': 50
+}
+
+NewPatient = namedtuple('NewPatient', ('row_number',) + PATIENT_COLUMNS)
+# registered: UIDs of the new patients (empty when rejected); errors: [(row number, problem)]
+OnboardingResult = namedtuple('OnboardingResult', ['rows', 'registered', 'errors'])
+
+class OnboardingRejected(Exception):
+    """Raised when the file can't be used at all (not a CSV of patients, too many rows)."""
+
+def _check_row(values):
+    """Returns the first problem with a row's values, or None."""
+    for column in REQUIRED_COLUMNS:
+        if not values[column]:
+            return f'{column} is missing'
+    for column, max_length in MAX_LENGTHS.items():
+        if values[column] and len(values[column]) > max_length:
+            return f'{column} is longer than {max_length} characters'
+    if values['gender'] not in GENDERS:
+        return f"gender must be one of {', '.join(GENDERS)}"
+    try:
+        date_of_birth = date.fromisoformat(values['date_of_birth'])
+    except ValueError:
+        return 'date_of_birth must be YYYY-MM-DD'
+    if date_of_birth > date.today():
+        return 'date_of_birth is in the future'
+    return None
+
+def parse_patients_csv(stream, max_rows):
+    """
+    Reads patients from a binary CSV `stream` with a header row. Returns (patients, errors),
+    where errors lists (row number, problem) for rows with missing or invalid values.
+    Raises OnboardingRejected if the header is wrong or there are more than max_rows rows.
+    """
+    try:
+        reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+        header = [name.strip().lower() for name in next(reader, [])]
+        if not header:
+            raise OnboardingRejected('The file is empty.')
+        unknown = [name for name in header if name not in PATIENT_COLUMNS]
+        missing = [name for name in REQUIRED_COLUMNS if name not in header]
+        if unknown or missing or len(set(header)) != len(header):
+            raise OnboardingRejected(f"The first row must name the columns: {', '.join(PATIENT_COLUMNS)} "
+                                     f"(the last three are optional).")
+
+        patients, errors = [], []
+        for row_number, row in enumerate(reader, start=1):
+            if not any(field.strip() for field in row):
+                continue
+            if row_number > max_rows:
+                raise OnboardingRejected(f'At most {max_rows} patients can be registered per file.')
+            if len(row) != len(header):
+                errors.append((row_number, f'expected {len(header)} fields, found {len(row)}'))
+                continue
+            values = dict.fromkeys(PATIENT_COLUMNS)
+            values.update((name, field.strip() or None) for name, field in zip(header, row))
+            values['gender'] = (values['gender'] or '').capitalize() or None
+            problem = _check_row(values)
+            if problem:
+                errors.append((row_number, problem))
+            else:
+                patients.append(NewPatient(row_number=row_number, **values))
+    except UnicodeDecodeError:
+        raise OnboardingRejected('The file is not UTF-8 text.')
+    except csv.Error as e:
+        raise OnboardingRejected(f'Malformed CSV: {e}.')
+    return patients, errors
+
+def find_duplicates(cur, patients):
+    """
+    Returns (row number, problem) for patients whose UID appears more than once in the batch
+    or is already taken as a patient UID or a username. Two queries for the whole batch.
+    """
+    uids = [patient.uid for patient in patients]
+    cur.execute("SELECT uid FROM patients WHERE uid = ANY(%s)", (uids,))
+    existing_patients = {row[0] for row in cur.fetchall()}
+    cur.execute("SELECT username FROM users WHERE username = ANY(%s)", (uids,))
+    existing_usernames = {row[0] for row in cur.fetchall()}
+    counts = Counter(uids)
+
+    errors = []
+    for patient in patients:
+        if patient.uid in existing_patients:
+            errors.append((patient.row_number, f'a patient with UID "{patient.uid}" already exists'))
+        elif patient.uid in existing_usernames:
+            errors.append((patient.row_number, f'the username "{patient.uid}" is already taken'))
+        elif counts[patient.uid] > 1:
+            errors.append((patient.row_number, f'UID "{patient.uid}" appears more than once in the file'))
+    return errors
+
+def register_patients(cur, doctor_id, patients, password_hashes):
+    """Inserts users and patients rows for the batch with one multi-row INSERT each."""
+    user_rows = psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO users (username, password, role) VALUES %s RETURNING id, username",
+        [(patient.uid, password_hash) for patient, password_hash in zip(patients, password_hashes)],
+        template="(%s, %s, 'patient')", page_size=len(patients), fetch=True
+    )
+    user_ids = {username: user_id for user_id, username in user_rows}
+    psycopg2.extras.execute_values(
+        cur,
+        """INSERT INTO patients (uid, user_id, name, date_of_birth, gender, contact_info,
+                                 emergency_contact_name, emergency_contact_relationship, emergency_contact_phone,
+                                 registered_by)
+           VALUES %s""",
+        [(patient.uid, user_ids[patient.uid], patient.name, patient.date_of_birth, patient.gender, patient.contact_info,
+          patient.emergency_contact_name, patient.emergency_contact_relationship, patient.emergency_contact_phone,
+          doctor_id) for patient in patients],
+        page_size=len(patients)
+    )
+
+def onboard_patients(stream, doctor_id, max_rows):
+    """
+    Registers every patient in the CSV `stream` for `doctor_id`, or none if any row has a
+    problem. Returns an OnboardingResult. Raises OnboardingRejected, PasswordHashingBusy or
+    psycopg2.Error.
+    """
+    patients, errors = parse_patients_csv(stream, max_rows)
+    rows = len(patients) + len(errors)
+    if patients:
+        with transaction() as cur:
+            errors += find_duplicates(cur, patients)
+    if errors or not patients:
+        return OnboardingResult(rows, [], sorted(errors))
+
+    # Hashing takes a while, so it runs between the two transactions rather than inside one
+    password_hashes = get_password_hasher().hash_many(str(uuid.uuid4()) for _ in patients)
+    try:
+        with transaction() as cur:
+            register_patients(cur, doctor_id, patients, password_hashes)
+    except psycopg2.errors.UniqueViolation:
+        # Somebody registered one of the UIDs since the check; report which
+        with transaction() as cur:
+            errors = find_duplicates(cur, patients)
+        if not errors:
+            raise OnboardingRejected('Some of these patients were registered at the same time. Please upload the file again.')
+        return OnboardingResult(rows, [], sorted(errors))
+    return OnboardingResult(rows, [patient.uid for patient in patients], [])
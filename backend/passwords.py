@@ -0,0 +1,171 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
+import psycopg2
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+from backend.models import transaction
+
+# Password hashing (scrypt/PBKDF2) is deliberately slow and holds the GIL, so running it on
+# request threads lets a burst of logins stall every other request. Hashes are computed in a
+# small process pool instead. The number of hashes queued or running is capped at
+# PASSWORD_HASH_MAX_PENDING: past that, callers get PasswordHashingBusy straight away and the
+# route answers 503, rather than requests piling up behind a queue that can't drain.
+
+class PasswordHashingBusy(Exception):
+    """Raised when too many password hashes are already queued (or one took too long)."""
+
+def _hash_passwords(passwords, method):
+    return [generate_password_hash(password, method) for password in passwords]
+
+class PasswordHasher:
+    """Runs werkzeug password hashing in a bounded process pool (inline if workers is 0)."""
+
+    def __init__(self, method, workers=2, max_pending=32, timeout=10):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._executor = None
+        # Rehashed passwords are saved from here: done-callbacks run on the process pool's
+        # result thread, and a database round trip there would hold up every other hash result
+        self._store_executor = None
+        self._pid = None
+        self._pending = 0
+        self._method_prefix = None
+        self._stats = {'hashed': 0, 'verified': 0, 'rehashed': 0, 'rejected': 0, 'timed_out': 0}
+
+    def _get_executor(self):
+        """Starts the pools lazily, and again after a fork. Caller holds the lock."""
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            self._store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='password-rehash')
+            self._pid = os.getpid()
+            self._pending = 0
+        return self._executor
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def _submit(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._stats['rejected'] += 1
+                raise PasswordHashingBusy()
+            future = self._get_executor().submit(fn, *args)
+            self._pending += 1
+        future.add_done_callback(self._done)
+        return future
+
+    def _run(self, stat, fn, *args):
+        with self._lock:
+            self._stats[stat] += 1
+        if self.workers <= 0:
+            return fn(*args)
+        future = self._submit(fn, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                self._stats['timed_out'] += 1
+            raise PasswordHashingBusy()
+
+    def hash(self, password):
+        return self._run('hashed', generate_password_hash, password, self.method)
+
+    def hash_many(self, passwords, chunk_size=16):
+        """
+        Hashes a batch of passwords (e.g. bulk patient onboarding) and returns the hashes in
+        order. At most one chunk per worker is queued at a time, so logins submitted meanwhile
+        wait behind a chunk rather than the whole batch.
+        """
+        passwords = list(passwords)
+        with self._lock:
+            self._stats['hashed'] += len(passwords)
+        if self.workers <= 0:
+            return _hash_passwords(passwords, self.method)
+
+        chunks = [passwords[i:i + chunk_size] for i in range(0, len(passwords), chunk_size)]
+        hashes = [None] * len(chunks)
+        in_flight = {}
+        next_chunk = 0
+        while next_chunk < len(chunks) or in_flight:
+            while next_chunk < len(chunks) and len(in_flight) < self.workers:
+                in_flight[self._submit(_hash_passwords, chunks[next_chunk], self.method)] = next_chunk
+                next_chunk += 1
+            done, _ = wait(in_flight, timeout=self.timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                with self._lock:
+                    self._stats['timed_out'] += 1
+                raise PasswordHashingBusy()
+            for future in done:
+                hashes[in_flight.pop(future)] = future.result()
+        return [password_hash for chunk in hashes for password_hash in chunk]
+
+    def verify(self, stored_hash, password):
+        return self._run('verified', check_password_hash, stored_hash, password)
+
+    def needs_rehash(self, stored_hash):
+        """True if stored_hash was made with a different method or cost than PASSWORD_HASH_METHOD."""
+        if self._method_prefix is None:
+            # werkzeug fills in defaults ('scrypt' -> 'scrypt:32768:8:1'), so take the
+            # normalized method from a real hash rather than parsing the setting ourselves
+            self._method_prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return stored_hash.split('$', 1)[0] != self._method_prefix
+
+    def rehash_later(self, app, user_id, stored_hash, password):
+        """
+        Replaces a user's outdated hash in the background. Never raises: if the pool is busy
+        the rehash is skipped, and it will be tried again at the next login.
+        """
+        try:
+            future = self._submit(generate_password_hash, password, self.method) if self.workers > 0 else None
+        except PasswordHashingBusy:
+            return
+
+        def store(new_hash):
+            try:
+                with app.app_context(), transaction() as cur:
+                    # Only if the password wasn't changed in the meantime
+                    cur.execute(
+                        "UPDATE users SET password = %s WHERE id = %s AND password = %s",
+                        (new_hash, user_id, stored_hash)
+                    )
+                with self._lock:
+                    self._stats['rehashed'] += 1
+            except psycopg2.Error as e:
+                print(f"Error storing rehashed password for user {user_id}: {e}")
+
+        def on_hashed(future):
+            if future.exception() is not None:
+                print(f"Error rehashing password for user {user_id}: {future.exception()}")
+                return
+            self._store_executor.submit(store, future.result())
+
+        if future is None:
+            store(generate_password_hash(password, self.method))
+        else:
+            future.add_done_callback(on_hashed)
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._stats, pending=self._pending, workers=self.workers, max_pending=self.max_pending)
+
+def init_password_hasher(app):
+    hasher = PasswordHasher(
+        app.config['PASSWORD_HASH_METHOD'],
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+        timeout=app.config['PASSWORD_HASH_TIMEOUT']
+    )
+    app.extensions['password_hasher'] = hasher
+    return hasher
+
+def get_password_hasher():
+    return current_app.extensions['password_hasher']
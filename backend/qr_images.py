@@ -0,0 +1,97 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from itertools import repeat
+import qrcode
+import qrcode.image.svg
+from flask import current_app
+from backend.lru import LRUCache
+
+# --- QR code images ---
+# The URL a patient's QR code encodes never changes for a given host, so images are
+# generated once per (URL, format) and kept in a per-process LRU cache.
+
+QR_MIMETYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml', # Vector output, no PIL rasterization
+}
+
+def render_qr(data, fmt='png'):
+    """Encodes `data` as a QR code image in the given format and returns the bytes."""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    buffer = BytesIO()
+    if fmt == 'svg':
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+    elif fmt == 'png':
+        qr.make_image(fill_color="black", back_color="white").save(buffer, format="PNG")
+    else:
+        raise ValueError(f"Unsupported QR image format: {fmt!r}")
+    return buffer.getvalue()
+
+def init_qr_cache(app):
+    app.extensions['qr_cache'] = LRUCache(app.config['QR_CACHE_SIZE'])
+    app.extensions['qr_executor'] = None # Batch generation pool, started on first use
+
+def get_qr_image(data, fmt='png'):
+    """Returns (image bytes, etag) for `data`, generating the image only on a cache miss."""
+    cache = current_app.extensions['qr_cache']
+    key = (data, fmt)
+    entry = cache.get(key)
+    if entry is None:
+        image = render_qr(data, fmt)
+        entry = (image, hashlib.sha1(image).hexdigest())
+        cache.set(key, entry)
+    return entry
+
+# --- Batch generation ---
+# Printing cards for a whole clinic needs hundreds of QR codes at once; generation is pure
+# CPU, so large batches are spread over a process pool.
+
+_executor_lock = threading.Lock()
+
+def _get_qr_executor():
+    app = current_app._get_current_object()
+    with _executor_lock:
+        executor, pid = app.extensions.get('qr_executor') or (None, None)
+        if executor is None or pid != os.getpid():
+            executor = ProcessPoolExecutor(
+                max_workers=app.config['QR_BATCH_WORKERS'],
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            app.extensions['qr_executor'] = (executor, os.getpid())
+        return executor
+
+def get_qr_images(data_list, fmt='png'):
+    """
+    Like get_qr_image() for many values at once; returns a list of (image bytes, etag) in
+    the same order. Cache misses are generated in the process pool when there are at least
+    QR_BATCH_PARALLEL_MIN of them (below that, process overhead outweighs the gain).
+    """
+    cache = current_app.extensions['qr_cache']
+    results = [cache.get((data, fmt)) for data in data_list]
+    missing = [i for i, entry in enumerate(results) if entry is None]
+
+    workers = current_app.config['QR_BATCH_WORKERS']
+    to_render = [data_list[i] for i in missing]
+    if workers > 0 and len(missing) >= current_app.config['QR_BATCH_PARALLEL_MIN']:
+        chunksize = max(1, len(missing) // (workers * 4))
+        images = _get_qr_executor().map(render_qr, to_render, repeat(fmt), chunksize=chunksize)
+    else:
+        images = (render_qr(data, fmt) for data in to_render)
+
+    for i, image in zip(missing, images):
+        entry = (image, hashlib.sha1(image).hexdigest())
+        cache.set((data_list[i], fmt), entry)
+        results[i] = entry
+    return results
@@ -0,0 +1,182 @@
+import math
+import random
+import threading
+import time
+import psycopg2
+from flask import current_app
+from backend.lru import LRUCache
+from backend.models import transaction
+
+# --- Login throttling ---
+# Failed logins are counted per username and per client IP over a sliding window of
+# LOGIN_RATE_LIMIT_WINDOW seconds. Once either count reaches its limit, further attempts are
+# rejected before the user lookup and the (slow) password check, which is what makes
+# credential stuffing expensive for us.
+#
+# The window is approximated from two fixed windows: the failures in the current one plus
+# the previous one's, weighted by how much of it still overlaps the sliding window. That
+# needs two counters per key instead of a timestamp per attempt.
+#
+# Counters live in a per-process LRU by default, or in the login_failures table
+# (migration 0008) with LOGIN_RATE_LIMIT_STORE = 'postgres' so every node shares them.
+
+class MemoryFailureStore:
+    """Per-process failure counters: key -> (window index, failures in it, failures in the one before)."""
+
+    def __init__(self, maxsize=100000):
+        self.counters = LRUCache(maxsize) # Bounded, so a flood of random usernames can't exhaust memory
+        self._lock = threading.Lock()
+
+    def counts(self, keys, window_index):
+        """Returns {key: (previous window failures, current window failures)}."""
+        result = {}
+        for key in keys:
+            entry = self.counters.get(key)
+            if entry is None:
+                result[key] = (0, 0)
+            elif entry[0] == window_index:
+                result[key] = (entry[2], entry[1])
+            elif entry[0] == window_index - 1:
+                result[key] = (entry[1], 0)
+            else:
+                result[key] = (0, 0)
+        return result
+
+    def increment(self, keys, window_index):
+        with self._lock:
+            for key in keys:
+                previous, current = self.counts([key], window_index)[key]
+                self.counters.set(key, (window_index, current + 1, previous))
+
+    def reset(self, key):
+        self.counters.delete(key)
+
+    def size(self):
+        return len(self.counters)
+
+class PostgresFailureStore:
+    """Failure counters in the login_failures table, shared by all app nodes."""
+
+    def __init__(self, cleanup_probability=0.01):
+        self.cleanup_probability = cleanup_probability
+
+    def counts(self, keys, window_index):
+        result = {key: (0, 0) for key in keys}
+        with transaction() as cur:
+            cur.execute(
+                """SELECT key, window_index, failures FROM login_failures
+                   WHERE key = ANY(%s) AND window_index >= %s""",
+                (list(keys), window_index - 1)
+            )
+            for key, index, failures in cur.fetchall():
+                previous, current = result[key]
+                result[key] = (failures, current) if index < window_index else (previous, failures)
+        return result
+
+    def increment(self, keys, window_index):
+        with transaction() as cur:
+            for key in keys:
+                cur.execute(
+                    """INSERT INTO login_failures (key, window_index, failures) VALUES (%s, %s, 1)
+                       ON CONFLICT (key, window_index) DO UPDATE SET failures = login_failures.failures + 1""",
+                    (key, window_index)
+                )
+            if random.random() < self.cleanup_probability:
+                # Only the current and previous windows are ever read
+                cur.execute("DELETE FROM login_failures WHERE window_index < %s", (window_index - 1,))
+
+    def reset(self, key):
+        with transaction() as cur:
+            cur.execute("DELETE FROM login_failures WHERE key = %s", (key,))
+
+    def size(self):
+        return None # Not tracked: would cost a query per metrics call
+
+class LoginRateLimiter:
+    """Sliding-window limit on failed logins per username and per client IP."""
+
+    def __init__(self, store, user_limit=5, ip_limit=20, window=300):
+        self.store = store
+        self.user_limit = user_limit
+        self.ip_limit = ip_limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._stats = {'checked': 0, 'throttled_user': 0, 'throttled_ip': 0, 'failures': 0, 'store_errors': 0}
+
+    def _keys(self, username, ip):
+        return {'user:' + username.strip().lower(): self.user_limit, 'ip:' + (ip or 'unknown'): self.ip_limit}
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def check(self, username, ip):
+        """
+        Returns None if the attempt may proceed, or the number of seconds to wait (for a
+        Retry-After header) if the username or IP is throttled. Fails open if the store is down.
+        """
+        self._count('checked')
+        now = time.time()
+        window_index, elapsed = divmod(now, self.window)
+        window_index = int(window_index)
+        overlap = 1 - elapsed / self.window # Share of the previous window still inside the sliding window
+        keys = self._keys(username, ip)
+        try:
+            counts = self.store.counts(keys, window_index)
+        except psycopg2.Error as e:
+            self._count('store_errors')
+            print(f"Error reading login failure counters: {e}")
+            return None
+        for key, limit in keys.items():
+            previous, current = counts[key]
+            if previous * overlap + current >= limit:
+                self._count('throttled_user' if key.startswith('user:') else 'throttled_ip')
+                # When enough of the previous window has slid out, or the current one ends
+                if current < limit and previous:
+                    wait = (1 - (limit - current) / previous) * self.window - elapsed
+                else:
+                    wait = self.window - elapsed
+                return max(1, math.ceil(wait))
+        return None
+
+    def record_failure(self, username, ip):
+        self._count('failures')
+        try:
+            self.store.increment(list(self._keys(username, ip)), int(time.time() // self.window))
+        except psycopg2.Error as e:
+            self._count('store_errors')
+            print(f"Error recording failed login: {e}")
+
+    def record_success(self, username):
+        """Clears the username's failures (the IP's are kept: one success says little about the rest)."""
+        try:
+            self.store.reset('user:' + username.strip().lower())
+        except psycopg2.Error as e:
+            self._count('store_errors')
+            print(f"Error resetting failed logins: {e}")
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._stats, tracked_keys=self.store.size(), user_limit=self.user_limit,
+                        ip_limit=self.ip_limit, window=self.window)
+
+def init_login_limiter(app):
+    """Creates the login limiter selected by LOGIN_RATE_LIMIT_STORE ('memory', 'postgres', or 'off')."""
+    store_type = app.config['LOGIN_RATE_LIMIT_STORE']
+    limiter = None
+    if store_type != 'off':
+        if store_type == 'postgres':
+            store = PostgresFailureStore()
+        else:
+            store = MemoryFailureStore(app.config['LOGIN_RATE_LIMIT_MAX_KEYS'])
+        limiter = LoginRateLimiter(
+            store,
+            user_limit=app.config['LOGIN_RATE_LIMIT_PER_USER'],
+            ip_limit=app.config['LOGIN_RATE_LIMIT_PER_IP'],
+            window=app.config['LOGIN_RATE_LIMIT_WINDOW']
+        )
+    app.extensions['login_limiter'] = limiter
+    return limiter
+
+def get_login_limiter():
+    return current_app.extensions.get('login_limiter')
@@ -0,0 +1,360 @@
+import hashlib
+import glob
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from cachelib import FileSystemCache, NullCache, SimpleCache
+from flask import current_app, render_template, stream_template, request
+from flask_weasyprint import HTML
+from backend.models import transaction, on_commit, fetch_patient, fetch_patient_bundle, iter_medical_records, iter_appointments
+
+# --- Emergency report PDF cache ---
+# Rendering report_template.html with WeasyPrint costs hundreds of ms per request, and
+# emergency QR scans come in bursts. Rendered PDFs are cached per patient together with
+# the data version they were rendered from; any change to the patient's details, records
+# or appointments produces a new version, so stale entries are never served.
+
+# Bump when report_template.html changes so previously cached PDFs are re-rendered.
+REPORT_FORMAT_VERSION = 2
+
+ReportVersion = namedtuple('ReportVersion', ['etag', 'last_modified', 'record_count', 'appointment_count'])
+
+# updated_at is maintained by triggers (migration 0004). Row counts are part of the
+# version too, so that deleting a record also invalidates the cached report.
+REPORT_VERSION_SQL = """
+    SELECT GREATEST(p.updated_at, r.updated_at, a.updated_at) AT TIME ZONE current_setting('TimeZone'),
+           r.row_count, a.row_count
+    FROM patients p
+    CROSS JOIN LATERAL (
+        SELECT MAX(updated_at) AS updated_at, COUNT(*) AS row_count
+        FROM medical_records WHERE patient_uid = p.uid
+    ) r
+    CROSS JOIN LATERAL (
+        SELECT MAX(updated_at) AS updated_at, COUNT(*) AS row_count
+        FROM appointments WHERE patient_uid = p.uid
+    ) a
+    WHERE p.uid = %s
+"""
+
+def init_report_cache(app):
+    """Creates the report cache backend configured by REPORT_CACHE_TYPE and stores it on the app."""
+    cache_type = app.config['REPORT_CACHE_TYPE']
+    threshold = app.config['REPORT_CACHE_THRESHOLD']
+    timeout = app.config['REPORT_CACHE_TIMEOUT']
+    if cache_type == 'filesystem':
+        os.makedirs(app.config['REPORT_CACHE_DIR'], exist_ok=True)
+        cache = FileSystemCache(app.config['REPORT_CACHE_DIR'], threshold=threshold, default_timeout=timeout)
+    elif cache_type == 'simple':
+        cache = SimpleCache(threshold=threshold, default_timeout=timeout)
+    elif cache_type == 'null':
+        cache = NullCache()
+    else:
+        raise ValueError(f"Unknown REPORT_CACHE_TYPE: {cache_type!r}")
+    app.extensions['report_cache'] = cache
+    return cache
+
+def get_report_cache():
+    return current_app.extensions['report_cache']
+
+def _cache_key(patient_uid):
+    return f'report:{patient_uid}'
+
+def fetch_report_version(cur, patient_uid):
+    """Returns the ReportVersion of a patient's current data, or None if the patient does not exist."""
+    cur.execute(REPORT_VERSION_SQL, (patient_uid,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    last_modified, record_count, appointment_count = row
+    fingerprint = f'{REPORT_FORMAT_VERSION}:{patient_uid}:{last_modified.isoformat()}:{record_count}:{appointment_count}'
+    return ReportVersion(hashlib.sha1(fingerprint.encode()).hexdigest(), last_modified, record_count, appointment_count)
+
+def get_cached_report(patient_uid, version):
+    """Returns the cached PDF bytes for this exact data version, or None."""
+    entry = get_report_cache().get(_cache_key(patient_uid))
+    if entry and entry[0] == version.etag:
+        return entry[1]
+    return None
+
+def store_report(patient_uid, version, pdf):
+    # One entry per patient: a new version simply replaces the previous PDF.
+    get_report_cache().set(_cache_key(patient_uid), (version.etag, pdf))
+
+def render_report_pdf(bundle):
+    """Renders a PatientBundle (full history) as the emergency report PDF and returns the bytes."""
+    html = render_template(
+        'report_template.html',
+        patient_info=bundle.patient,
+        medical_records=bundle.medical_records,
+        appointments=bundle.appointments,
+        current_time=datetime.now()
+    )
+    return HTML(string=html).write_pdf()
+
+
+# --- File-backed reports for very long histories ---
+# Above REPORT_STREAMING_THRESHOLD records + appointments, a report is never held in a
+# Python string or bytes object: the HTML is rendered from server-side cursors into a
+# spooled temp file, the PDF is written straight to disk, and the response streams the
+# file. At most REPORT_MAX_ROWS records (and appointments) are included, which caps what
+# WeasyPrint has to lay out. Files live in REPORT_CACHE_DIR/files, one per patient.
+
+def is_large_report(version):
+    return version.record_count + version.appointment_count > current_app.config['REPORT_STREAMING_THRESHOLD']
+
+def _report_files_dir():
+    path = os.path.join(current_app.config['REPORT_CACHE_DIR'], 'files')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def _report_file_prefix(patient_uid):
+    # Hashed so that any UID is a safe file name
+    return os.path.join(_report_files_dir(), hashlib.sha1(patient_uid.encode()).hexdigest())
+
+def get_cached_report_file(patient_uid, version):
+    """Returns the path of the rendered PDF for this exact data version, or None."""
+    path = f'{_report_file_prefix(patient_uid)}-{version.etag}.pdf'
+    return path if os.path.exists(path) else None
+
+def stream_report_html(cur, patient_uid, version):
+    """
+    Renders the report HTML from server-side cursors into a spooled temp file (in memory up
+    to REPORT_SPOOL_MAX_SIZE bytes, on disk beyond). Must be called inside transaction().
+    Returns the file positioned at the start (caller closes it), or None if the patient is gone.
+    """
+    patient_info = fetch_patient(cur, patient_uid)
+    if patient_info is None:
+        return None
+    max_rows = current_app.config['REPORT_MAX_ROWS']
+    fetch_size = current_app.config['REPORT_FETCH_SIZE']
+
+    html_file = tempfile.SpooledTemporaryFile(max_size=current_app.config['REPORT_SPOOL_MAX_SIZE'])
+    chunks = stream_template(
+        'report_template.html',
+        patient_info=patient_info,
+        medical_records=iter_medical_records(cur, patient_uid, limit=max_rows, fetch_size=fetch_size),
+        appointments=iter_appointments(cur, patient_uid, limit=max_rows, fetch_size=fetch_size),
+        records_omitted=max(0, version.record_count - max_rows),
+        appointments_omitted=max(0, version.appointment_count - max_rows),
+        current_time=datetime.now()
+    )
+    for chunk in chunks:
+        html_file.write(chunk.encode('utf-8'))
+    html_file.seek(0)
+    return html_file
+
+def write_report_file(html_file, patient_uid, version):
+    """Renders the HTML file to the version's PDF file and removes older versions. Returns the path."""
+    prefix = _report_file_prefix(patient_uid)
+    path = f'{prefix}-{version.etag}.pdf'
+    # Write to a temp name first so concurrent readers never see a partial PDF
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as pdf_file:
+            HTML(file_obj=html_file, base_url=request.url, encoding='utf-8').write_pdf(pdf_file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    for stale in glob.glob(f'{prefix}-*.pdf'):
+        if stale != path:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+    return path
+
+def render_report_file(patient_uid, version):
+    """Renders a large report to disk (see above). Returns the file path, or None if the patient is gone."""
+    with transaction() as cur:
+        html_file = stream_report_html(cur, patient_uid, version)
+    if html_file is None:
+        return None
+    # The PDF is laid out after the transaction has committed
+    with html_file:
+        return write_report_file(html_file, patient_uid, version)
+
+# --- Background pre-rendering ---
+# When a patient's data changes, their report is re-rendered in a process pool (WeasyPrint
+# is CPU-bound and holds the GIL) and put in the cache, so the next emergency scan finds
+# a ready PDF instead of paying for the render in the request thread.
+
+_worker_app = None
+
+# Settings the workers take from the parent app rather than from the environment, so an app
+# created with overrides (tests, CLI) renders from the same database into the same cache dir
+WORKER_CONFIG_PREFIXES = ('DATABASE_URL', 'DB_POOL_', 'REPORT_')
+
+def worker_config(app):
+    """The parent app's settings to pass on to the render workers (see WORKER_CONFIG_PREFIXES)."""
+    return {key: value for key, value in app.config.items() if key.startswith(WORKER_CONFIG_PREFIXES)}
+
+def _init_worker(parent_config=None):
+    """Process pool initializer: builds a minimal app (DB pool, templates) once per worker."""
+    global _worker_app
+    from backend.app import create_app # Imported here to avoid a circular import
+    _worker_app = create_app(dict(parent_config or {}, **{
+        'REPORT_PRERENDER_WORKERS': 0, # Workers never start pools of their own
+        'REPORT_CACHE_TYPE': 'null', # The parent process stores the result
+        'AUTO_MIGRATE': False,
+        'CHECK_INDEXES_ON_STARTUP': False,
+        'SESSION_GC_INTERVAL': 0, # The parent process sweeps sessions
+        'DB_POOL_MIN_SIZE': 0,
+        'DB_POOL_MAX_SIZE': 1,
+    }))
+
+def _render_in_worker(patient_uid, base_url):
+    """
+    Runs in a pool process. Returns (version, pdf bytes, render seconds), or None if the
+    patient is gone. pdf is None for file-backed (large) reports, which are written to disk.
+    """
+    # flask_weasyprint resolves the report's URLs against the request that triggered the render
+    with _worker_app.test_request_context('/', base_url=base_url):
+        with transaction() as cur:
+            version = fetch_report_version(cur, patient_uid)
+        if version is None:
+            return None
+        started = time.perf_counter()
+        if is_large_report(version):
+            # Written to the shared report files directory; nothing to send back
+            if render_report_file(patient_uid, version) is None:
+                return None
+            return version, None, time.perf_counter() - started
+        with transaction() as cur:
+            bundle = fetch_patient_bundle(cur, patient_uid=patient_uid)
+        if bundle is None:
+            return None
+        pdf = render_report_pdf(bundle)
+        return version, pdf, time.perf_counter() - started
+
+class ReportPrerenderer:
+    """
+    Queues report re-renders into a process pool and stores the results in the report cache.
+    Re-render requests for a patient that is already queued (not yet running) are coalesced.
+    """
+
+    def __init__(self, cache, workers=2, max_pending=100, config=None):
+        self.cache = cache
+        self.config = config or {} # Passed to the workers' create_app()
+        self.workers = workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._pending = {} # patient_uid -> latest Future
+        self._stats = {
+            'submitted': 0, 'coalesced': 0, 'dropped': 0, 'completed': 0, 'failed': 0, 'rendered': 0,
+            'render_seconds_total': 0.0, 'render_seconds_max': 0.0, 'render_seconds_last': None,
+        }
+
+    def _get_executor(self):
+        """Starts the pool lazily, and again after a fork (the parent's pool is unusable there). Caller holds the lock."""
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.config,)
+            )
+            self._pid = os.getpid()
+            self._pending = {}
+        return self._executor
+
+    def submit(self, patient_uid, base_url):
+        with self._lock:
+            queued = self._pending.get(patient_uid)
+            if queued is not None and not queued.running() and not queued.done():
+                # The queued render will read the latest data when it starts
+                self._stats['coalesced'] += 1
+                return queued
+            if len(self._pending) >= self.max_pending:
+                # Overloaded: the report will be rendered on demand at the next scan instead
+                self._stats['dropped'] += 1
+                return None
+            future = self._get_executor().submit(_render_in_worker, patient_uid, base_url)
+            self._pending[patient_uid] = future
+            self._stats['submitted'] += 1
+        future.add_done_callback(lambda f: self._finished(patient_uid, f))
+        return future
+
+    def _finished(self, patient_uid, future):
+        with self._lock:
+            if self._pending.get(patient_uid) is future:
+                del self._pending[patient_uid]
+            try:
+                result = future.result()
+            except Exception as e:
+                self._stats['failed'] += 1
+                print(f"Background report render failed for {patient_uid}: {e}")
+                return
+            self._stats['completed'] += 1
+            if result is None:
+                return
+            version, pdf, seconds = result
+            self._stats['rendered'] += 1
+            self._stats['render_seconds_total'] += seconds
+            self._stats['render_seconds_max'] = max(self._stats['render_seconds_max'], seconds)
+            self._stats['render_seconds_last'] = seconds
+        if pdf is not None:
+            self.cache.set(_cache_key(patient_uid), (version.etag, pdf))
+
+    def wait(self, patient_uid, version, timeout):
+        """
+        If a render of this patient is in flight, waits up to `timeout` seconds for it and
+        returns the PDF when it matches `version`. Returns None otherwise (always, for
+        file-backed reports: look for the file once this returns).
+        """
+        with self._lock:
+            future = self._pending.get(patient_uid)
+        if future is None or timeout <= 0:
+            return None
+        try:
+            result = future.result(timeout=timeout)
+        except Exception:
+            return None
+        if result is not None and result[0].etag == version.etag:
+            return result[1]
+        return None
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._pending)
+        stats['render_seconds_avg'] = stats['render_seconds_total'] / stats['rendered'] if stats['rendered'] else None
+        stats['workers'] = self.workers
+        return stats
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+def init_report_prerenderer(app):
+    """Creates the background renderer if REPORT_PRERENDER_WORKERS > 0 (the pool itself starts on first use)."""
+    prerenderer = None
+    if app.config['REPORT_PRERENDER_WORKERS'] > 0:
+        prerenderer = ReportPrerenderer(
+            app.extensions['report_cache'],
+            workers=app.config['REPORT_PRERENDER_WORKERS'],
+            max_pending=app.config['REPORT_PRERENDER_MAX_PENDING'],
+            config=worker_config(app)
+        )
+    app.extensions['report_prerenderer'] = prerenderer
+    return prerenderer
+
+def get_report_prerenderer():
+    return current_app.extensions.get('report_prerenderer')
+
+def schedule_report_render(patient_uid):
+    """Queues a re-render of the patient's report once the current transaction commits."""
+    prerenderer = get_report_prerenderer()
+    if prerenderer is None:
+        return
+    base_url = request.url_root
+    on_commit(lambda: prerenderer.submit(patient_uid, base_url))
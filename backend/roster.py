@@ -0,0 +1,125 @@
+import base64
+import binascii
+import json
+import threading
+import time
+from collections import namedtuple
+from flask import current_app
+from backend.lru import LRUCache
+from backend.models import transaction, on_commit, Page
+
+# --- Doctor Patient Roster ---
+# The doctor dashboard lists "my patients": everyone the doctor has written a medical record
+# for or has an appointment with, by name, DOCTOR_ROSTER_PAGE_SIZE at a time (keyset pages on
+# (name, uid)). Most views only ever show the count and the first page, so those are cached
+# per doctor for DOCTOR_ROSTER_CACHE_TTL seconds. Writing a record or an appointment clears
+# the doctor's entry on this node once committed; other nodes catch up when theirs expires.
+
+RosterPatient = namedtuple('RosterPatient', ['uid', 'name', 'date_of_birth'])
+
+DOCTOR_PATIENTS_SQL = """
+    SELECT patient_uid FROM medical_records WHERE doctor_id = %(doctor_id)s
+    UNION
+    SELECT patient_uid FROM appointments WHERE doctor_id = %(doctor_id)s
+"""
+
+def encode_roster_cursor(name, uid):
+    """Opaque keyset cursor pointing just after the patient (name, uid)."""
+    return base64.urlsafe_b64encode(json.dumps([name, uid]).encode()).decode().rstrip('=')
+
+def decode_roster_cursor(token):
+    """Returns the (name, uid) pair encoded by encode_roster_cursor(). Raises ValueError if malformed."""
+    try:
+        name, uid = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        if not isinstance(name, str) or not isinstance(uid, str):
+            raise ValueError("Malformed roster cursor")
+        return name, uid
+    except (binascii.Error, UnicodeDecodeError, TypeError) as e:
+        raise ValueError("Malformed roster cursor") from e
+
+def count_doctor_patients(cur, doctor_id):
+    cur.execute(f"SELECT count(*) FROM ({DOCTOR_PATIENTS_SQL}) d", {'doctor_id': doctor_id})
+    return cur.fetchone()[0]
+
+def fetch_doctor_patients_page(cur, doctor_id, cursor=None, limit=25):
+    """Returns a Page of the doctor's patients ordered by name, starting after `cursor`."""
+    sql = f"""SELECT p.uid, p.name, p.date_of_birth
+              FROM patients p
+              JOIN ({DOCTOR_PATIENTS_SQL}) d ON d.patient_uid = p.uid"""
+    params = {'doctor_id': doctor_id, 'limit': limit + 1}
+    if cursor:
+        sql += " WHERE (p.name, p.uid) > (%(after_name)s, %(after_uid)s)"
+        params['after_name'], params['after_uid'] = decode_roster_cursor(cursor)
+    sql += " ORDER BY p.name, p.uid LIMIT %(limit)s"
+    cur.execute(sql, params)
+    rows = [RosterPatient(*row) for row in cur.fetchall()]
+    next_cursor = encode_roster_cursor(rows[limit - 1].name, rows[limit - 1].uid) if len(rows) > limit else None
+    return Page(rows[:limit], next_cursor)
+
+class DoctorRosterCache:
+    """Per-doctor (patient count, first roster page), kept for `ttl` seconds or until invalidated."""
+
+    def __init__(self, page_size=25, maxsize=1024, ttl=60):
+        self.page_size = page_size
+        self.ttl = ttl
+        self.entries = LRUCache(maxsize) # doctor_id -> (loaded_at, count, first page)
+        self._lock = threading.Lock()
+        # Invalidation counters (all doctors, per doctor), so a load that raced an invalidation isn't kept
+        self._all_generation = 0
+        self._generations = {}
+        self.loads = 0
+
+    def first_page(self, doctor_id):
+        """Returns (patient count, first Page) for the doctor. May query the database (raises psycopg2.Error)."""
+        entry = self.entries.get(doctor_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            return entry[1], entry[2]
+        with self._lock:
+            generation = self._generation(doctor_id)
+        with transaction() as cur:
+            count = count_doctor_patients(cur, doctor_id)
+            page = fetch_doctor_patients_page(cur, doctor_id, limit=self.page_size)
+        with self._lock:
+            self.loads += 1
+            if generation == self._generation(doctor_id):
+                self.entries.set(doctor_id, (time.monotonic(), count, page))
+        return count, page
+
+    def _generation(self, doctor_id):
+        return self._all_generation, self._generations.get(doctor_id, 0)
+
+    def page(self, doctor_id, cursor):
+        """A later page of the roster; never cached. Raises ValueError for a malformed cursor."""
+        with transaction() as cur:
+            return fetch_doctor_patients_page(cur, doctor_id, cursor=cursor, limit=self.page_size)
+
+    def invalidate(self, doctor_id=None):
+        """Drops one doctor's entry, or every entry (e.g. after a patient is renamed) if doctor_id is None."""
+        with self._lock:
+            if doctor_id is None:
+                self._all_generation += 1
+                self.entries.clear()
+            else:
+                self._generations[doctor_id] = self._generations.get(doctor_id, 0) + 1
+                self.entries.delete(doctor_id)
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.entries.stats(), loads=self.loads, ttl=self.ttl, page_size=self.page_size)
+
+def init_doctor_roster(app):
+    roster = DoctorRosterCache(
+        page_size=app.config['DOCTOR_ROSTER_PAGE_SIZE'],
+        maxsize=app.config['DOCTOR_ROSTER_CACHE_SIZE'],
+        ttl=app.config['DOCTOR_ROSTER_CACHE_TTL']
+    )
+    app.extensions['doctor_roster'] = roster
+    return roster
+
+def get_doctor_roster():
+    return current_app.extensions['doctor_roster']
+
+def invalidate_doctor_roster(doctor_id=None):
+    """Drops the cached roster of `doctor_id` (all doctors if None) once the current transaction commits."""
+    roster = get_doctor_roster()
+    on_commit(lambda: roster.invalidate(doctor_id))
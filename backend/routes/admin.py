@@ -0,0 +1,120 @@
+import tempfile
+from datetime import date
+import psycopg2
+from flask import Blueprint, session, jsonify, current_app, request, send_file
+from backend.lru import LRUCache
+from backend.models import transaction
+from backend.appointment_io import FORMATS, ImportRejected, import_appointments, export_appointments, format_for_filename
+from backend.reports import get_report_prerenderer
+from backend.passwords import get_password_hasher
+from backend.ratelimit import get_login_limiter
+from backend.doctors import get_doctor_directory
+from backend.roster import get_doctor_roster, invalidate_doctor_roster
+from backend.sessions import privileged
+
+# Create a Blueprint for operational endpoints
+admin_bp = Blueprint('admin', __name__)
+
+def _is_admin():
+    return session.get('username') in current_app.config['ADMIN_USERNAMES']
+
+@admin_bp.route('/admin/metrics')
+@privileged
+def metrics():
+    """Returns runtime metrics as JSON. Only for users listed in ADMIN_USERNAMES."""
+    if not _is_admin():
+        return jsonify(error='Unauthorized access.'), 403
+
+    prerenderer = get_report_prerenderer()
+    session_cache = getattr(current_app.session_interface, 'cache', None)
+    session_gc = current_app.extensions.get('session_gc')
+    login_limiter = get_login_limiter()
+    return jsonify(
+        report_prerender=prerenderer.metrics() if prerenderer else None,
+        qr_cache=current_app.extensions['qr_cache'].stats(),
+        password_hasher=get_password_hasher().metrics(),
+        login_limiter=login_limiter.metrics() if login_limiter else None,
+        doctor_directory=get_doctor_directory().metrics(),
+        doctor_roster=get_doctor_roster().metrics(),
+        session_cache=session_cache.stats() if isinstance(session_cache, LRUCache) else None,
+        session_gc=session_gc.metrics() if session_gc else None
+    )
+
+@admin_bp.route('/admin/appointments/import', methods=['POST'])
+@privileged
+def import_appointments_file():
+    """
+    Imports appointments from CSV or NDJSON, sent as the request body or as a `file` upload
+    (?format=csv|ndjson, else from the content type or file name). All rows or none are
+    imported; rejected rows are listed in the response.
+    """
+    if not _is_admin():
+        return jsonify(error='Unauthorized access.'), 403
+
+    upload = request.files.get('file')
+    if upload is not None:
+        stream, fmt = upload.stream, format_for_filename(upload.filename)
+    else:
+        stream = request.stream
+        fmt = 'ndjson' if request.mimetype in ('application/x-ndjson', 'application/jsonl') else 'csv'
+    fmt = request.args.get('format', fmt)
+    if fmt not in FORMATS:
+        return jsonify(error=f"Unknown format; expected one of {', '.join(FORMATS)}."), 400
+
+    try:
+        with transaction() as cur:
+            result = import_appointments(
+                cur, stream, fmt,
+                default_minutes=current_app.config['APPOINTMENT_SLOT_MINUTES'],
+                max_errors=current_app.config['APPOINTMENT_IMPORT_MAX_ERRORS']
+            )
+            if result.imported:
+                invalidate_doctor_roster()
+    except ImportRejected as e:
+        return jsonify(error=str(e)), 400
+    except psycopg2.Error as e:
+        return jsonify(error=f'Error importing appointments: {e}'), 500
+
+    return jsonify(
+        rows=result.rows,
+        imported=result.imported,
+        error_count=result.error_count,
+        errors=[{'row': row_number, 'problem': problem} for row_number, problem in result.errors]
+    ), 422 if result.error_count else 200
+
+@admin_bp.route('/admin/appointments/export')
+@privileged
+def export_doctor_appointments():
+    """Downloads a doctor's appointments (?doctor_id=&from=YYYY-MM-DD&to=YYYY-MM-DD&format=csv|ndjson)."""
+    if not _is_admin():
+        return jsonify(error='Unauthorized access.'), 403
+
+    doctor_id = request.args.get('doctor_id', type=int)
+    fmt = request.args.get('format', 'csv')
+    if doctor_id is None:
+        return jsonify(error='doctor_id is required.'), 400
+    if fmt not in FORMATS:
+        return jsonify(error=f"Unknown format; expected one of {', '.join(FORMATS)}."), 400
+    try:
+        first_day = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+        last_day = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        return jsonify(error='Invalid date.'), 400
+
+    # COPY writes into a spooled file (memory, then disk) and the response streams from it,
+    # so the database connection goes back to the pool before a slow download starts
+    export_file = tempfile.SpooledTemporaryFile(max_size=current_app.config['APPOINTMENT_EXPORT_SPOOL_MAX_SIZE'])
+    try:
+        with transaction() as cur:
+            export_appointments(cur, export_file, doctor_id, first_day=first_day, last_day=last_day, fmt=fmt)
+    except psycopg2.Error as e:
+        export_file.close()
+        return jsonify(error=f'Error exporting appointments: {e}'), 500
+
+    export_file.seek(0)
+    return send_file(
+        export_file,
+        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+        as_attachment=True,
+        download_name=f'appointments_doctor_{doctor_id}.{fmt}'
+    )
@@ -1,11 +1,49 @@
 import psycopg2
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
-from backend.models import get_db_connection
-from datetime import datetime
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify, get_template_attribute, current_app
+from backend.models import transaction, history_page_size, encode_page_cursor, decode_page_cursor
+from backend.reports import schedule_report_render
+from backend.sessions import privileged
+from backend.doctors import get_doctor_directory
+from backend.roster import invalidate_doctor_roster
+from backend.scheduling import book_appointment, next_free_slots, fetch_availability, free_start_times, working_hours, SlotUnavailable
+from datetime import date, datetime, timedelta
 
 # Create a Blueprint for appointment routes
 appointment_bp = Blueprint('appointment', __name__)
 
+MAX_CALENDAR_DOCTORS = 20 # Doctors shown side by side in one availability calendar
+
+def _fetch_appointment_rows(cur, user_id, user_role, cursor=None):
+    """
+    Returns one keyset page of the user's appointments for manage_appointments, newest first,
+    as (rows, next_cursor). Rows are (id, date, reason, status, doctor username or patient name[, patient uid]).
+    """
+    limit = history_page_size()
+    if user_role == 'patient':
+        sql = """SELECT a.id, a.appointment_date, a.reason, a.status, u.username as doctor_username
+                 FROM appointments a
+                 JOIN users u ON a.doctor_id = u.id
+                 WHERE a.patient_uid = (SELECT uid FROM patients WHERE user_id = %s)"""
+    else:
+        sql = """SELECT a.id, a.appointment_date, a.reason, a.status, p.name as patient_name, p.uid as patient_uid
+                 FROM appointments a
+                 JOIN patients p ON a.patient_uid = p.uid
+                 WHERE a.doctor_id = %s"""
+    params = [user_id]
+    if cursor:
+        sql += " AND (a.appointment_date, a.id) < (%s, %s)"
+        params.extend(decode_page_cursor(cursor))
+    sql += " ORDER BY a.appointment_date DESC, a.id DESC LIMIT %s"
+    params.append(limit + 1)
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_page_cursor(last[1], last[0])
+    return rows[:limit], next_cursor
+
 @appointment_bp.route('/manage_appointments')
 def manage_appointments():
     """Allows both doctors and patients to view their appointments."""
@@ -16,45 +54,40 @@ def manage_appointments():
     user_id = session['user_id']
     user_role = session['role']
     appointments = []
+    next_cursor = None
 
-    conn = get_db_connection()
-    if conn is None:
-        flash('Database connection error. Please try again later.', 'error')
-        return render_template('appointment_form.html', appointments=appointments)
-
-    cur = conn.cursor()
     try:
-        if user_role == 'patient':
-            # Get patient's UID
-            cur.execute("SELECT uid FROM patients WHERE user_id = %s", (user_id,))
-            patient_uid = cur.fetchone()[0]
+        with transaction() as cur:
+            appointments, next_cursor = _fetch_appointment_rows(cur, user_id, user_role)
+    except psycopg2.Error as e:
+        flash(f"Error fetching appointments: {e}", 'error')
 
-            cur.execute(
-                """SELECT a.id, a.appointment_date, a.reason, a.status, u.username as doctor_username
-                   FROM appointments a
-                   JOIN users u ON a.doctor_id = u.id
-                   WHERE a.patient_uid = %s ORDER BY a.appointment_date DESC""",
-                (patient_uid,)
-            )
-        elif user_role == 'doctor':
-            cur.execute(
-                """SELECT a.id, a.appointment_date, a.reason, a.status, p.name as patient_name, p.uid as patient_uid
-                   FROM appointments a
-                   JOIN patients p ON a.patient_uid = p.uid
-                   WHERE a.doctor_id = %s ORDER BY a.appointment_date DESC""",
-                (user_id,)
+    return render_template('appointment_form.html', appointments=appointments, user_role=user_role, next_cursor=next_cursor)
+
+@appointment_bp.route('/manage_appointments/more')
+def manage_appointments_more():
+    """Returns the next page of manage_appointments rows as an HTML fragment (JSON-wrapped)."""
+    if 'user_id' not in session:
+        return jsonify(error='Please log in to access this page.'), 401
+
+    try:
+        with transaction() as cur:
+            appointments, next_cursor = _fetch_appointment_rows(
+                cur, session['user_id'], session['role'], request.args.get('cursor')
             )
-        appointments = cur.fetchall()
+    except ValueError:
+        return jsonify(error='Invalid page cursor.'), 400
     except psycopg2.Error as e:
-        flash(f"Error fetching appointments: {e}", 'error')
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
+        return jsonify(error=f'Error fetching appointments: {e}'), 500
 
-    return render_template('appointment_form.html', appointments=appointments, user_role=user_role)
+    appointment_rows = get_template_attribute('_appointment_rows.html', 'appointment_rows')
+    return jsonify(
+        fragments={'rows': str(appointment_rows(appointments, session['role']))},
+        next_cursor=next_cursor
+    )
 
 @appointment_bp.route('/create_appointment', methods=['GET', 'POST'])
+@privileged
 def create_appointment():
     """Allows doctors and patients to create appointments."""
     if 'user_id' not in session:
@@ -63,36 +96,27 @@ def create_appointment():
 
     user_id = session['user_id']
     user_role = session['role']
-    patients = [] # For doctors to select a patient
-    doctors = []  # For patients to select a doctor
+    doctors = []  # For patients to select a doctor (doctors pick patients by search instead)
+    specializations = []
+    specialization = request.args.get('specialization', '')
     current_patient_uid = None # For patients to pre-fill their UID
 
-    conn = get_db_connection()
-    if conn is None:
-        flash('Database connection error. Please try again later.', 'error')
-        return render_template('appointment_form.html')
-
-    cur = conn.cursor()
     try:
-        if user_role == 'doctor':
-            cur.execute("SELECT uid, name FROM patients ORDER BY name")
-            patients = cur.fetchall()
-        elif user_role == 'patient':
-            cur.execute("SELECT id, username FROM users WHERE role = 'doctor' ORDER BY username")
-            doctors = cur.fetchall()
-            cur.execute("SELECT uid FROM patients WHERE user_id = %s", (user_id,))
-            current_patient_uid = cur.fetchone()[0]
+        if user_role == 'patient':
+            # Served from the in-memory directory; filtering needs no query either
+            directory = get_doctor_directory()
+            doctors = directory.by_specialization(specialization)
+            specializations = directory.specializations()
+            with transaction() as cur:
+                cur.execute("SELECT uid FROM patients WHERE user_id = %s", (user_id,))
+                current_patient_uid = cur.fetchone()[0]
     except psycopg2.Error as e:
         flash(f"Error preparing form data: {e}", 'error')
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
 
     if request.method == 'POST':
         if user_role == 'patient':
             patient_uid = current_patient_uid
-            doctor_id = request.form['doctor_id']
+            doctor_id = request.form.get('doctor_id', type=int)
         elif user_role == 'doctor':
             patient_uid = request.form['patient_uid']
             doctor_id = user_id
@@ -106,58 +130,158 @@ def create_appointment():
             flash('Invalid date or time format. Please use YYYY-MM-DD and HH:MM.', 'error')
             return render_template(
                 'appointment_form.html',
-                patients=patients,
                 doctors=doctors,
+                specializations=specializations,
                 user_role=user_role,
                 current_patient_uid=current_patient_uid,
                 form_data=request.form
             )
 
-        conn = get_db_connection()
-        if conn is None:
-            flash('Database connection error. Please try again later.', 'error')
-            return render_template('appointment_form.html')
-
-        cur = conn.cursor()
         try:
-            # Verify patient_uid exists
-            cur.execute("SELECT uid FROM patients WHERE uid = %s", (patient_uid,))
-            if not cur.fetchone():
-                flash('Invalid Patient UID.', 'error')
-                return render_template('appointment_form.html', patients=patients, doctors=doctors, user_role=user_role, current_patient_uid=current_patient_uid, form_data=request.form)
-
-            # Verify doctor_id exists and is a doctor
-            cur.execute("SELECT id FROM users WHERE id = %s AND role = 'doctor'", (doctor_id,))
-            if not cur.fetchone():
+            # Verify doctor_id is a doctor (from the directory, so this costs no query)
+            if user_role == 'patient' and get_doctor_directory().get(doctor_id) is None:
                 flash('Invalid Doctor selection.', 'error')
-                return render_template('appointment_form.html', patients=patients, doctors=doctors, user_role=user_role, current_patient_uid=current_patient_uid, form_data=request.form)
+                return render_template('appointment_form.html', doctors=doctors, specializations=specializations, user_role=user_role, current_patient_uid=current_patient_uid, form_data=request.form)
 
+            with transaction() as cur:
+                # Verify patient_uid exists
+                cur.execute("SELECT uid FROM patients WHERE uid = %s", (patient_uid,))
+                if not cur.fetchone():
+                    flash('Invalid Patient UID.', 'error')
+                    return render_template('appointment_form.html', doctors=doctors, specializations=specializations, user_role=user_role, current_patient_uid=current_patient_uid, form_data=request.form)
 
-            cur.execute(
-                """INSERT INTO appointments (patient_uid, doctor_id, appointment_date, reason, status)
-                   VALUES (%s, %s, %s, %s, 'scheduled')""",
-                (patient_uid, doctor_id, appointment_date, reason)
-            )
-            conn.commit()
-            flash('Appointment created successfully!', 'success')
-            return redirect(url_for('appointment.manage_appointments'))
+                try:
+                    # The exclusion constraint rejects overlapping bookings (see backend/scheduling.py)
+                    book_appointment(cur, patient_uid, doctor_id, appointment_date, reason)
+                except SlotUnavailable:
+                    free_slots = next_free_slots(cur, doctor_id, after=appointment_date,
+                                                 count=current_app.config['APPOINTMENT_FREE_SLOTS'],
+                                                 search_days=current_app.config['APPOINTMENT_SEARCH_DAYS'])
+                    flash('The doctor already has an appointment at that time. Please pick another time.', 'error')
+                    return render_template('appointment_form.html', doctors=doctors, specializations=specializations, user_role=user_role, current_patient_uid=current_patient_uid, form_data=request.form, free_slots=free_slots)
+                invalidate_doctor_roster(doctor_id) # The patient may be new to this doctor
+                schedule_report_render(patient_uid) # The report lists appointments too
+                flash('Appointment created successfully!', 'success')
+                return redirect(url_for('appointment.manage_appointments'))
         except psycopg2.Error as e:
             flash(f'An error occurred: {e}', 'error')
-            conn.rollback()
-        finally:
-            if conn:
-                cur.close()
-                conn.close()
 
     return render_template(
         'appointment_form.html',
-        patients=patients,
         doctors=doctors,
+        specializations=specializations,
+        specialization=specialization,
         user_role=user_role,
-        current_patient_uid=current_patient_uid
+        current_patient_uid=current_patient_uid,
+        form_data=request.args if request.args.get('appointment_date') else None # Prefilled from the availability calendar
     )
 
+def _parse_month(value):
+    """
+    First and last day of a 'YYYY-MM' month (the current month if empty). Raises ValueError if
+    malformed or outside 1900-9998, which keeps the previous/next month links within date's range.
+    """
+    first_day = datetime.strptime(value, '%Y-%m').date() if value else date.today().replace(day=1)
+    if not 1900 <= first_day.year <= 9998:
+        raise ValueError(f"Month out of range: {value}")
+    last_day = (first_day + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return first_day, last_day
+
+@appointment_bp.route('/appointments/availability')
+def availability():
+    """
+    Month calendar of free appointment times for one or more doctors
+    (?doctor_id=&doctor_id=...&month=YYYY-MM, or ?specialization= for every doctor of one).
+    Add format=json for a JSON answer.
+    """
+    if 'user_id' not in session:
+        flash('Please log in to access this page.', 'warning')
+        return redirect(url_for('auth.login'))
+
+    try:
+        first_day, last_day = _parse_month(request.args.get('month'))
+    except ValueError:
+        first_day, last_day = _parse_month(None)
+
+    # Deduplicated and capped before any lookups, so a long query string can't fan out into queries
+    doctor_ids = list(dict.fromkeys(request.args.getlist('doctor_id', type=int)))[:MAX_CALENDAR_DOCTORS]
+    doctors = []
+    calendar = {} # doctor id -> [(day, [free start times])]
+    try:
+        directory = get_doctor_directory()
+        if session['role'] == 'doctor':
+            doctors = [directory.get(session['user_id'])]
+        elif doctor_ids:
+            doctors = [directory.get(doctor_id) for doctor_id in doctor_ids]
+        else:
+            doctors = directory.by_specialization(request.args.get('specialization'))
+        doctors = [doctor for doctor in doctors if doctor is not None][:MAX_CALENDAR_DOCTORS]
+
+        hours = working_hours()
+        with transaction() as cur:
+            # Every doctor and day in one query, from the precomputed bitmaps
+            days = fetch_availability(cur, [doctor.id for doctor in doctors], first_day, last_day, hours)
+        now = datetime.now()
+        for day in days:
+            calendar.setdefault(day.doctor_id, []).append((day.day, free_start_times(day, hours.slot_minutes, after=now)))
+    except psycopg2.Error as e:
+        if request.args.get('format') == 'json':
+            return jsonify(error=f'Error fetching availability: {e}'), 500
+        flash(f"Error fetching availability: {e}", 'error')
+
+    if request.args.get('format') == 'json':
+        return jsonify(
+            month=first_day.strftime('%Y-%m'),
+            doctors=[{
+                'id': doctor.id,
+                'name': doctor.name or doctor.username,
+                'specialization': doctor.specialization,
+                'days': {day.isoformat(): [start.strftime('%H:%M') for start in starts]
+                         for day, starts in calendar.get(doctor.id, [])},
+            } for doctor in doctors]
+        )
+
+    return render_template(
+        'availability.html',
+        doctors=doctors,
+        calendar=calendar,
+        month=first_day,
+        previous_month=(first_day - timedelta(days=1)).strftime('%Y-%m'),
+        next_month=(last_day + timedelta(days=1)).strftime('%Y-%m'),
+        specialization=request.args.get('specialization', ''),
+        doctor_ids=doctor_ids,
+        user_role=session['role']
+    )
+
+@appointment_bp.route('/appointments/free_slots')
+def free_slots():
+    """Returns the next free appointment slots of a doctor as JSON (?doctor_id=&after=YYYY-MM-DDTHH:MM&count=)."""
+    if 'user_id' not in session:
+        return jsonify(error='Please log in to access this page.'), 401
+
+    doctor_id = session['user_id'] if session['role'] == 'doctor' else request.args.get('doctor_id', type=int)
+    count = min(max(request.args.get('count', current_app.config['APPOINTMENT_FREE_SLOTS'], type=int), 1), 50)
+    try:
+        after = datetime.fromisoformat(request.args['after']) if request.args.get('after') else None
+    except ValueError:
+        return jsonify(error='Invalid start time.'), 400
+    if after is not None and after.tzinfo is not None:
+        # Appointment times are naive local times; comparing them with an offset raises TypeError
+        return jsonify(error='Invalid start time: leave out the time zone offset.'), 400
+
+    try:
+        if get_doctor_directory().get(doctor_id) is None:
+            return jsonify(error='Unknown doctor.'), 404
+        with transaction() as cur:
+            slots = next_free_slots(cur, doctor_id, after=after, count=count,
+                                    search_days=current_app.config['APPOINTMENT_SEARCH_DAYS'])
+    except psycopg2.Error as e:
+        return jsonify(error=f'Error fetching free slots: {e}'), 500
+
+    return jsonify(doctor_id=doctor_id, slots=[slot.isoformat(timespec='minutes') for slot in slots])
+
 @appointment_bp.route('/cancel_appointment/<int:appointment_id>')
+@privileged
 def cancel_appointment(appointment_id):
     """Allows users to cancel an appointment."""
     if 'user_id' not in session:
@@ -167,47 +291,37 @@ def cancel_appointment(appointment_id):
     user_id = session['user_id']
     user_role = session['role']
 
-    conn = get_db_connection()
-    if conn is None:
-        flash('Database connection error. Please try again later.', 'error')
-        return redirect(url_for('appointment.manage_appointments'))
-
-    cur = conn.cursor()
     try:
-        # Check ownership before canceling
-        if user_role == 'patient':
-            cur.execute("SELECT patient_uid FROM appointments WHERE id = %s", (appointment_id,))
-            appointment_patient_uid = cur.fetchone()
-            if not appointment_patient_uid:
-                flash('Appointment not found.', 'error')
-                return redirect(url_for('appointment.manage_appointments'))
+        with transaction() as cur:
+            # Check ownership before canceling
+            if user_role == 'patient':
+                cur.execute("SELECT patient_uid FROM appointments WHERE id = %s", (appointment_id,))
+                appointment_patient_uid = cur.fetchone()
+                if not appointment_patient_uid:
+                    flash('Appointment not found.', 'error')
+                    return redirect(url_for('appointment.manage_appointments'))
 
-            cur.execute("SELECT uid FROM patients WHERE user_id = %s", (user_id,))
-            current_patient_uid = cur.fetchone()
+                cur.execute("SELECT uid FROM patients WHERE user_id = %s", (user_id,))
+                current_patient_uid = cur.fetchone()
 
-            if not current_patient_uid or appointment_patient_uid[0] != current_patient_uid[0]:
-                flash('You do not have permission to cancel this appointment.', 'error')
-                return redirect(url_for('appointment.manage_appointments'))
+                if not current_patient_uid or appointment_patient_uid[0] != current_patient_uid[0]:
+                    flash('You do not have permission to cancel this appointment.', 'error')
+                    return redirect(url_for('appointment.manage_appointments'))
 
-        elif user_role == 'doctor':
-            cur.execute("SELECT doctor_id FROM appointments WHERE id = %s", (appointment_id,))
-            appointment_doctor_id = cur.fetchone()
-            if not appointment_doctor_id or appointment_doctor_id[0] != user_id:
-                flash('You do not have permission to cancel this appointment.', 'error')
-                return redirect(url_for('appointment.manage_appointments'))
+            elif user_role == 'doctor':
+                cur.execute("SELECT doctor_id FROM appointments WHERE id = %s", (appointment_id,))
+                appointment_doctor_id = cur.fetchone()
+                if not appointment_doctor_id or appointment_doctor_id[0] != user_id:
+                    flash('You do not have permission to cancel this appointment.', 'error')
+                    return redirect(url_for('appointment.manage_appointments'))
 
-        cur.execute(
-            "UPDATE appointments SET status = 'cancelled' WHERE id = %s",
-            (appointment_id,)
-        )
-        conn.commit()
-        flash('Appointment cancelled successfully!', 'success')
+            cur.execute(
+                "UPDATE appointments SET status = 'cancelled' WHERE id = %s RETURNING patient_uid",
+                (appointment_id,)
+            )
+            schedule_report_render(cur.fetchone()[0]) # The report lists appointments too
+            flash('Appointment cancelled successfully!', 'success')
     except psycopg2.Error as e:
         flash(f"Error cancelling appointment: {e}", 'error')
-        conn.rollback()
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
 
     return redirect(url_for('appointment.manage_appointments'))
@@ -1,11 +1,18 @@
+import secrets
 import uuid
 import psycopg2
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
-from backend.models import get_db_connection, hash_password, check_password
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, current_app
+from backend.models import transaction
+from backend.passwords import get_password_hasher, PasswordHashingBusy
+from backend.ratelimit import get_login_limiter
+from backend.doctors import invalidate_doctor_directory
+from backend.sessions import revoke_session
 
 # Create a Blueprint for authentication routes
 auth_bp = Blueprint('auth', __name__)
 
+BUSY_MESSAGE = 'The server is busy right now. Please try again in a few seconds.'
+
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
     """Handles user login."""
@@ -24,22 +31,30 @@ def login():
         username = request.form['username']
         password = request.form['password']
 
-        conn = get_db_connection()
-        if conn is None:
-            flash('Database connection error. Please try again later.', 'error')
-            return render_template('login.html', target_role=target_role) # Pass role back on error
+        limiter = get_login_limiter()
+        if limiter:
+            retry_after = limiter.check(username, request.remote_addr)
+            if retry_after:
+                # Throttled: answer before looking up the user or checking the password
+                flash('Too many failed login attempts. Please wait a few minutes and try again.', 'error')
+                return render_template('login.html', target_role=target_role), 429, {'Retry-After': str(retry_after)}
 
-        cur = conn.cursor()
         try:
-            cur.execute("SELECT id, username, password, role FROM users WHERE username = %s", (username,))
-            user = cur.fetchone()
-            cur.close()
-            conn.close()
-
-            if user and check_password(user[2], password): # Use check_password from models
+            with transaction() as cur:
+                cur.execute("SELECT id, username, password, role FROM users WHERE username = %s", (username,))
+                user = cur.fetchone()
+
+            hasher = get_password_hasher()
+            if user and hasher.verify(user[2], password): # Runs in the hashing pool
+                if hasher.needs_rehash(user[2]):
+                    # Hashed with an older PASSWORD_HASH_METHOD: upgrade it without delaying the login
+                    hasher.rehash_later(current_app._get_current_object(), user[0], user[2], password)
+                if limiter:
+                    limiter.record_success(username)
                 session['user_id'] = user[0]
                 session['username'] = user[1]
                 session['role'] = user[3] # The actual role from the DB
+                session['session_id'] = secrets.token_urlsafe(16) # Identifies this login, so it can be revoked at logout
 
                 flash(f'Logged in successfully as {session["role"]}!', 'success')
                 if session['role'] == 'patient':
@@ -47,13 +62,14 @@ def login():
                 elif session['role'] == 'doctor':
                     return redirect(url_for('doctor.doctor_dashboard'))
             else:
+                if limiter:
+                    limiter.record_failure(username, request.remote_addr)
                 flash('Invalid username or password.', 'error')
+        except PasswordHashingBusy:
+            flash(BUSY_MESSAGE, 'error')
+            return render_template('login.html', target_role=target_role), 503, {'Retry-After': '5'}
         except psycopg2.Error as e:
             flash(f'An error occurred during login: {e}', 'error')
-            conn.rollback() # Rollback any potential incomplete transactions
-        finally:
-            if conn:
-                conn.close()
 
     return render_template('login.html', target_role=target_role)
 
@@ -86,90 +102,76 @@ def register():
         emergency_contact_phone = request.form.get('emergency_contact_phone')
 
 
-        conn = get_db_connection()
-        if conn is None:
-            flash('Database connection error. Please try again later.', 'error')
-            # Pass form data back to template on error
-            return render_template(
-                'register.html',
-                form_data=request.form,
-                target_role=user_role # Use the role from the form submission
-            )
-
-        cur = conn.cursor()
         try:
-            # Check if username already exists
-            cur.execute("SELECT id FROM users WHERE username = %s", (username,))
-            if cur.fetchone():
-                flash('Username already exists. Please choose a different one.', 'error')
-                return render_template(
-                    'register.html',
-                    form_data=request.form,
-                    target_role=user_role
-                )
-
-            hashed_password = hash_password(password)
+            # Hash before opening the transaction, so no pooled connection waits on it
+            hashed_password = get_password_hasher().hash(password)
+        except PasswordHashingBusy:
+            flash(BUSY_MESSAGE, 'error')
+            return render_template('register.html', form_data=request.form, target_role=user_role), 503, {'Retry-After': '5'}
 
-            # Insert into users table
-            cur.execute(
-                "INSERT INTO users (username, password, role) VALUES (%s, %s, %s) RETURNING id",
-                (username, hashed_password, user_role)
-            )
-            user_id = cur.fetchone()[0]
-
-            if user_role == 'patient':
-                # Generate a unique patient ID (UUID)
-                patient_uid = str(uuid.uuid4())
-                # Insert into patients table
-                cur.execute(
-                    """INSERT INTO patients (uid, user_id, name, date_of_birth, gender, contact_info,
-                                           emergency_contact_name, emergency_contact_relationship, emergency_contact_phone)
-                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-                    (patient_uid, user_id, name, date_of_birth, gender, contact_info,
-                     emergency_contact_name, emergency_contact_relationship, emergency_contact_phone)
-                )
-                conn.commit()
-                flash('Patient registration successful! You can now log in.', 'success')
-                return redirect(url_for('auth.login', role='patient'))
-
-            elif user_role == 'doctor':
-                # Check for unique license number for doctors
-                cur.execute("SELECT id FROM doctors WHERE license_number = %s", (license_number,))
+        try:
+            with transaction() as cur:
+                # Check if username already exists
+                cur.execute("SELECT id FROM users WHERE username = %s", (username,))
                 if cur.fetchone():
-                    # Rollback user creation as doctor details cannot be added
-                    conn.rollback()
-                    flash('Medical license number already registered. Please use a unique one.', 'error')
+                    flash('Username already exists. Please choose a different one.', 'error')
                     return render_template(
                         'register.html',
                         form_data=request.form,
                         target_role=user_role
                     )
 
-                # Insert into doctors table
+                if user_role not in ('patient', 'doctor'):
+                    flash('Invalid registration role.', 'error')
+                    return render_template(
+                        'register.html',
+                        form_data=request.form,
+                        target_role='unknown'
+                    )
+
+                if user_role == 'doctor':
+                    # Check for unique license number before creating the user
+                    cur.execute("SELECT id FROM doctors WHERE license_number = %s", (license_number,))
+                    if cur.fetchone():
+                        flash('Medical license number already registered. Please use a unique one.', 'error')
+                        return render_template(
+                            'register.html',
+                            form_data=request.form,
+                            target_role=user_role
+                        )
+
+                # Insert into users table
                 cur.execute(
-                    """INSERT INTO doctors (user_id, name, specialization, license_number, contact_info)
-                       VALUES (%s, %s, %s, %s, %s)""",
-                    (user_id, name, specialization, license_number, contact_info)
-                )
-                conn.commit()
-                flash('Doctor registration successful! You can now log in.', 'success')
-                return redirect(url_for('auth.login', role='doctor'))
-            else:
-                flash('Invalid registration role.', 'error')
-                conn.rollback() # Rollback user creation
-                return render_template(
-                    'register.html',
-                    form_data=request.form,
-                    target_role='unknown'
+                    "INSERT INTO users (username, password, role) VALUES (%s, %s, %s) RETURNING id",
+                    (username, hashed_password, user_role)
                 )
+                user_id = cur.fetchone()[0]
+
+                if user_role == 'patient':
+                    # Generate a unique patient ID (UUID)
+                    patient_uid = str(uuid.uuid4())
+                    # Insert into patients table
+                    cur.execute(
+                        """INSERT INTO patients (uid, user_id, name, date_of_birth, gender, contact_info,
+                                               emergency_contact_name, emergency_contact_relationship, emergency_contact_phone)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                        (patient_uid, user_id, name, date_of_birth, gender, contact_info,
+                         emergency_contact_name, emergency_contact_relationship, emergency_contact_phone)
+                    )
+                else:
+                    # Insert into doctors table
+                    cur.execute(
+                        """INSERT INTO doctors (user_id, name, specialization, license_number, contact_info)
+                           VALUES (%s, %s, %s, %s, %s)""",
+                        (user_id, name, specialization, license_number, contact_info)
+                    )
+                    invalidate_doctor_directory() # New doctors can be booked right away
+
+            flash(f'{user_role.capitalize()} registration successful! You can now log in.', 'success')
+            return redirect(url_for('auth.login', role=user_role))
 
         except psycopg2.Error as e:
             flash(f'An error occurred during registration: {e}', 'error')
-            conn.rollback() # Rollback any potential incomplete transactions
-        finally:
-            if conn:
-                cur.close()
-                conn.close()
 
     # Initial GET request (or error re-render)
     # Determine the title and default fields based on target_role from URL args
@@ -188,6 +190,11 @@ def register():
 @auth_bp.route('/logout')
 def logout():
     """Logs out the current user."""
+    try:
+        revoke_session() # Cookie sessions: stop copies of this cookie from being used for privileged actions
+    except psycopg2.Error as e:
+        print(f"Error revoking session: {e}")
+    session.pop('session_id', None)
     session.pop('user_id', None)
     session.pop('username', None)
     session.pop('role', None)
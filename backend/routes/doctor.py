@@ -1,6 +1,12 @@
 import psycopg2
-from flask import Blueprint, render_template, session, flash, redirect, url_for, request
-from backend.models import get_db_connection, hash_password
+from flask import Blueprint, render_template, session, flash, redirect, url_for, request, jsonify, get_template_attribute, current_app
+from backend.models import transaction, fetch_patient_overview, search_patients, fetch_patient, structure_medical_record
+from backend.passwords import get_password_hasher, PasswordHashingBusy
+from backend.onboarding import onboard_patients, OnboardingRejected, PATIENT_COLUMNS
+from backend.reports import schedule_report_render
+from backend.roster import get_doctor_roster, invalidate_doctor_roster
+from backend.scheduling import fetch_working_hours, save_working_hours, working_hours
+from backend.sessions import privileged
 from datetime import datetime
 import uuid # For generating patient UIDs
 
@@ -17,79 +23,92 @@ def doctor_dashboard():
     # Initialize variables for patient search results
     searched_uid = None
     patient_info = None
-    medical_records = []
-    appointments = []
+    summary = None # Allergies/medications/conditions cards
     message = None
+    roster_count = None
+    roster_page = None
 
     # Check if this request is a redirect from a search
     if request.method == 'GET' and 'uid_search' in request.args:
         searched_uid = request.args.get('uid_search')
         # If there's a UID in the query, perform the lookup logic here
         if searched_uid:
-            conn = get_db_connection()
-            if conn is None:
-                flash('Database connection error. Please try again later.', 'error')
-            else:
-                cur = conn.cursor()
-                try:
-                    # Fetch patient details including emergency contact
-                    cur.execute(
-                        """SELECT uid, name, date_of_birth, gender, contact_info,
-                                  emergency_contact_name, emergency_contact_relationship, emergency_contact_phone
-                           FROM patients WHERE uid = %s""",
-                        (searched_uid,)
-                    )
-                    patient_row = cur.fetchone()
-                    if patient_row:
-                        patient_info = {
-                            'uid': patient_row[0],
-                            'name': patient_row[1],
-                            'date_of_birth': patient_row[2],
-                            'gender': patient_row[3],
-                            'contact_info': patient_row[4],
-                            'emergency_contact_name': patient_row[5],
-                            'emergency_contact_relationship': patient_row[6],
-                            'emergency_contact_phone': patient_row[7]
-                        }
-
-                        # Fetch medical records for the patient
-                        cur.execute(
-                            """SELECT mr.record_date, mr.disease_history, mr.prescriptions, u.username AS doctor_username
-                               FROM medical_records mr
-                               JOIN users u ON mr.doctor_id = u.id
-                               WHERE mr.patient_uid = %s ORDER BY mr.record_date DESC""",
-                            (searched_uid,)
-                        )
-                        medical_records = cur.fetchall()
-
-                        cur.execute(
-                            """SELECT a.appointment_date, a.reason, a.status, u.username AS doctor_username
-                               FROM appointments a
-                               JOIN users u ON a.doctor_id = u.id
-                               WHERE a.patient_uid = %s ORDER BY a.appointment_date DESC""",
-                            (searched_uid,)
-                        )
-                        appointments = cur.fetchall()
-                    else:
-                        message = "No patient found with that UID."
-                except psycopg2.Error as e:
-                    flash(f"Error fetching patient details: {e}", 'error')
-                finally:
-                    if conn:
-                        cur.close()
-                        conn.close()
+            try:
+                with transaction() as cur:
+                    # Patient details and the clinical summary in one round trip; the history is in the PDF report
+                    overview = fetch_patient_overview(cur, searched_uid)
+                if overview:
+                    patient_info, summary = overview
+                else:
+                    message = "No patient found with that UID."
+            except psycopg2.Error as e:
+                flash(f"Error fetching patient details: {e}", 'error')
+
+    try:
+        # "My patients": count and first page come from the per-doctor cache
+        roster_count, roster_page = get_doctor_roster().first_page(session['user_id'])
+    except psycopg2.Error as e:
+        flash(f"Error fetching your patients: {e}", 'error')
 
     return render_template(
         'doctor_dashboard.html',
         username=session['username'],
         searched_uid=searched_uid,
         patient_info=patient_info,
-        medical_records=medical_records,
-        appointments=appointments,
+        summary=summary,
+        roster_count=roster_count,
+        roster_page=roster_page,
         message=message
     )
 
+@doctor_bp.route('/doctor/patients')
+def doctor_patient_roster():
+    """Returns the next page of the doctor's own patients as an HTML fragment (JSON-wrapped)."""
+    if 'user_id' not in session or session['role'] != 'doctor':
+        return jsonify(error='Unauthorized access.'), 401
+
+    cursor = request.args.get('cursor')
+    try:
+        if cursor:
+            page = get_doctor_roster().page(session['user_id'], cursor)
+        else:
+            _, page = get_doctor_roster().first_page(session['user_id'])
+    except ValueError:
+        return jsonify(error='Invalid page cursor.'), 400
+    except psycopg2.Error as e:
+        return jsonify(error=f'Error fetching your patients: {e}'), 500
+
+    roster_items = get_template_attribute('_roster_items.html', 'roster_items')
+    return jsonify(fragments={'roster': str(roster_items(page.items))}, next_cursor=page.next_cursor)
+
+@doctor_bp.route('/doctor/patients/search')
+def doctor_patient_search():
+    """Typeahead search over patients by name, phone number or date of birth. Returns JSON."""
+    if 'user_id' not in session or session['role'] != 'doctor':
+        return jsonify(error='Unauthorized access.'), 401
+
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', current_app.config['PATIENT_SEARCH_LIMIT'], type=int)
+    limit = max(1, min(limit, current_app.config['PATIENT_SEARCH_MAX_LIMIT']))
+    try:
+        with transaction() as cur:
+            matches = search_patients(cur, query, limit)
+    except psycopg2.Error as e:
+        return jsonify(error=f'Error searching patients: {e}'), 500
+
+    return jsonify(
+        query=query,
+        results=[{
+            'uid': match.uid,
+            'name': match.name,
+            'date_of_birth': match.date_of_birth.isoformat() if match.date_of_birth else None,
+            'contact_info': match.contact_info,
+            'url': url_for('doctor.doctor_dashboard', uid_search=match.uid)
+        } for match in matches]
+    )
+
 @doctor_bp.route('/doctor_initiate_new_patient', methods=['POST'])
+@privileged
 def doctor_initiate_new_patient():
     """Handles the initial UID check for new patient registration by a doctor."""
     if 'user_id' not in session or session['role'] != 'doctor':
@@ -101,27 +120,18 @@ def doctor_initiate_new_patient():
         flash('Please enter a UID for the new patient.', 'error')
         return redirect(url_for('doctor.doctor_dashboard'))
 
-    conn = get_db_connection()
-    if conn is None:
-        flash('Database connection error. Please try again later.', 'error')
-        return redirect(url_for('doctor.doctor_dashboard'))
-
-    cur = conn.cursor()
     try:
-        # Check if UID already exists in patients table
-        cur.execute("SELECT uid FROM patients WHERE uid = %s", (new_patient_uid,))
-        if cur.fetchone():
-            flash(f'Patient with UID "{new_patient_uid}" already exists. Please use "Existing Patient Management" or choose a different UID.', 'error')
-            return redirect(url_for('doctor.doctor_dashboard', uid_search=new_patient_uid)) # Redirect to dashboard, show existing patient
-
-        # If UID is unique, proceed to the detailed registration form
-        return redirect(url_for('doctor.doctor_register_new_patient_form', patient_uid=new_patient_uid))
+        with transaction() as cur:
+            # Check if UID already exists in patients table
+            cur.execute("SELECT uid FROM patients WHERE uid = %s", (new_patient_uid,))
+            if cur.fetchone():
+                flash(f'Patient with UID "{new_patient_uid}" already exists. Please use "Existing Patient Management" or choose a different UID.', 'error')
+                return redirect(url_for('doctor.doctor_dashboard', uid_search=new_patient_uid)) # Redirect to dashboard, show existing patient
+
+            # If UID is unique, proceed to the detailed registration form
+            return redirect(url_for('doctor.doctor_register_new_patient_form', patient_uid=new_patient_uid))
     except psycopg2.Error as e:
         flash(f'Database error: {e}', 'error')
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
     return redirect(url_for('doctor.doctor_dashboard'))
 
 
@@ -138,24 +148,20 @@ def doctor_register_new_patient_form():
         return redirect(url_for('doctor.doctor_dashboard'))
 
     # Check if the UID might have been registered in another tab/process
-    conn = get_db_connection()
-    if conn:
-        cur = conn.cursor()
-        try:
+    try:
+        with transaction() as cur:
             cur.execute("SELECT uid FROM patients WHERE uid = %s", (patient_uid,))
             if cur.fetchone():
                 flash(f'Patient with UID "{patient_uid}" already exists. Cannot register again.', 'error')
                 return redirect(url_for('doctor.doctor_dashboard', uid_search=patient_uid))
-        except psycopg2.Error as e:
-            flash(f'Database error: {e}', 'error')
-        finally:
-            cur.close()
-            conn.close()
+    except psycopg2.Error as e:
+        flash(f'Database error: {e}', 'error')
 
     return render_template('doctor_new_patient_form.html', patient_uid=patient_uid)
 
 
 @doctor_bp.route('/doctor_complete_new_patient_registration', methods=['POST'])
+@privileged
 def doctor_complete_new_patient_registration():
     """Handles the submission of a new patient's details by a doctor."""
     if 'user_id' not in session or session['role'] != 'doctor':
@@ -175,154 +181,224 @@ def doctor_complete_new_patient_registration():
     # For simplicity, assign a default username/password for doctor-registered patients
     username = patient_uid # Use UID as username for simplicity for doctor-added patients
     password = str(uuid.uuid4()) # Generate a random password, not given to patient directly
-    hashed_password = hash_password(password) # Hash this generated password
-
-    conn = get_db_connection()
-    if conn is None:
-        flash('Database connection error. Please try again later.', 'error')
-        return render_template('doctor_new_patient_form.html', form_data=request.form, patient_uid=patient_uid)
+    try:
+        hashed_password = get_password_hasher().hash(password) # Hash this generated password
+    except PasswordHashingBusy:
+        flash('The server is busy right now. Please try again in a few seconds.', 'error')
+        return render_template('doctor_new_patient_form.html', form_data=request.form, patient_uid=patient_uid), 503
 
-    cur = conn.cursor()
     try:
-        # Re-check if UID already exists (race condition check)
-        cur.execute("SELECT uid FROM patients WHERE uid = %s", (patient_uid,))
-        if cur.fetchone():
-            flash(f'Patient with UID "{patient_uid}" already exists. Cannot register again.', 'error')
-            return render_template('doctor_new_patient_form.html', form_data=request.form, patient_uid=patient_uid)
-
-        # Check if username exists (less critical for doctor-registered, but good practice)
-        cur.execute("SELECT id FROM users WHERE username = %s", (username,))
-        if cur.fetchone():
-            flash(f'Internal error: Generated username "{username}" already exists. Please try again.', 'error')
-            return render_template('doctor_new_patient_form.html', form_data=request.form, patient_uid=patient_uid)
-
-        # Insert into users table
-        cur.execute(
-            "INSERT INTO users (username, password, role) VALUES (%s, %s, 'patient') RETURNING id",
-            (username, hashed_password)
-        )
-        user_id = cur.fetchone()[0]
-
-        # Insert into patients table with new emergency contact fields
-        cur.execute(
-            """INSERT INTO patients (uid, user_id, name, date_of_birth, gender, contact_info,
-                                   emergency_contact_name, emergency_contact_relationship, emergency_contact_phone)
-               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-            (patient_uid, user_id, name, date_of_birth, gender, contact_info,
-             emergency_contact_name, emergency_contact_relationship, emergency_contact_phone)
-        )
-
-        conn.commit()
-        flash(f'Patient "{name}" registered successfully with UID: {patient_uid}. Now add initial consultation.', 'success')
-        # Redirect to add medical record with the new patient's UID pre-selected
-        return redirect(url_for('doctor.doctor_add_medical_record', patient_uid=patient_uid))
+        with transaction() as cur:
+            # Re-check if UID already exists (race condition check)
+            cur.execute("SELECT uid FROM patients WHERE uid = %s", (patient_uid,))
+            if cur.fetchone():
+                flash(f'Patient with UID "{patient_uid}" already exists. Cannot register again.', 'error')
+                return render_template('doctor_new_patient_form.html', form_data=request.form, patient_uid=patient_uid)
+
+            # Check if username exists (less critical for doctor-registered, but good practice)
+            cur.execute("SELECT id FROM users WHERE username = %s", (username,))
+            if cur.fetchone():
+                flash(f'Internal error: Generated username "{username}" already exists. Please try again.', 'error')
+                return render_template('doctor_new_patient_form.html', form_data=request.form, patient_uid=patient_uid)
+
+            # Insert into users table
+            cur.execute(
+                "INSERT INTO users (username, password, role) VALUES (%s, %s, 'patient') RETURNING id",
+                (username, hashed_password)
+            )
+            user_id = cur.fetchone()[0]
+
+            # Insert into patients table with new emergency contact fields and the registering doctor
+            cur.execute(
+                """INSERT INTO patients (uid, user_id, name, date_of_birth, gender, contact_info,
+                                       emergency_contact_name, emergency_contact_relationship, emergency_contact_phone,
+                                       registered_by)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                (patient_uid, user_id, name, date_of_birth, gender, contact_info,
+                 emergency_contact_name, emergency_contact_relationship, emergency_contact_phone,
+                 session['user_id'])
+            )
+
+            flash(f'Patient "{name}" registered successfully with UID: {patient_uid}. Now add initial consultation.', 'success')
+            # Redirect to add medical record with the new patient's UID pre-selected
+            return redirect(url_for('doctor.doctor_add_medical_record', patient_uid=patient_uid))
 
     except psycopg2.Error as e:
         flash(f'An error occurred during patient registration: {e}', 'error')
-        conn.rollback()
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
 
     return render_template('doctor_new_patient_form.html', form_data=request.form, patient_uid=patient_uid)
 
 
+@doctor_bp.route('/doctor/patients/import', methods=['GET', 'POST'])
+@privileged
+def doctor_import_patients():
+    """Registers many new patients at once from an uploaded CSV file."""
+    if 'user_id' not in session or session['role'] != 'doctor':
+        flash('Unauthorized access.', 'warning')
+        return redirect(url_for('auth.login'))
+
+    max_rows = current_app.config['PATIENT_IMPORT_MAX_ROWS']
+    if request.method == 'GET':
+        return render_template('doctor_import_patients.html', columns=PATIENT_COLUMNS, max_rows=max_rows)
+
+    upload = request.files.get('patients_file')
+    if upload is None or not upload.filename:
+        flash('Please choose a CSV file to upload.', 'error')
+        return render_template('doctor_import_patients.html', columns=PATIENT_COLUMNS, max_rows=max_rows)
+
+    try:
+        result = onboard_patients(upload.stream, session['user_id'], max_rows)
+    except OnboardingRejected as e:
+        flash(str(e), 'error')
+        return render_template('doctor_import_patients.html', columns=PATIENT_COLUMNS, max_rows=max_rows)
+    except PasswordHashingBusy:
+        flash('The server is busy right now. Please try again in a few seconds.', 'error')
+        return render_template('doctor_import_patients.html', columns=PATIENT_COLUMNS, max_rows=max_rows), 503
+    except psycopg2.Error as e:
+        flash(f'An error occurred during patient registration: {e}', 'error')
+        return render_template('doctor_import_patients.html', columns=PATIENT_COLUMNS, max_rows=max_rows)
+
+    if result.errors:
+        flash(f'{len(result.errors)} of {result.rows} rows need fixing. No patients were registered.', 'error')
+        return render_template('doctor_import_patients.html', columns=PATIENT_COLUMNS, max_rows=max_rows,
+                               errors=result.errors)
+    if not result.registered:
+        flash('The file has no patients in it.', 'warning')
+        return render_template('doctor_import_patients.html', columns=PATIENT_COLUMNS, max_rows=max_rows)
+
+    flash(f'{len(result.registered)} patients registered. You can print their emergency QR cards now.', 'success')
+    return redirect(url_for('qr_code.qr_sheet'))
+
+
 @doctor_bp.route('/doctor_edit_patient_details/<patient_uid>', methods=['GET', 'POST'])
+@privileged
 def doctor_edit_patient_details(patient_uid):
     """Allows a doctor to edit an existing patient's personal details."""
     if 'user_id' not in session or session['role'] != 'doctor':
         flash('Unauthorized access.', 'warning')
         return redirect(url_for('auth.login'))
 
-    conn = get_db_connection()
-    if conn is None:
-        flash('Database connection error. Please try again later.', 'error')
-        return redirect(url_for('doctor.doctor_dashboard'))
-
-    cur = conn.cursor()
     patient_data = None
 
     try:
-        # Fetch all patient details including emergency contact
-        cur.execute(
-            """SELECT uid, name, date_of_birth, gender, contact_info,
-                      emergency_contact_name, emergency_contact_relationship, emergency_contact_phone
-               FROM patients WHERE uid = %s""",
-            (patient_uid,)
-        )
-        patient_row = cur.fetchone()
-        if not patient_row:
-            flash('Patient not found.', 'error')
-            return redirect(url_for('doctor.doctor_dashboard'))
-
-        patient_data = {
-            'uid': patient_row[0],
-            'name': patient_row[1],
-            'date_of_birth': patient_row[2].isoformat() if patient_row[2] else '', # Format date for HTML input
-            'gender': patient_row[3],
-            'contact_info': patient_row[4],
-            'emergency_contact_name': patient_row[5],
-            'emergency_contact_relationship': patient_row[6],
-            'emergency_contact_phone': patient_row[7]
-        }
-
-        if request.method == 'POST':
-            name = request.form['name'] # Though name is not editable, it's passed for consistency if needed.
-            date_of_birth = request.form['date_of_birth']
-            gender = request.form['gender']
-            contact_info = request.form['contact_info']
-            # NEW: Emergency Contact Details from form
-            emergency_contact_name = request.form.get('emergency_contact_name')
-            emergency_contact_relationship = request.form.get('emergency_contact_relationship')
-            emergency_contact_phone = request.form.get('emergency_contact_phone')
-
+        with transaction() as cur:
+            # Fetch all patient details including emergency contact
             cur.execute(
-                """UPDATE patients SET name = %s, date_of_birth = %s, gender = %s, contact_info = %s,
-                                     emergency_contact_name = %s, emergency_contact_relationship = %s, emergency_contact_phone = %s
-                   WHERE uid = %s""",
-                (name, date_of_birth, gender, contact_info,
-                 emergency_contact_name, emergency_contact_relationship, emergency_contact_phone,
-                 patient_uid)
+                """SELECT uid, name, date_of_birth, gender, contact_info,
+                          emergency_contact_name, emergency_contact_relationship, emergency_contact_phone
+                   FROM patients WHERE uid = %s""",
+                (patient_uid,)
             )
-            conn.commit()
-            flash('Patient details updated successfully!', 'success')
-            return redirect(url_for('doctor.doctor_dashboard', uid_search=patient_uid)) # Redirect to dashboard with updated info
+            patient_row = cur.fetchone()
+            if not patient_row:
+                flash('Patient not found.', 'error')
+                return redirect(url_for('doctor.doctor_dashboard'))
+
+            patient_data = {
+                'uid': patient_row[0],
+                'name': patient_row[1],
+                'date_of_birth': patient_row[2].isoformat() if patient_row[2] else '', # Format date for HTML input
+                'gender': patient_row[3],
+                'contact_info': patient_row[4],
+                'emergency_contact_name': patient_row[5],
+                'emergency_contact_relationship': patient_row[6],
+                'emergency_contact_phone': patient_row[7]
+            }
+
+            if request.method == 'POST':
+                name = request.form['name'] # Though name is not editable, it's passed for consistency if needed.
+                date_of_birth = request.form['date_of_birth']
+                gender = request.form['gender']
+                contact_info = request.form['contact_info']
+                # NEW: Emergency Contact Details from form
+                emergency_contact_name = request.form.get('emergency_contact_name')
+                emergency_contact_relationship = request.form.get('emergency_contact_relationship')
+                emergency_contact_phone = request.form.get('emergency_contact_phone')
+
+                cur.execute(
+                    """UPDATE patients SET name = %s, date_of_birth = %s, gender = %s, contact_info = %s,
+                                         emergency_contact_name = %s, emergency_contact_relationship = %s, emergency_contact_phone = %s
+                       WHERE uid = %s""",
+                    (name, date_of_birth, gender, contact_info,
+                     emergency_contact_name, emergency_contact_relationship, emergency_contact_phone,
+                     patient_uid)
+                )
+                schedule_report_render(patient_uid) # Refresh the cached emergency report once committed
+                invalidate_doctor_roster() # Every roster listing this patient shows the old name
+                flash('Patient details updated successfully!', 'success')
+                return redirect(url_for('doctor.doctor_dashboard', uid_search=patient_uid)) # Redirect to dashboard with updated info
     except psycopg2.Error as e:
         flash(f'An error occurred during update: {e}', 'error')
-        conn.rollback()
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
 
     return render_template('doctor_edit_patient_details.html', patient_data=patient_data)
 
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'] # ISO weekdays 1-7
+
+@doctor_bp.route('/doctor/working_hours', methods=['GET', 'POST'])
+@privileged
+def doctor_working_hours():
+    """Lets a doctor set their weekly working hours, which bound the free times patients are offered."""
+    if 'user_id' not in session or session['role'] != 'doctor':
+        flash('Please log in as a doctor to access this page.', 'warning')
+        return redirect(url_for('auth.login'))
+
+    doctor_id = session['user_id']
+    hours = {}
+
+    if request.method == 'POST':
+        errors = []
+        for isodow, weekday in enumerate(WEEKDAYS, start=1):
+            start = request.form.get(f'start_{isodow}', '').strip()
+            end = request.form.get(f'end_{isodow}', '').strip()
+            if not start and not end:
+                continue # Day off
+            try:
+                start_time = datetime.strptime(start, '%H:%M').time()
+                end_time = datetime.strptime(end, '%H:%M').time()
+            except ValueError:
+                errors.append(f'{weekday}: enter both a start and an end time (HH:MM), or neither.')
+                continue
+            if end_time <= start_time:
+                errors.append(f'{weekday}: the end time must be after the start time.')
+                continue
+            hours[isodow] = (start_time, end_time)
+
+        if errors:
+            for error in errors:
+                flash(error, 'error')
+        else:
+            try:
+                with transaction() as cur:
+                    save_working_hours(cur, doctor_id, hours)
+                flash('Working hours saved.', 'success')
+                return redirect(url_for('doctor.doctor_working_hours'))
+            except psycopg2.Error as e:
+                flash(f'An error occurred: {e}', 'error')
+    else:
+        try:
+            with transaction() as cur:
+                hours = fetch_working_hours(cur, doctor_id)
+        except psycopg2.Error as e:
+            flash(f"Error fetching working hours: {e}", 'error')
+
+    return render_template(
+        'doctor_working_hours.html',
+        weekdays=list(enumerate(WEEKDAYS, start=1)),
+        hours=hours,
+        form_data=request.form if request.method == 'POST' else None,
+        default_hours=working_hours()
+    )
+
 @doctor_bp.route('/doctor_add_medical_record', methods=['GET', 'POST'])
+@privileged
 def doctor_add_medical_record():
     """Allows a doctor to add medical records for a patient."""
     if 'user_id' not in session or session['role'] != 'doctor':
         flash('Please log in as a doctor to access this page.', 'warning')
         return redirect(url_for('auth.login'))
 
-    patients = []
     preselected_patient_uid = request.args.get('patient_uid') # Get pre-selected UID from query param
-
-    conn = get_db_connection()
-    if conn is None:
-        flash('Database connection error. Please try again later.', 'error')
-        return render_template('prescription_form.html', patients=patients)
-
-    cur = conn.cursor()
-    try:
-        cur.execute("SELECT uid, name FROM patients ORDER BY name")
-        patients = cur.fetchall()
-    except psycopg2.Error as e:
-        flash(f"Error fetching patient list: {e}", 'error')
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
+    selected_patient = None # Shown next to the patient picker; patients are searched, never listed
 
     if request.method == 'POST':
         patient_uid = request.form['patient_uid']
@@ -331,38 +407,39 @@ def doctor_add_medical_record():
         prescriptions = request.form['prescriptions']
         doctor_id = session['user_id']
 
-        # Combine symptoms_diagnosis and allergies into disease_history with a clear separator
-        # This is a pragmatic solution given the current single 'disease_history' column.
-        # For a more robust solution, 'allergies' should be a separate column in the DB.
+        # Stored as structured columns (migration 0010); disease_history keeps the legacy packed
+        # format until every app node reads the new columns
         combined_disease_history = f"Symptoms & Diagnosis: {symptoms_diagnosis}\n--- Allergies: {allergies}"
+        allergy_list, medication_list, diagnoses = structure_medical_record(symptoms_diagnosis, allergies, prescriptions)
 
-        conn = get_db_connection()
-        if conn is None:
-            flash('Database connection error. Please try again later.', 'error')
-            return render_template('prescription_form.html', patients=patients, preselected_patient_uid=preselected_patient_uid, form_data=request.form)
-
-        cur = conn.cursor()
         try:
-            # Check if patient_uid exists
-            cur.execute("SELECT uid FROM patients WHERE uid = %s", (patient_uid,))
-            if not cur.fetchone():
-                flash('Patient with the provided UID does not exist. Please register the patient first.', 'error')
-                return render_template('prescription_form.html', patients=patients, form_data=request.form, preselected_patient_uid=preselected_patient_uid)
-
-            cur.execute(
-                """INSERT INTO medical_records (patient_uid, doctor_id, disease_history, prescriptions)
-                   VALUES (%s, %s, %s, %s)""",
-                (patient_uid, doctor_id, combined_disease_history, prescriptions) # Use combined string here
-            )
-            conn.commit()
-            flash('Medical record added successfully!', 'success')
-            return redirect(url_for('doctor.doctor_dashboard', uid_search=patient_uid)) # Redirect to search result
+            with transaction() as cur:
+                # Check if patient_uid exists
+                cur.execute("SELECT uid FROM patients WHERE uid = %s", (patient_uid,))
+                if not cur.fetchone():
+                    flash('Patient with the provided UID does not exist. Please register the patient first.', 'error')
+                    return render_template('prescription_form.html', form_data=request.form, preselected_patient_uid=preselected_patient_uid)
+
+                cur.execute(
+                    """INSERT INTO medical_records (patient_uid, doctor_id, disease_history, prescriptions,
+                                                   symptoms_diagnosis, allergies, allergy_list, medication_list, diagnoses)
+                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                    (patient_uid, doctor_id, combined_disease_history, prescriptions,
+                     symptoms_diagnosis.strip(), allergies.strip(), allergy_list, medication_list, diagnoses)
+                )
+                schedule_report_render(patient_uid) # Refresh the cached emergency report once committed
+                invalidate_doctor_roster(doctor_id) # The patient may be new to this doctor
+                flash('Medical record added successfully!', 'success')
+                return redirect(url_for('doctor.doctor_dashboard', uid_search=patient_uid)) # Redirect to search result
         except psycopg2.Error as e:
             flash(f'An error occurred: {e}', 'error')
-            conn.rollback()
-        finally:
-            if conn:
-                cur.close()
-                conn.close()
+        return render_template('prescription_form.html', form_data=request.form, preselected_patient_uid=preselected_patient_uid)
+
+    if preselected_patient_uid:
+        try:
+            with transaction() as cur:
+                selected_patient = fetch_patient(cur, preselected_patient_uid)
+        except psycopg2.Error as e:
+            flash(f"Error fetching patient details: {e}", 'error')
 
-    return render_template('prescription_form.html', patients=patients, preselected_patient_uid=preselected_patient_uid)
+    return render_template('prescription_form.html', preselected_patient_uid=preselected_patient_uid, selected_patient=selected_patient)
@@ -1,11 +1,19 @@
-import qrcode
 import base64
-import psycopg2
+import re
+import zipfile
 from io import BytesIO
-from flask import Blueprint, render_template, session, flash, redirect, url_for, send_file, current_app
+import psycopg2
+from flask import Blueprint, render_template, session, flash, redirect, url_for, send_file, current_app, request, abort
 from flask_weasyprint import HTML, render_pdf
-from backend.models import get_db_connection
-from datetime import datetime # Import datetime
+from werkzeug.http import is_resource_modified
+from werkzeug.utils import secure_filename
+from backend.models import transaction, fetch_patient_bundle
+from backend.reports import (
+    fetch_report_version, get_cached_report, store_report, render_report_pdf, get_report_prerenderer,
+    is_large_report, get_cached_report_file, render_report_file
+)
+from backend.qr_images import QR_MIMETYPES, get_qr_image, get_qr_images
+from backend.sessions import privileged
 
 # Create a Blueprint for QR code and PDF generation
 qr_bp = Blueprint('qr_code', __name__)
@@ -20,51 +28,200 @@ def generate_qr(patient_uid):
         flash('Unauthorized access.', 'warning')
         return redirect(url_for('auth.login'))
 
-    conn = get_db_connection()
-    if conn is None:
-        flash('Database connection error. Please try again later.', 'error')
-        return redirect(url_for('patient.patient_dashboard'))
-
-    cur = conn.cursor()
     current_patient_uid = None
     try:
-        # Verify if the logged-in patient owns this UID
-        cur.execute("SELECT uid FROM patients WHERE user_id = %s", (session['user_id'],))
-        current_patient_uid_row = cur.fetchone()
-        if not current_patient_uid_row or current_patient_uid_row[0] != patient_uid:
-            flash('You can only generate QR codes for your own patient ID.', 'error')
-            return redirect(url_for('patient.patient_dashboard'))
-        current_patient_uid = current_patient_uid_row[0] # Confirmed owned UID
+        with transaction() as cur:
+            # Verify if the logged-in patient owns this UID
+            cur.execute("SELECT uid FROM patients WHERE user_id = %s", (session['user_id'],))
+            current_patient_uid_row = cur.fetchone()
+            if not current_patient_uid_row or current_patient_uid_row[0] != patient_uid:
+                flash('You can only generate QR codes for your own patient ID.', 'error')
+                return redirect(url_for('patient.patient_dashboard'))
+            current_patient_uid = current_patient_uid_row[0] # Confirmed owned UID
     except psycopg2.Error as e:
         flash(f"Database error: {e}", 'error')
         return redirect(url_for('patient.patient_dashboard'))
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
 
     # Construct the URL that the QR code will point to
     # Make sure 'yourwebsite.com' is replaced with your actual domain in production
     # For local testing, it would be http://127.0.0.1:5000
     report_url = url_for('qr_code.emergency_report_download', patient_uid=patient_uid, _external=True)
 
-    # Generate QR code
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
+    # The image itself is served (and cached) by qr_image below instead of being inlined here
+    return render_template(
+        'qr_code_display.html',
+        qr_image_url=url_for('qr_code.qr_image', patient_uid=patient_uid, fmt='svg'),
+        qr_png_url=url_for('qr_code.qr_image', patient_uid=patient_uid, fmt='png'),
+        patient_uid=patient_uid,
+        report_url=report_url
     )
-    qr.add_data(report_url)
-    qr.make(fit=True)
 
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    qr_image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+def _can_view_qr(patient_uid):
+    """Patients may fetch their own QR code image; doctors may fetch any patient's (for printing)."""
+    if session.get('role') == 'doctor':
+        return True
+    if session.get('role') != 'patient':
+        return False
+    # The dashboard stores the patient's UID in the session; only hit the database without it
+    if 'patient_uid' in session:
+        return session['patient_uid'] == patient_uid
+    with transaction() as cur:
+        cur.execute("SELECT uid FROM patients WHERE user_id = %s", (session['user_id'],))
+        row = cur.fetchone()
+    return row is not None and row[0] == patient_uid
+
+@qr_bp.route('/qr/<patient_uid>.<fmt>')
+def qr_image(patient_uid, fmt):
+    """Serves a patient's QR code as PNG or SVG, with long-lived caching (the encoded URL never changes)."""
+    if fmt not in QR_MIMETYPES:
+        abort(404)
+    try:
+        if not _can_view_qr(patient_uid):
+            abort(403)
+    except psycopg2.Error as e:
+        print(f"Error checking QR code access: {e}")
+        return "Error checking access. Please try again later.", 500
+
+    report_url = url_for('qr_code.emergency_report_download', patient_uid=patient_uid, _external=True)
+    image, etag = get_qr_image(report_url, fmt)
 
-    return render_template('qr_code_display.html', qr_image=qr_image_base64, patient_uid=patient_uid, report_url=report_url)
+    response = current_app.response_class(image, mimetype=QR_MIMETYPES[fmt])
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['QR_IMAGE_MAX_AGE']
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+def _parse_patient_uids(text):
+    """Splits a pasted list of UIDs (newlines, commas or spaces), keeping order and dropping duplicates."""
+    uids = []
+    for uid in re.split(r'[\s,]+', text or ''):
+        if uid and uid not in uids:
+            uids.append(uid)
+    return uids
+
+@qr_bp.route('/qr_sheet', methods=['GET', 'POST'])
+@privileged
+def qr_sheet():
+    """
+    Lets a doctor print emergency QR cards for many patients at once: either a list of
+    UIDs or every patient they registered, as one PDF sheet or a ZIP of PNGs.
+    """
+    if 'user_id' not in session or session['role'] != 'doctor':
+        flash('Please log in as a doctor to access this page.', 'warning')
+        return redirect(url_for('auth.login'))
+
+    max_patients = current_app.config['QR_SHEET_MAX_PATIENTS']
+    if request.method == 'GET':
+        return render_template('qr_sheet_form.html', max_patients=max_patients)
+
+    scope = request.form.get('scope', 'mine')
+    output = request.form.get('output', 'pdf')
+    patients = []
+
+    try:
+        with transaction() as cur:
+            if scope == 'mine':
+                cur.execute(
+                    "SELECT uid, name FROM patients WHERE registered_by = %s ORDER BY name LIMIT %s",
+                    (session['user_id'], max_patients + 1)
+                )
+                patients = cur.fetchall()
+            else:
+                uids = _parse_patient_uids(request.form.get('patient_uids'))
+                cur.execute("SELECT uid, name FROM patients WHERE uid = ANY(%s)", (uids[:max_patients + 1],))
+                found = dict(cur.fetchall())
+                unknown = [uid for uid in uids if uid not in found]
+                if unknown:
+                    flash(f"Unknown patient UIDs skipped: {', '.join(unknown[:20])}", 'warning')
+                patients = [(uid, found[uid]) for uid in uids if uid in found] # Keep the order given
+    except psycopg2.Error as e:
+        flash(f"Error fetching patients: {e}", 'error')
+        return render_template('qr_sheet_form.html', max_patients=max_patients, form_data=request.form)
 
+    if not patients:
+        flash('No patients to print.', 'error')
+        return render_template('qr_sheet_form.html', max_patients=max_patients, form_data=request.form)
+    if len(patients) > max_patients:
+        flash(f'At most {max_patients} patients can be printed at once.', 'error')
+        return render_template('qr_sheet_form.html', max_patients=max_patients, form_data=request.form)
+
+    report_urls = [
+        url_for('qr_code.emergency_report_download', patient_uid=uid, _external=True)
+        for uid, _ in patients
+    ]
+
+    if output == 'zip':
+        images = get_qr_images(report_urls, 'png')
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive: # PNGs are already compressed
+            for (uid, _), (image, _) in zip(patients, images):
+                archive.writestr(f"qr_{secure_filename(uid) or 'patient'}.png", image)
+        buffer.seek(0)
+        return send_file(buffer, mimetype='application/zip', as_attachment=True, download_name='qr_cards.zip')
+
+    # SVG keeps the codes sharp in print and skips PIL; all cards go through one WeasyPrint render
+    images = get_qr_images(report_urls, 'svg')
+    cards = [
+        (patient, 'data:image/svg+xml;base64,' + base64.b64encode(image).decode('ascii'))
+        for patient, (image, _) in zip(patients, images)
+    ]
+    html = render_template('qr_sheet.html', cards=cards)
+    return render_pdf(HTML(string=html), download_filename='qr_cards.pdf')
+
+def _report_pdf_bytes(patient_uid, version):
+    """Returns the report as bytes: cached, from an in-flight background render, or rendered here."""
+    pdf = get_cached_report(patient_uid, version)
+
+    # Cache miss right after an edit: the background render of this version is probably
+    # in flight, so wait for it briefly rather than rendering the same PDF twice.
+    prerenderer = get_report_prerenderer()
+    if pdf is None and prerenderer is not None:
+        pdf = prerenderer.wait(patient_uid, version, current_app.config['REPORT_PRERENDER_WAIT'])
+
+    if pdf is None:
+        with transaction() as cur:
+            bundle = fetch_patient_bundle(cur, patient_uid=patient_uid)
+        if bundle is None:
+            return None
+        # Rendered outside the transaction so it isn't held open during WeasyPrint
+        pdf = render_report_pdf(bundle)
+        store_report(patient_uid, version, pdf)
+    return pdf
+
+def _open_report_file(path):
+    """Opens a cached report PDF, or returns None if it is gone (a newer version's render removes old files)."""
+    if path is None:
+        return None
+    try:
+        return open(path, 'rb')
+    except FileNotFoundError:
+        return None
+
+def _report_pdf_file(patient_uid, version):
+    """
+    Same as _report_pdf_bytes() for very long histories, but returns the PDF opened from disk
+    (send_file streams and closes it). Opening it right away, rather than passing its path on,
+    means a concurrent re-render can't remove it between the check and the read.
+    """
+    pdf_file = _open_report_file(get_cached_report_file(patient_uid, version))
+
+    prerenderer = get_report_prerenderer()
+    if pdf_file is None and prerenderer is not None:
+        prerenderer.wait(patient_uid, version, current_app.config['REPORT_PRERENDER_WAIT'])
+        pdf_file = _open_report_file(get_cached_report_file(patient_uid, version))
+
+    # The file we render can itself be replaced by a newer version before we open it; try once more
+    for _ in range(2):
+        if pdf_file is not None:
+            return pdf_file
+        path = render_report_file(patient_uid, version)
+        if path is None:
+            return None
+        pdf_file = _open_report_file(path)
+    if pdf_file is None:
+        raise FileNotFoundError(f"Report for {patient_uid} was replaced while being served")
+    return pdf_file
 
 @qr_bp.route('/report/<patient_uid>/download')
 def emergency_report_download(patient_uid):
@@ -74,75 +231,43 @@ def emergency_report_download(patient_uid):
     It does not require login, but in a real system, you'd add
     security like a temporary token in the URL or IP-based restrictions.
     For this project, it's globally accessible as per prompt.
-    """
-    patient_info = None
-    medical_records = []
-    appointments = []
-
-    conn = get_db_connection()
-    if conn is None:
-        flash('Database connection error. Please try again later.', 'error')
-        return "Database error. Please try again later.", 500
 
-    cur = conn.cursor()
+    Rendered PDFs are cached per data version (see backend.reports), and clients
+    that already hold the current version get a 304 without any rendering.
+    Reports for very long histories are built and sent from disk instead of memory.
+    """
     try:
-        # Fetch patient details
-        cur.execute(
-            "SELECT uid, name, date_of_birth, gender, contact_info FROM patients WHERE uid = %s",
-            (patient_uid,)
-        )
-        patient_row = cur.fetchone()
-        if patient_row:
-            patient_info = {
-                'uid': patient_row[0],
-                'name': patient_row[1],
-                'date_of_birth': patient_row[2],
-                'gender': patient_row[3],
-                'contact_info': patient_row[4]
-            }
-
-            # Fetch medical records for the patient, including doctor's username
-            cur.execute(
-                """SELECT mr.record_date, mr.disease_history, mr.prescriptions, u.username as doctor_username
-                   FROM medical_records mr
-                   JOIN users u ON mr.doctor_id = u.id
-                   WHERE mr.patient_uid = %s ORDER BY mr.record_date DESC""",
-                (patient_uid,)
-            )
-            medical_records = cur.fetchall()
-
-            # Fetch appointments for the patient, including doctor's username
-            cur.execute(
-                """SELECT a.appointment_date, a.reason, a.status, u.username as doctor_username
-                   FROM appointments a
-                   JOIN users u ON a.doctor_id = u.id
-                   WHERE a.patient_uid = %s ORDER BY a.appointment_date DESC""",
-                (patient_uid,)
-            )
-            appointments = cur.fetchall()
+        with transaction() as cur:
+            version = fetch_report_version(cur, patient_uid)
+        if version is None:
+            return "Patient not found.", 404
+
+        # Repeat scan of an unchanged report: nothing to send
+        if not is_resource_modified(request.environ, etag=version.etag, last_modified=version.last_modified):
+            response = current_app.response_class(status=304)
+            response.set_etag(version.etag)
+            response.last_modified = version.last_modified
+            return response
 
+        if is_large_report(version):
+            pdf_file = _report_pdf_file(patient_uid, version)
+            if pdf_file is None:
+                return "Patient not found.", 404
+            # Streamed from disk in chunks by the WSGI server
+            response = send_file(pdf_file, mimetype='application/pdf', etag=False, conditional=False)
         else:
-            return "Patient not found.", 404
+            pdf = _report_pdf_bytes(patient_uid, version)
+            if pdf is None:
+                return "Patient not found.", 404
+            response = current_app.response_class(pdf, mimetype='application/pdf')
 
     except psycopg2.Error as e:
         print(f"Error fetching report data: {e}")
         return "Error fetching report data. Please try again later.", 500
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
-
-    # Pass the current datetime object to the template
-    current_time = datetime.now()
-
-    # Render the HTML template for the report
-    html = render_template(
-        'report_template.html',
-        patient_info=patient_info,
-        medical_records=medical_records,
-        appointments=appointments,
-        current_time=current_time # Pass current_time here
-    )
 
-    # Convert HTML to PDF and provide as download
-    return render_pdf(HTML(string=html))
+    response.headers['Content-Disposition'] = 'inline'
+    response.set_etag(version.etag)
+    response.last_modified = version.last_modified
+    # Let browsers keep the PDF but revalidate on every scan, so updates show up immediately
+    response.cache_control.no_cache = True
+    return response
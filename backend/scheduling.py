@@ -0,0 +1,147 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+import psycopg2.errors
+from flask import current_app
+
+# --- Appointment Scheduling ---
+# Double-booking is prevented by the database: the appointments_no_overlap exclusion
+# constraint (migration 0013) rejects a scheduled appointment whose
+# [appointment_date, appointment_date + duration_minutes) range overlaps another one of the
+# same doctor. Checking first and inserting second would race between app nodes; letting
+# the insert fail doesn't, and costs one GiST probe instead of loading the doctor's calendar.
+#
+# Availability comes from bitmaps (migration 0014): one BIT(96) per doctor and day for the
+# working hours and one for the booked slots, 15 minutes per bit. A trigger keeps the booked
+# bitmaps current, so a calendar for any number of doctors and days is a single query that
+# reads one row per doctor and day, never the appointments themselves.
+
+SLOT_MINUTES = 15 # Resolution of the bitmaps
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+MAX_DURATION_MINUTES = 480 # appointments_duration_check
+SEARCH_CHUNK_DAYS = 31
+
+WorkingHours = namedtuple('WorkingHours', ['day_start', 'day_end', 'slot_minutes'])
+# `free` is a string of SLOTS_PER_DAY '0'/'1' characters: '1' where the doctor works and is not booked
+DayAvailability = namedtuple('DayAvailability', ['doctor_id', 'day', 'free'])
+
+class SlotUnavailable(Exception):
+    """Raised when the doctor already has a scheduled appointment overlapping the requested time."""
+
+AVAILABILITY_SQL = """
+    WITH doctors AS (
+        SELECT d.doctor_id, EXISTS (SELECT 1 FROM doctor_working_hours w WHERE w.doctor_id = d.doctor_id) AS has_hours
+        FROM unnest(%(doctor_ids)s::int[]) AS d(doctor_id)
+    )
+    SELECT d.doctor_id, g.day::date,
+           (CASE WHEN d.has_hours THEN COALESCE(w.slots, B'0'::bit(96)) ELSE %(default_slots)s::bit(96) END
+            & ~COALESCE(b.busy, B'0'::bit(96)))::text
+    FROM doctors d
+    CROSS JOIN generate_series(%(first_day)s::date, %(last_day)s::date, interval '1 day') AS g(day)
+    LEFT JOIN doctor_working_hours w ON w.doctor_id = d.doctor_id AND w.isodow = extract(isodow FROM g.day)
+    LEFT JOIN doctor_busy_slots b ON b.doctor_id = d.doctor_id AND b.day = g.day::date
+    ORDER BY d.doctor_id, g.day
+"""
+
+def working_hours():
+    """The default bookable day (APPOINTMENT_DAY_START/END) and the appointment length from the app config."""
+    config = current_app.config
+    return WorkingHours(
+        datetime.strptime(config['APPOINTMENT_DAY_START'], '%H:%M').time(),
+        datetime.strptime(config['APPOINTMENT_DAY_END'], '%H:%M').time(),
+        config['APPOINTMENT_SLOT_MINUTES']
+    )
+
+def _minutes(value):
+    return value.hour * 60 + value.minute
+
+def working_slots(day_start, day_end):
+    """The working-hours bitmap (as a '0'/'1' string) for a day from day_start to day_end; whole slots only."""
+    first = -(-_minutes(day_start) // SLOT_MINUTES)
+    last = _minutes(day_end) // SLOT_MINUTES
+    return ''.join('1' if first <= i < last else '0' for i in range(SLOTS_PER_DAY))
+
+def fetch_availability(cur, doctor_ids, first_day, last_day, hours=None):
+    """
+    Returns a DayAvailability for every doctor in `doctor_ids` and every day from first_day
+    to last_day (inclusive), ordered by doctor then day. One query, however many days.
+    """
+    hours = hours or working_hours()
+    cur.execute(AVAILABILITY_SQL, {
+        'doctor_ids': list(doctor_ids),
+        'first_day': first_day,
+        'last_day': last_day,
+        'default_slots': working_slots(hours.day_start, hours.day_end),
+    })
+    return [DayAvailability(*row) for row in cur.fetchall()]
+
+def free_start_times(availability, duration_minutes, after=None):
+    """
+    Start times on availability.day where an appointment of `duration_minutes` fits into free
+    slots, on multiples of duration_minutes from midnight (so 9:00, 9:30, ... for 30 minutes).
+    """
+    needed = -(-duration_minutes // SLOT_MINUTES)
+    step = max(1, duration_minutes // SLOT_MINUTES)
+    midnight = datetime.combine(availability.day, datetime.min.time())
+    starts = []
+    for first in range(0, SLOTS_PER_DAY - needed + 1, step):
+        if availability.free[first:first + needed] == '1' * needed:
+            start = midnight + timedelta(minutes=first * SLOT_MINUTES)
+            if after is None or start >= after:
+                starts.append(start)
+    return starts
+
+def book_appointment(cur, patient_uid, doctor_id, start, reason, duration_minutes=None):
+    """
+    Inserts a scheduled appointment and returns its id. Raises SlotUnavailable if it
+    overlaps one of the doctor's scheduled appointments; the rest of the caller's
+    transaction is unaffected (the insert runs in a savepoint).
+    """
+    duration_minutes = duration_minutes or working_hours().slot_minutes
+    cur.execute("SAVEPOINT book_appointment")
+    try:
+        cur.execute(
+            """INSERT INTO appointments (patient_uid, doctor_id, appointment_date, duration_minutes, reason, status)
+               VALUES (%s, %s, %s, %s, %s, 'scheduled') RETURNING id""",
+            (patient_uid, doctor_id, start, duration_minutes, reason)
+        )
+    except psycopg2.errors.ExclusionViolation:
+        cur.execute("ROLLBACK TO SAVEPOINT book_appointment")
+        raise SlotUnavailable()
+    appointment_id = cur.fetchone()[0]
+    cur.execute("RELEASE SAVEPOINT book_appointment")
+    return appointment_id
+
+def next_free_slots(cur, doctor_id, after=None, count=5, hours=None, search_days=60):
+    """
+    Returns up to `count` start times (datetimes, earliest first) of free slots for the
+    doctor at or after `after` (default: now), looking at most `search_days` ahead.
+    """
+    hours = hours or working_hours()
+    after = after or datetime.now()
+    slots = []
+    first_day = after.date()
+    last_day = first_day + timedelta(days=search_days)
+    while first_day < last_day and len(slots) < count:
+        chunk_end = min(first_day + timedelta(days=SEARCH_CHUNK_DAYS), last_day)
+        for availability in fetch_availability(cur, [doctor_id], first_day, chunk_end - timedelta(days=1), hours):
+            slots.extend(free_start_times(availability, hours.slot_minutes, after))
+            if len(slots) >= count:
+                break
+        first_day = chunk_end
+    return slots[:count]
+
+# --- Working Hours ---
+
+def fetch_working_hours(cur, doctor_id):
+    """Returns {ISO weekday (1 = Monday): (start_time, end_time)}; empty if the doctor keeps the default hours."""
+    cur.execute("SELECT isodow, start_time, end_time FROM doctor_working_hours WHERE doctor_id = %s", (doctor_id,))
+    return {isodow: (start_time, end_time) for isodow, start_time, end_time in cur.fetchall()}
+
+def save_working_hours(cur, doctor_id, hours_by_weekday):
+    """Replaces the doctor's working hours with `hours_by_weekday` (as returned by fetch_working_hours)."""
+    cur.execute("DELETE FROM doctor_working_hours WHERE doctor_id = %s", (doctor_id,))
+    for isodow, (start_time, end_time) in sorted(hours_by_weekday.items()):
+        cur.execute(
+            "INSERT INTO doctor_working_hours (doctor_id, isodow, start_time, end_time) VALUES (%s, %s, %s, %s)",
+            (doctor_id, isodow, start_time, end_time)
+        )
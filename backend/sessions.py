@@ -0,0 +1,431 @@
+import base64
+import bisect
+import hashlib
+import os
+import random
+import struct
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+import msgspec
+import psycopg2
+from flask import g, current_app, session, flash, redirect, url_for
+from flask.sessions import SecureCookieSessionInterface
+from cachelib.file import FileSystemCache
+from itsdangerous import URLSafeTimedSerializer
+from flask_session import Session
+from flask_session.base import ServerSideSession, ServerSideSessionInterface
+from flask_session.defaults import Defaults
+from backend.lru import LRUCache
+from backend.models import transaction
+
+try:
+    from cryptography.fernet import Fernet, MultiFernet
+except ImportError: # Optional: only needed for encrypted cookie sessions
+    Fernet = MultiFernet = None
+
+# --- Server-side sessions in PostgreSQL ---
+# Selected with SESSION_TYPE = 'postgres'. Sessions live in the sessions table (migration
+# 0006) so any app node can serve any user, with a small per-process LRU in front of it:
+# most requests read their session from memory, and nothing is written back unless the
+# session changed (or its expiry is due for a refresh).
+#
+# The LRU is not shared between nodes: an entry is trusted for at most SESSION_CACHE_TTL
+# seconds, which bounds how long a logout on one node can go unnoticed on another.
+
+class PostgresSession(ServerSideSession):
+    pass
+
+class PostgresSessionInterface(ServerSideSessionInterface):
+    """Flask-Session interface storing sessions in PostgreSQL behind an in-process LRU."""
+
+    session_class = PostgresSession
+    ttl = False # Expired rows are deleted by _delete_expired_sessions()
+
+    def __init__(self, app, key_prefix=Defaults.SESSION_KEY_PREFIX, use_signer=Defaults.SESSION_USE_SIGNER,
+                 permanent=Defaults.SESSION_PERMANENT, sid_length=Defaults.SESSION_ID_LENGTH,
+                 serialization_format=Defaults.SESSION_SERIALIZATION_FORMAT,
+                 cleanup_n_requests=Defaults.SESSION_CLEANUP_N_REQUESTS,
+                 cache_size=10000, cache_ttl=5, refresh_interval=300, cleanup_batch_size=1000):
+        super().__init__(app, key_prefix, use_signer, permanent, sid_length, serialization_format, cleanup_n_requests)
+        self.cache = LRUCache(cache_size)
+        self.cache_ttl = cache_ttl
+        self.refresh_interval = refresh_interval
+        self.cleanup_batch_size = cleanup_batch_size
+
+    def open_session(self, app, request):
+        session = super().open_session(app, request)
+        # Set by _retrieve_session_data(); None for brand new sessions
+        session.store_expires_at = g.pop('session_store_expires_at', None)
+        return session
+
+    def should_set_storage(self, app, session):
+        """
+        Writes the session back only when it changed, or, with SESSION_REFRESH_EACH_REQUEST,
+        when its sliding expiry was last pushed forward more than SESSION_REFRESH_INTERVAL ago.
+        """
+        if session.modified:
+            return True
+        if not app.config['SESSION_REFRESH_EACH_REQUEST']:
+            return False
+        expires_at = getattr(session, 'store_expires_at', None)
+        if expires_at is None:
+            return True
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        return expires_at - time.time() < lifetime - self.refresh_interval
+
+    def _retrieve_session_data(self, store_id):
+        now = time.time()
+        entry = self.cache.get(store_id)
+        if entry is not None:
+            data, expires_at, cached_at = entry
+            if now - cached_at <= self.cache_ttl and expires_at > now:
+                g.session_store_expires_at = expires_at
+                return self.serializer.decode(data)
+            self.cache.delete(store_id)
+
+        try:
+            with transaction() as cur:
+                cur.execute(
+                    """SELECT data, EXTRACT(EPOCH FROM expiry - CURRENT_TIMESTAMP)
+                       FROM sessions WHERE id = %s AND expiry > CURRENT_TIMESTAMP""",
+                    (store_id,)
+                )
+                row = cur.fetchone()
+        except psycopg2.Error as e:
+            # Treat as logged out rather than failing every page while the database is unavailable
+            print(f"Error loading session: {e}")
+            return None
+        if row is None:
+            return None
+        data, expires_in = bytes(row[0]), float(row[1])
+        expires_at = now + expires_in
+        self.cache.set(store_id, (data, expires_at, now))
+        g.session_store_expires_at = expires_at
+        return self.serializer.decode(data)
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        data = self.serializer.encode(session)
+        lifetime = session_lifetime.total_seconds()
+        try:
+            with transaction() as cur:
+                cur.execute(
+                    """INSERT INTO sessions (id, data, expiry)
+                       VALUES (%s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')
+                       ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data, expiry = EXCLUDED.expiry""",
+                    (store_id, psycopg2.Binary(data), lifetime)
+                )
+        except psycopg2.Error as e:
+            self.cache.delete(store_id)
+            print(f"Error saving session: {e}")
+            return
+        now = time.time()
+        self.cache.set(store_id, (data, now + lifetime, now))
+
+    def _delete_session(self, store_id):
+        self.cache.delete(store_id)
+        try:
+            with transaction() as cur:
+                cur.execute("DELETE FROM sessions WHERE id = %s", (store_id,))
+        except psycopg2.Error as e:
+            print(f"Error deleting session: {e}")
+
+    def _delete_expired_batch(self):
+        """Deletes up to SESSION_CLEANUP_BATCH_SIZE expired sessions. Returns (rows, bytes) deleted."""
+        # One short transaction per batch, so cleanup never holds long locks
+        with transaction() as cur:
+            cur.execute(
+                """WITH deleted AS (
+                       DELETE FROM sessions WHERE id IN (
+                           SELECT id FROM sessions WHERE expiry <= CURRENT_TIMESTAMP
+                           LIMIT %s FOR UPDATE SKIP LOCKED)
+                       RETURNING octet_length(data) AS size)
+                   SELECT COUNT(*), COALESCE(SUM(size), 0) FROM deleted""",
+                (self.cleanup_batch_size,)
+            )
+            count, size = cur.fetchone()
+        return count, int(size)
+
+    def _delete_expired_sessions(self, max_batches=None):
+        """Deletes expired sessions in batches of SESSION_CLEANUP_BATCH_SIZE rows. Returns the number deleted."""
+        deleted = 0
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            count, _ = self._delete_expired_batch()
+            deleted += count
+            batches += 1
+            if count < self.cleanup_batch_size:
+                break
+        return deleted
+
+    def sweep_expired(self, time_budget=None):
+        """Deletes expired sessions batch by batch until done or time_budget seconds have passed."""
+        deadline = time.monotonic() + time_budget if time_budget else None
+        removed = reclaimed = 0
+        while True:
+            count, size = self._delete_expired_batch()
+            removed += count
+            reclaimed += size
+            if count < self.cleanup_batch_size:
+                return SweepResult(removed, removed, reclaimed, True)
+            if deadline is not None and time.monotonic() >= deadline:
+                return SweepResult(removed, removed, reclaimed, False)
+
+    def _cleanup_n_requests(self):
+        # Called from before_request: never let a request pay for more than one batch
+        if self.cleanup_n_requests and random.randint(0, self.cleanup_n_requests) == 0:
+            self._delete_expired_sessions(max_batches=1)
+
+# --- Stateless signed-cookie sessions ---
+# Selected with SESSION_TYPE = 'cookie'. The session (user_id, username, role, patient_uid)
+# is small enough to live in the cookie itself, so requests do no session I/O at all.
+# Payloads are msgpack-encoded, signed with SECRET_KEY (SECRET_KEY_FALLBACKS are still
+# accepted, for key rotation) and, if SESSION_COOKIE_ENCRYPTION_KEYS is set, encrypted.
+#
+# A cookie can't be deleted server-side, so logging out records the session's id in
+# revoked_sessions; views decorated with @privileged reject revoked cookies. Other views
+# don't check, which keeps read-mostly traffic free of database lookups.
+
+class MsgpackSessionSerializer:
+    """itsdangerous payload serializer: msgpack, optionally encrypted with (Multi)Fernet."""
+
+    def __init__(self, fernet=None):
+        self.fernet = fernet
+
+    def dumps(self, value):
+        data = msgspec.msgpack.encode(value)
+        if self.fernet is not None:
+            # Fernet tokens are base64 already; store the raw bytes so itsdangerous doesn't encode twice
+            data = base64.urlsafe_b64decode(self.fernet.encrypt(data))
+        return data
+
+    def loads(self, data):
+        if self.fernet is not None:
+            data = self.fernet.decrypt(base64.urlsafe_b64encode(data))
+        return msgspec.msgpack.decode(data)
+
+class _TextURLSafeTimedSerializer(URLSafeTimedSerializer):
+    # The payload is binary, but the signed, base64-encoded result must be text to go in a cookie
+    def dumps(self, obj, salt=None):
+        return super().dumps(obj, salt).decode('ascii')
+
+class SignedCookieSessionInterface(SecureCookieSessionInterface):
+    """Flask's signed cookie sessions with a compact msgpack payload and optional encryption."""
+
+    salt = 'vhr-cookie-session'
+
+    def __init__(self, encryption_keys=()):
+        fernet = None
+        if encryption_keys:
+            if MultiFernet is None:
+                raise RuntimeError("SESSION_COOKIE_ENCRYPTION_KEYS is set but the 'cryptography' package is not installed.")
+            # The first key encrypts; all of them decrypt, so keys can be rotated
+            fernet = MultiFernet([Fernet(key) for key in encryption_keys])
+        self.serializer = MsgpackSessionSerializer(fernet)
+
+    def get_signing_serializer(self, app):
+        if not app.secret_key:
+            return None
+        # itsdangerous signs with the last key and accepts all of them
+        keys = list(app.config['SECRET_KEY_FALLBACKS'] or []) + [app.secret_key]
+        return _TextURLSafeTimedSerializer(
+            keys,
+            salt=self.salt,
+            serializer=self.serializer,
+            signer_kwargs={'key_derivation': self.key_derivation, 'digest_method': self.digest_method}
+        )
+
+def uses_cookie_sessions():
+    return current_app.config['SESSION_TYPE'] == 'cookie'
+
+def revoke_session():
+    """Records the current cookie session as revoked (no-op for server-side sessions, which are simply deleted)."""
+    session_id = session.get('session_id')
+    if not uses_cookie_sessions() or not session_id:
+        return
+    lifetime = current_app.permanent_session_lifetime.total_seconds()
+    with transaction() as cur:
+        # Revocations only matter until the cookie would have expired anyway
+        cur.execute("DELETE FROM revoked_sessions WHERE expires_at < CURRENT_TIMESTAMP")
+        cur.execute(
+            """INSERT INTO revoked_sessions (session_id, expires_at)
+               VALUES (%s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')
+               ON CONFLICT (session_id) DO NOTHING""",
+            (session_id, lifetime)
+        )
+
+def is_session_revoked():
+    session_id = session.get('session_id')
+    if not uses_cookie_sessions() or not session_id:
+        return False
+    with transaction() as cur:
+        cur.execute("SELECT 1 FROM revoked_sessions WHERE session_id = %s", (session_id,))
+        return cur.fetchone() is not None
+
+def privileged(view):
+    """Decorator for views that change data: rejects cookie sessions that were revoked at logout."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            revoked = is_session_revoked()
+        except psycopg2.Error as e:
+            flash(f'Database error: {e}', 'error')
+            return redirect(url_for('index'))
+        if revoked:
+            session.clear()
+            flash('Your session has ended. Please log in again.', 'warning')
+            return redirect(url_for('auth.login'))
+        return view(*args, **kwargs)
+    return wrapper
+
+# --- Expired session garbage collection ---
+# Filesystem sessions are cachelib files that are never looked at again once they expire.
+# cachelib only prunes the directory from inside a request, when the file count passes
+# SESSION_FILE_THRESHOLD, and then scans every file at once. We set the threshold to 0
+# (no inline pruning) and instead sweep the directory with `flask sessions gc`, or from a
+# background thread every SESSION_GC_INTERVAL seconds. Each sweep stops after
+# SESSION_GC_TIME_BUDGET seconds and the next one resumes where it left off.
+# PostgreSQL sessions are swept the same way, in SESSION_CLEANUP_BATCH_SIZE batches.
+
+# scanned/removed are entries, bytes_reclaimed their size; complete is False if the budget ran out
+SweepResult = namedtuple('SweepResult', ['scanned', 'removed', 'bytes_reclaimed', 'complete'])
+
+class SessionFileSweeper:
+    """Removes expired cachelib session files from a directory, a time-bounded slice at a time."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._resume_after = None # Name of the last file the previous (unfinished) sweep looked at
+        self._count_file = hashlib.md5(FileSystemCache._fs_count_file.encode()).hexdigest()
+        self._lock = threading.Lock()
+
+    def _is_session_file(self, name):
+        return name != self._count_file and not name.endswith(FileSystemCache._fs_transaction_suffix)
+
+    def _remove_if_expired(self, path, now):
+        """Returns the size of the file if it was expired and removed, else None."""
+        try:
+            before = os.stat(path)
+            with open(path, 'rb') as f:
+                # cachelib files start with the expiry time as a 4-byte unsigned int (0 = never)
+                expires = struct.unpack('I', f.read(4))[0]
+            if expires == 0 or expires >= now:
+                return None
+            # cachelib rewrites sessions by renaming a new file over the old one: if that
+            # happened since we read it, the session was just refreshed and must be kept
+            if os.stat(path).st_ino != before.st_ino:
+                return None
+            os.remove(path)
+            return before.st_size
+        except FileNotFoundError:
+            return None # Deleted by a logout in the meantime
+        except (OSError, struct.error) as e:
+            print(f"Error sweeping session file {path}: {e}")
+            return None
+
+    def sweep_expired(self, time_budget=None):
+        """Sweeps until every file was checked or time_budget seconds have passed."""
+        with self._lock:
+            deadline = time.monotonic() + time_budget if time_budget else None
+            try:
+                names = sorted(name for name in os.listdir(self.cache_dir) if self._is_session_file(name))
+            except FileNotFoundError:
+                return SweepResult(0, 0, 0, True)
+            start = bisect.bisect_right(names, self._resume_after) if self._resume_after else 0
+
+            now = time.time()
+            scanned = removed = reclaimed = 0
+            for name in names[start:]:
+                size = self._remove_if_expired(os.path.join(self.cache_dir, name), now)
+                scanned += 1
+                if size is not None:
+                    removed += 1
+                    reclaimed += size
+                # Checked after each file, so every sweep makes some progress
+                if deadline is not None and time.monotonic() >= deadline and scanned < len(names) - start:
+                    self._resume_after = name
+                    return SweepResult(scanned, removed, reclaimed, False)
+            self._resume_after = None
+            return SweepResult(scanned, removed, reclaimed, True)
+
+class SessionGarbageCollector:
+    """Runs sweeps, optionally on a daemon thread, and keeps running totals for /admin/metrics."""
+
+    def __init__(self, app, sweeper, time_budget, interval=0):
+        self.app = app
+        self.sweeper = sweeper
+        self.time_budget = time_budget
+        self.interval = interval
+        self.totals = {'sweeps': 0, 'scanned': 0, 'removed': 0, 'bytes_reclaimed': 0, 'last_sweep_seconds': None}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sweep(self, time_budget=None):
+        started = time.monotonic()
+        with self.app.app_context(): # PostgreSQL sweeps need the request-scoped connection helpers
+            result = self.sweeper.sweep_expired(time_budget if time_budget is not None else self.time_budget)
+        totals = self.totals
+        totals['sweeps'] += 1
+        totals['scanned'] += result.scanned
+        totals['removed'] += result.removed
+        totals['bytes_reclaimed'] += result.bytes_reclaimed
+        totals['last_sweep_seconds'] = round(time.monotonic() - started, 3)
+        return result
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e: # Keep the thread alive; the next sweep will try again
+                print(f"Error sweeping expired sessions: {e}")
+
+    def start(self):
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='session-gc', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def metrics(self):
+        return dict(self.totals, interval=self.interval, time_budget=self.time_budget)
+
+def init_session_gc(app):
+    """Sets up expired-session sweeping for 'filesystem' and 'postgres' sessions (None for other types)."""
+    config = app.config
+    sweeper = None
+    if config['SESSION_TYPE'] == 'filesystem':
+        sweeper = SessionFileSweeper(config['SESSION_FILE_DIR'])
+    elif config['SESSION_TYPE'] == 'postgres':
+        sweeper = app.session_interface
+    collector = None
+    if sweeper is not None:
+        collector = SessionGarbageCollector(app, sweeper, config['SESSION_GC_TIME_BUDGET'], config['SESSION_GC_INTERVAL'])
+        collector.start()
+    app.extensions['session_gc'] = collector
+    return collector
+
+def init_session(app):
+    """Installs the session interface selected by SESSION_TYPE ('postgres', 'cookie', or any Flask-Session type)."""
+    config = app.config
+    if config['SESSION_TYPE'] == 'cookie':
+        app.session_interface = SignedCookieSessionInterface(config['SESSION_COOKIE_ENCRYPTION_KEYS'])
+        return app.session_interface
+    if config['SESSION_TYPE'] != 'postgres':
+        Session(app)
+        return app.session_interface
+    app.session_interface = PostgresSessionInterface(
+        app,
+        key_prefix=config.get('SESSION_KEY_PREFIX', Defaults.SESSION_KEY_PREFIX),
+        use_signer=config.get('SESSION_USE_SIGNER', Defaults.SESSION_USE_SIGNER),
+        permanent=config.get('SESSION_PERMANENT', Defaults.SESSION_PERMANENT),
+        sid_length=config.get('SESSION_ID_LENGTH', Defaults.SESSION_ID_LENGTH),
+        serialization_format=config.get('SESSION_SERIALIZATION_FORMAT', Defaults.SESSION_SERIALIZATION_FORMAT),
+        cleanup_n_requests=config.get('SESSION_CLEANUP_N_REQUESTS', Defaults.SESSION_CLEANUP_N_REQUESTS),
+        cache_size=config['SESSION_CACHE_SIZE'],
+        cache_ttl=config['SESSION_CACHE_TTL'],
+        refresh_interval=config['SESSION_REFRESH_INTERVAL'],
+        cleanup_batch_size=config['SESSION_CLEANUP_BATCH_SIZE']
+    )
+    return app.session_interface
@@ -0,0 +1,137 @@
+// "Load more" buttons for keyset-paginated lists.
+// A button carries data-load-more-url and data-cursor. The endpoint answers with
+// {"fragments": {"<name>": "<html>", ...}, "next_cursor": "..."}; each fragment is appended
+// to the element marked data-load-more-target="<name>".
+document.addEventListener('click', function (event) {
+    var button = event.target.closest('[data-load-more-url]');
+    if (!button) {
+        return;
+    }
+    event.preventDefault();
+    button.disabled = true;
+
+    var url = button.dataset.loadMoreUrl + '?cursor=' + encodeURIComponent(button.dataset.cursor);
+    fetch(url, { headers: { 'Accept': 'application/json' }, credentials: 'same-origin' })
+        .then(function (response) {
+            if (!response.ok) {
+                throw new Error('Request failed with status ' + response.status);
+            }
+            return response.json();
+        })
+        .then(function (data) {
+            Object.keys(data.fragments).forEach(function (name) {
+                var target = document.querySelector('[data-load-more-target="' + name + '"]');
+                if (target) {
+                    target.insertAdjacentHTML('beforeend', data.fragments[name]);
+                }
+            });
+            if (data.next_cursor) {
+                button.dataset.cursor = data.next_cursor;
+                button.disabled = false;
+            } else {
+                button.remove();
+            }
+        })
+        .catch(function () {
+            button.disabled = false;
+        });
+});
+
+// Typeahead search boxes.
+// An input carries data-typeahead-url; the next [data-typeahead-results] list shows the
+// matches. The endpoint is called with ?q=<text> and answers {"results": [{"name", "uid",
+// "date_of_birth", "contact_info", "url"}, ...]}, best matches first.
+// Matches link to result.url, or, if the input has data-typeahead-pick, choosing one puts
+// its UID into the input and describes it in the [data-typeahead-selected] element.
+(function () {
+    var DELAY_MS = 200;
+
+    function describe(patient) {
+        return [patient.date_of_birth, patient.contact_info].filter(Boolean).join(' \u00b7 ');
+    }
+
+    function pick(input, list, patient) {
+        input.value = patient.uid; // Setting value doesn't fire 'input', so no new search starts
+        var selected = input.parentNode.querySelector('[data-typeahead-selected]');
+        if (selected) {
+            selected.textContent = 'Selected: ' + patient.name + (patient.date_of_birth ? ' (born ' + patient.date_of_birth + ')' : '');
+        }
+        list.classList.add('hidden');
+    }
+
+    function renderResults(input, list, results) {
+        list.innerHTML = '';
+        if (!results.length) {
+            var empty = document.createElement('li');
+            empty.className = 'px-4 py-2 text-gray-400';
+            empty.textContent = 'No matching patients.';
+            list.appendChild(empty);
+        }
+        var picking = input.hasAttribute('data-typeahead-pick');
+        results.forEach(function (patient) {
+            var item = document.createElement('li');
+            var link = document.createElement(picking ? 'button' : 'a');
+            if (picking) {
+                link.type = 'button';
+                link.addEventListener('click', function () {
+                    pick(input, list, patient);
+                });
+            } else {
+                link.href = patient.url;
+            }
+            link.className = list.dataset.typeaheadItemClass || 'block px-4 py-2 hover:bg-gray-700 text-gray-200';
+            link.textContent = patient.name + ' (UID: ' + patient.uid + ')';
+            var details = document.createElement('span');
+            details.className = 'block text-sm text-gray-400';
+            details.textContent = describe(patient);
+            link.appendChild(details);
+            item.appendChild(link);
+            list.appendChild(item);
+        });
+        list.classList.remove('hidden');
+    }
+
+    document.querySelectorAll('[data-typeahead-url]').forEach(function (input) {
+        var list = input.parentNode.querySelector('[data-typeahead-results]');
+        var timer = null;
+        var latest = 0;
+
+        input.addEventListener('input', function () {
+            clearTimeout(timer);
+            var selected = input.parentNode.querySelector('[data-typeahead-selected]');
+            if (selected) {
+                selected.textContent = ''; // The typed text no longer is the picked patient
+            }
+            var query = input.value.trim();
+            if (query.length < 2) {
+                list.classList.add('hidden');
+                return;
+            }
+            timer = setTimeout(function () {
+                var request = ++latest;
+                fetch(input.dataset.typeaheadUrl + '?q=' + encodeURIComponent(query),
+                      { headers: { 'Accept': 'application/json' }, credentials: 'same-origin' })
+                    .then(function (response) {
+                        if (!response.ok) {
+                            throw new Error('Request failed with status ' + response.status);
+                        }
+                        return response.json();
+                    })
+                    .then(function (data) {
+                        if (request === latest) { // Ignore answers to queries the user has already typed past
+                            renderResults(input, list, data.results);
+                        }
+                    })
+                    .catch(function () {
+                        list.classList.add('hidden');
+                    });
+            }, DELAY_MS);
+        });
+
+        document.addEventListener('click', function (event) {
+            if (event.target !== input && !list.contains(event.target)) {
+                list.classList.add('hidden');
+            }
+        });
+    });
+})();